@@ -0,0 +1,171 @@
+"""
+Build LittleFS image content from data folder (PlatformIO extra script, also usable alone).
+
+Web pages, scripts and style sheets are minified (blanks and comments only, line breaks are kept)
+    and gzipped (ESPAsyncWebServer sends file.gz when file is asked). References to scripts and
+    style sheets in pages get a "?v=<content hash>" suffix, so the firmware can let browsers keep
+    them forever. Other files (settings.json, lang_*.json read by firmware, already gzipped files...)
+    are copied unchanged (lang_*.json being compacted).
+
+An "assets.json" manifest is added, giving hash and size of each file, and date of last change,
+    used by firmware for cache headers.
+
+Files are only rebuilt when their content (or hash of files they reference) changed, using a
+    content hash cache kept next to output folder.
+
+Used alone: python buildWebAssets.py [data] [.pio/build/webData]
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import pathlib
+import re
+import shutil
+import sys
+import time
+
+# Change when output format changes, to rebuild all files
+PIPELINE_VERSION = "1"
+# Files to minify and compress
+COMPRESSED_EXTENSIONS = (".htm", ".html", ".js", ".css")
+# Files read by firmware, that should stay readable
+COMPACTED_JSON = re.compile(r"^lang_.*\.json$")
+# References to scripts and style sheets in pages
+ASSET_REFERENCE = re.compile(r"""((?:src|href)\s*=\s*)(["'])(/?)([\w.-]+\.(?:js|css))\2""")
+# Manifest name
+MANIFEST_FILE = "assets.json"
+
+# Return short hash of a content
+def contentHash(content):
+    return hashlib.sha256(content).hexdigest()[:12]
+
+# Remove a trailing // comment from a line, when it's clearly not in a string or a regular expression
+def removeLineComment(line):
+    position = line.find(" //")
+    while position >= 0:
+        before = line[:position]
+        if before.count('"') % 2 == 0 and before.count("'") % 2 == 0 and "`" not in before and "/" not in before.replace("//", ""):
+            return before.rstrip()
+        position = line.find(" //", position + 1)
+    return line
+
+# Minify a script, keeping line breaks (so automatic semicolons stay where they were)
+def minifyJs(text):
+    lines = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line == "" or line.startswith("//"):
+            continue
+        lines.append(removeLineComment(line))
+    return "\n".join(lines) + "\n"
+
+# Minify a style sheet
+def minifyCss(text):
+    text = re.sub(r"/\*.*?\*/", "", text, flags=re.DOTALL)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"\s*([{}:;,>])\s*", r"\1", text)
+    return text.replace(";}", "}").strip() + "\n"
+
+# Minify a page (comments and indentation), adding hashes to asset references
+def minifyHtml(text, assetHashes):
+    text = re.sub(r"<!--(?!\[).*?-->", "", text, flags=re.DOTALL)
+    lines = [line.strip() for line in text.splitlines() if line.strip() != ""]
+    return fingerprint("\n".join(lines) + "\n", assetHashes)
+
+# Add "?v=<hash>" to references of known assets
+def fingerprint(text, assetHashes):
+    def replace(match):
+        name = match.group(4)
+        if name not in assetHashes:
+            return match.group(0)
+        return F"{match.group(1)}{match.group(2)}{match.group(3)}{name}?v={assetHashes[name]}{match.group(2)}"
+    return ASSET_REFERENCE.sub(replace, text)
+
+# Compress a content, giving same result for same content (no date nor name in header)
+def compress(content):
+    return gzip.compress(content, compresslevel=9, mtime=0)
+
+# Build output folder from data folder, returns count of files rebuilt
+def buildAssets(dataDir, outputDir, log=print):
+    dataDir = pathlib.Path(dataDir)
+    outputDir = pathlib.Path(outputDir)
+    outputDir.mkdir(parents=True, exist_ok=True)
+    cachePath = outputDir.with_name(outputDir.name + ".cache.json")  # Kept out of file system image
+    try:
+        cache = json.loads(cachePath.read_text())
+        if cache.get("version") != PIPELINE_VERSION:
+            cache = {}
+    except (OSError, ValueError):
+        cache = {}
+    cachedFiles = cache.get("files", {})
+    sources = {path.name: path.read_bytes() for path in sorted(dataDir.iterdir()) if path.is_file() and path.name != MANIFEST_FILE}
+    # Hash of each script or style sheet, as referenced by pages (ace.js for ace.js.gz)
+    assetHashes = {}
+    for name, content in sources.items():
+        baseName = name[:-3] if name.endswith(".gz") else name
+        if baseName.endswith((".js", ".css")):
+            assetHashes[baseName] = contentHash(content)
+    files = {}
+    rebuilt = 0
+    for name, content in sources.items():
+        isPage = name.endswith((".htm", ".html"))
+        key = contentHash(content + (json.dumps(assetHashes, sort_keys=True).encode() if isPage else b""))
+        cached = cachedFiles.get(name)
+        if cached != None and cached["key"] == key and (outputDir / cached["output"]).exists():
+            files[name] = cached
+            continue
+        if name.endswith(COMPRESSED_EXTENSIONS):
+            text = content.decode("UTF-8")
+            if isPage:
+                text = minifyHtml(text, assetHashes)
+            elif name.endswith(".css"):
+                text = minifyCss(text)
+            else:
+                text = minifyJs(text)
+            output = name + ".gz"
+            result = compress(text.encode("UTF-8"))
+        elif COMPACTED_JSON.match(name):
+            output = name
+            result = json.dumps(json.loads(content), ensure_ascii=False, separators=(",", ":")).encode("UTF-8")
+        else:
+            output = name
+            result = content
+        (outputDir / output).write_bytes(result)
+        log(F"{name}: {len(content)} -> {len(result)} bytes ({output})")
+        files[name] = {"key": key, "output": output, "hash": contentHash(result), "size": len(result), "sourceSize": len(content)}
+        rebuilt += 1
+    # Remove outputs of deleted or renamed files
+    outputs = {entry["output"] for entry in files.values()} | {MANIFEST_FILE}
+    for path in outputDir.iterdir():
+        if path.name not in outputs:
+            if path.is_dir():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+            rebuilt += 1
+    lastModified = cache.get("lastModified")
+    if rebuilt or lastModified == None:
+        lastModified = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+    manifest = {"lastModified": lastModified, "files": {"/" + entry["output"]: {"hash": entry["hash"], "size": entry["size"]}
+        for entry in files.values()}}
+    (outputDir / MANIFEST_FILE).write_text(json.dumps(manifest, separators=(",", ":")))
+    cachePath.write_text(json.dumps({"version": PIPELINE_VERSION, "lastModified": lastModified, "files": files}, indent=1))
+    sourceSize = sum(len(content) for content in sources.values())
+    outputSize = sum(entry["size"] for entry in files.values())
+    log(F"{rebuilt} file(s) rebuilt, {sourceSize} bytes of data, {outputSize} bytes of assets")
+    return rebuilt
+
+if __name__ == "__main__":
+    buildAssets(sys.argv[1] if len(sys.argv) > 1 else "data", sys.argv[2] if len(sys.argv) > 2 else os.path.join(".pio", "build", "webData"))
+else:
+    # Loaded by PlatformIO: build assets when file system image is built or uploaded, and use them instead of data folder
+    import inspect
+    Import("env")
+    thisScriptFileName = pathlib.Path(inspect.getouterframes(inspect.currentframe())[0].filename).name
+    outputDir = env.subst("$BUILD_DIR/webData")
+    if set(COMMAND_LINE_TARGETS) & {"buildfs", "uploadfs", "uploadfsota"}:
+        print(F"{thisScriptFileName}: Building web assets from {env.subst('$PROJECT_DATA_DIR')} into {outputDir}")
+        buildAssets(env.subst("$PROJECT_DATA_DIR"), outputDir, lambda message: print(F"{thisScriptFileName}: {message}"))
+        env.Replace(PROJECT_DATA_DIR=outputDir)
@@ -6,59 +6,96 @@ It reads received SMS through MQTT and send them back.
 
 This is useless, but may be a good starting point for your own code.
 
-Traces are kept in a log file, rotated each week.
+Profiling (cProfile, tracemalloc, thread stacks) can be started on the running process
+    through commands sent on an MQTT control topic.
+
+Answers can be spread over several SMS servers (see GATEWAYS).
+
+MQTT connection can use a persistent session with QoS 1, so SMS received or sent while
+    reconnecting are not lost.
+
+Traces are kept in a log file, rotated each week, written by a background thread (as text or JSON lines).
+
+Received and sent SMS can also be kept in a SQLite database, to be queried by smsHistory.py (see HISTORY_FILE).
 
 Author: Flying Domotic
 License: GNU GPL V3
 """
 
-fileVersion = "1.1.0"
+fileVersion = "1.6.0"
 
-import paho.mqtt.client as mqtt
 import pathlib
 import os
 import socket
 import random
-import logging
-import logging.handlers as handlers
 import json
 from datetime import datetime
+from smsLogging import setupLogging
+from smsProfiler import Profiler
+from smsTransport import MqttTransport
+from smsGateways import GatewayRouter
+from smsScheduler import SmsScheduler, PRIORITY_NORMAL
+from smsBatch import decodeMessages
+from smsHistory import HistoryStore
 
 def onConnect(client, userdata, flags, reasonCode, properties=None):
     # Check for connection state
     if reasonCode != 'Success' and str(reasonCode) != '0':
-        logger.error(F"Failed to connect - Reason code={reasonCode}")
+        logger.error("Failed to connect - Reason code=%s", reasonCode)
         return
-    client.subscribe(MQTT_RECEIVE_TOPIC, 0)
+    for topic in gatewayRouter.topics():
+        mqttTransport.subscribe(topic)
+    if MQTT_CONTROL_TOPIC != "":
+        mqttTransport.subscribe(MQTT_CONTROL_TOPIC)
+    mqttTransport.publish(MQTT_LWT_TOPIC, '{"state":"up", "version":"'+str(fileVersion)+'", "startDate":"'+str(datetime.now())+'"}', True)
 
 def onMessage(client, userdata, msg):
+    # Execute control commands (profiling, debug)
+    if MQTT_CONTROL_TOPIC != "" and msg.topic == MQTT_CONTROL_TOPIC:
+        command = msg.payload.decode("UTF-8", errors="backslashreplace")
+        logger.info("Received control command %s", command)
+        if not profiler.execute(command):
+            logger.error("Command %s is unknown", command)
+        return
+    # Keep track of SMS servers state
+    if gatewayRouter.onState(msg.topic, msg.payload):
+        return
+    profiler.call(processMessage, client, userdata, msg)
+
+# Process a received SMS message
+def processMessage(client, userdata, msg):
     if msg.retain==0:
         payload = msg.payload.decode("UTF-8")
-        logger.info('Received >'+payload+'< from '+msg.topic)
+        logger.info("Received >%s< from %s", payload, msg.topic)
         try:
-            jsonData = json.loads(payload)
+            # Message may contain a single SMS or a batch of SMS
+            smsList = decodeMessages(payload)
         except:
             #logger.error("Can't decode payload")
             logger.exception("Can't decode payload")
             return
-        number = getValue(jsonData, 'number').strip()
-        date = getValue(jsonData, 'date').strip()
-        message = getValue(jsonData, 'message').strip()
-        if message == '' or date == '' or number == '':
-            logger.error("Can't find 'number' or 'date' or 'message'")
-            return
-        logger.info("Received >"+str(message)+"< from "+str(number)+" on "+str(date))
-        # Compose SMS answer message
-        message = "Received: "+message
-        jsonAnswer = {}
-        jsonAnswer['number'] = str(number)
-        jsonAnswer['message'] = message
-        answerMessage = json.dumps(jsonAnswer)
-        logger.info("Answer: >"+answerMessage+"<")
-        client.publish(MQTT_SEND_TOPIC, answerMessage)
-
-def onSubscribe(client, userdata, mid, reasonCode, properties=None):
-  pass
+        for jsonData in smsList:
+            number = getValue(jsonData, 'number').strip()
+            date = getValue(jsonData, 'date').strip()
+            message = getValue(jsonData, 'message').strip()
+            if message == '' or date == '' or number == '':
+                logger.error("Can't find 'number' or 'date' or 'message'")
+                continue
+            logger.info("Received >%s< from %s on %s", message, number, date, extra={"number": number})
+            if history != None:
+                history.received(number, message, smsDate=date)
+            # Send answer through best SMS server
+            gatewayRouter.send(str(number), "Received: "+message, PRIORITY_NORMAL)
+
+# Compose SMS answer message and send it to an SMS server (called by its scheduler)
+def publishSms(topic, number, message):
+    jsonAnswer = {}
+    jsonAnswer['number'] = number
+    jsonAnswer['message'] = message
+    answerMessage = json.dumps(jsonAnswer)
+    logger.info("Answer: >%s<", answerMessage)
+    if mqttTransport.publish(topic, answerMessage) and history != None:
+        history.sent(number, message)
 
 # Returns a dictionary value giving a key or default value if not existing
 def getValue(dict, key, default=''):
@@ -88,47 +125,65 @@ cdeFile = pathlib.Path(__file__).stem
 
 # MQTT Settings
 MQTT_BROKER = "*myMqttHost*"
+MQTT_PORT = 1883
 MQTT_RECEIVE_TOPIC = "smsServer/received"
 MQTT_SEND_TOPIC = "smsServer/toSend"
 MQTT_LWT_TOPIC = "smsServer/LWT/"+hostName
+MQTT_SMS_SERVER_LWT_TOPIC = "smsServer/LWT"            # LWT topic of SMS server
+MQTT_CONTROL_TOPIC = "smsServer/control/"+hostName   # Set to "" to disable profiling commands
 MQTT_ID = "*myMqttUser*"
 MQTT_KEY = "*myMqttKey*"
 
+# Reliable MQTT transport (persistent session and QoS 1, with a stable client id)
+MQTT_RELIABLE = False
+MQTT_CLIENT_ID = cdeFile+"_"+hostName                  # Only used when MQTT_RELIABLE is True
+MQTT_MAX_INFLIGHT = 20
+MQTT_MAX_QUEUED = 1000
+MQTT_RECONNECT_MIN_DELAY = 1
+MQTT_RECONNECT_MAX_DELAY = 60
+
+# SMS servers, when more than one is used (name -> topics), for example:
+#   {"sim1": {"mqttSendTopic": "smsServer1/toSend", "mqttReceiveTopic": "smsServer1/received", "mqttLwtTopic": "smsServer1/LWT"},
+#   "sim2": {"mqttSendTopic": "smsServer2/toSend", "mqttReceiveTopic": "smsServer2/received", "mqttLwtTopic": "smsServer2/LWT"}}
+# Answers are sent through SMS servers up, a given number always using the same one
+GATEWAYS = {}
+SMS_RATE = 0                                            # Maximum SMS sent per minute by each SMS server (0 for no limit)
+
+# Log format ("text" or "json" for JSON lines)
+LOG_FORMAT = "text"
+
+# History of received and sent SMS (SQLite database, "" to disable), and days records are kept (0 to keep them forever)
+HISTORY_FILE = ""                                       # Like os.path.join(currentPath, cdeFile+"_history.db")
+HISTORY_RETENTION_DAYS = 90
+
 ### End of settings ###
 
-# Log settings
-log_format = "%(asctime)s:%(levelname)s:%(message)s"
-logger = logging.getLogger(cdeFile)
-logger.setLevel(logging.INFO)
-logHandler = handlers.TimedRotatingFileHandler(str(currentPath) + cdeFile +'_'+hostName+'.log', when='W0', interval=1)
-logHandler.suffix = "%Y%m%d"
-logHandler.setLevel(logging.INFO)
-formatter = logging.Formatter(log_format)
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-logger.info('----- Starting on '+hostName+', version '+fileVersion+' -----')
-
-# Use this python file name and random number as client name
+# Log settings (records are written by a background thread)
+logger, _ = setupLogging(cdeFile, os.path.join(currentPath, cdeFile +'_'+hostName+'.log'), LOG_FORMAT == "json")
+logger.info("----- Starting on %s, version %s -----", hostName, fileVersion)
+
+# History of received and sent SMS
+history = None
+if HISTORY_FILE != "":
+    history = HistoryStore(HISTORY_FILE, logger, HISTORY_RETENTION_DAYS)
+    history.start()
+
+# Profiler, driven by control commands (results summary published on <MQTT_CONTROL_TOPIC>/result)
+profiler = Profiler(logger, os.path.join(currentPath, cdeFile +'_'+hostName), lambda text: mqttClient.publish(MQTT_CONTROL_TOPIC+"/result", text))
+
+# Use this python file name and random number as client name (or a stable name with reliable transport)
 random.seed()
-mqttClientName = pathlib.Path(__file__).stem+'_{:x}'.format(random.randrange(65535))
-
-# Initialize MQTT client
-# Try to find CallbackAPIVersion (exists starting on version 2)
-try:
-    from paho.mqtt.enums import CallbackAPIVersion
-    mqttClient = mqtt.Client(client_id=mqttClientName, callback_api_version=CallbackAPIVersion.VERSION2)
-except AttributeError:
-    mqttClient = mqtt.Client(client_id=mqttClientName)
-except ModuleNotFoundError:
-    mqttClient = mqtt.Client(client_id=mqttClientName)
-mqttClient.on_message = onMessage
-mqttClient.on_connect = onConnect
-mqttClient.on_subscribe = onSubscribe
-mqttClient.username_pw_set(MQTT_ID, MQTT_KEY)
-# Set Last Will Testament (QOS=0, retain=True)
-mqttClient.will_set(MQTT_LWT_TOPIC, '{"state":"down"}', 0, True)
-# Connect to MQTT
-mqttClient.connect(MQTT_BROKER)
-mqttClient.publish(MQTT_LWT_TOPIC, '{"state":"up", "version":"'+str(fileVersion)+'", "startDate":"'+str(datetime.now())+'"}', 0, True)
-# Never give up!
-mqttClient.loop_forever()
+mqttClientName = MQTT_CLIENT_ID if MQTT_RELIABLE else pathlib.Path(__file__).stem+'_{:x}'.format(random.randrange(65535))
+
+# SMS servers, each with its outbound SMS scheduler
+gatewayRouter = GatewayRouter(lambda gateway: SmsScheduler(lambda number, message, instance: publishSms(gateway.sendTopic, number, message), logger, SMS_RATE), logger)
+gatewayRouter.configure({name: {"sendTopic": getValue(gateway, "mqttSendTopic", MQTT_SEND_TOPIC), "receiveTopic": getValue(gateway, "mqttReceiveTopic", MQTT_RECEIVE_TOPIC),
+    "lwtTopic": getValue(gateway, "mqttLwtTopic", MQTT_SMS_SERVER_LWT_TOPIC)} for name, gateway in (GATEWAYS or {"default": {}}).items()})
+
+# Initialize MQTT transport
+mqttTransport = MqttTransport(mqttClientName, logger, MQTT_RELIABLE, MQTT_MAX_INFLIGHT, MQTT_MAX_QUEUED, MQTT_RECONNECT_MIN_DELAY, MQTT_RECONNECT_MAX_DELAY)
+mqttTransport.onMessage = onMessage
+mqttTransport.onConnect = onConnect
+mqttClient = mqttTransport.client
+# Connect to MQTT (Last Will Testament being {"state":"down"}, retained), and never give up!
+mqttTransport.run(lambda: (MQTT_BROKER, MQTT_PORT, MQTT_ID, MQTT_KEY, MQTT_LWT_TOPIC, '{"state":"down"}'))
@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Admission control of SMS commands, used by smsHandler.py so that an SMS storm (or a sender
+    retrying in a loop) can't take down the host it should help to recover.
+
+Before being queued, a command should pass:
+    - a token bucket of its sender (sustained commands per minute and burst, that can be given per number),
+    - host load: commands waiting or running are capped by a limit going down from its configured
+        value (while 1 minute load average per CPU is below half of maximum) to 1 (at maximum),
+        and all commands are rejected above maximum load, or when available memory is too low.
+
+Rejected commands are answered immediately by a short SMS (at most one per number and interval,
+    so that a sender retrying in a loop doesn't trigger an SMS storm back). Numbers allowed to
+    ignore host load (to be able to recover it) can be given.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import os
+import threading
+import time
+
+# Admission results
+ADMIT_OK = "ok"
+ADMIT_RATE = "rate"                                                 # Sender exceeded its rate
+ADMIT_LOAD = "load"                                                 # Host load too high
+ADMIT_MEMORY = "memory"                                             # Host memory too low
+ADMIT_FULL = "full"                                                 # Too many commands waiting or running
+
+class TokenBucket:
+    # Create a bucket, full
+    #   rate: tokens added per minute (0 for no limit)
+    #   burst: maximum tokens
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.lastRefill = time.monotonic()
+
+    # Take a token, returns 0 if taken, else delay before next token (in seconds)
+    def take(self):
+        if self.rate <= 0:
+            return 0
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) * 60 / self.rate
+
+    # Return True if bucket is full (and can be forgotten)
+    def isFull(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+    # Add tokens earned since last refill
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate / 60)
+        self.lastRefill = now
+
+# Return host state: 1 minute load average per CPU and available memory in MB (None when not known)
+def readHostState():
+    try:
+        loadPerCpu = round(os.getloadavg()[0] / (os.cpu_count() or 1), 2)
+    except (AttributeError, OSError):
+        loadPerCpu = None
+    availableMb = None
+    try:
+        with open("/proc/meminfo", "r") as memInfo:
+            for line in memInfo:
+                if line.startswith("MemAvailable:"):
+                    availableMb = int(line.split()[1]) // 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    return loadPerCpu, availableMb
+
+class AdmissionController:
+    # Create a controller
+    #   rate/burst: commands per minute and burst of each sender (0 rate for no limit)
+    #   rates: specific settings by number, like {"+33612345678": {"rate": 30, "burst": 10, "ignoreLoad": true}}
+    #   maxLoadPerCpu: 1 minute load average per CPU above which commands are rejected (0 to ignore load)
+    #   minFreeMemory: available memory (in MB) below which commands are rejected (0 to ignore memory)
+    #   replyInterval: minimum delay between two rejection answers to the same number (in seconds)
+    #   metrics: optional metrics registry
+    #   readHost: function returning load per CPU and available memory
+    def __init__(self, rate=10, burst=5, rates=None, maxLoadPerCpu=4, minFreeMemory=32, replyInterval=60, metrics=None, readHost=readHostState):
+        self.metrics = metrics
+        self.readHost = readHost
+        self.lock = threading.Lock()
+        self.buckets = {}                                           # Number -> token bucket
+        self.lastReplies = {}                                       # Number -> time (monotonic) of last rejection answer
+        self.lastHostState = (None, None)
+        self.hostStateTime = 0
+        self.lastCleanTime = time.monotonic()
+        self.configure(rate, burst, rates, maxLoadPerCpu, minFreeMemory, replyInterval)
+        if metrics != None:
+            for reason in (ADMIT_RATE, ADMIT_LOAD, ADMIT_MEMORY, ADMIT_FULL):
+                metrics.increment(F"commands_shed_{reason}", 0)
+            metrics.setGauge("host_load_per_cpu", lambda: self.hostState()[0])
+            metrics.setGauge("host_memory_available_mb", lambda: self.hostState()[1])
+
+    # Change settings (buckets of numbers whose settings didn't change are kept)
+    def configure(self, rate, burst, rates, maxLoadPerCpu, minFreeMemory, replyInterval):
+        with self.lock:
+            self.rate = rate
+            self.burst = burst
+            self.rates = rates or {}
+            self.maxLoadPerCpu = maxLoadPerCpu
+            self.minFreeMemory = minFreeMemory
+            self.replyInterval = replyInterval
+            for number, bucket in list(self.buckets.items()):
+                if (bucket.rate, bucket.burst) != self._limits(number):
+                    del self.buckets[number]
+
+    # Check if a command of a number can be queued
+    #   pending: commands already waiting or running
+    #   maxPending: maximum commands waiting or running when host is idle
+    #   Returns result (ADMIT_xxx) and rejection message to send back (None if already sent recently)
+    def admit(self, number, pending, maxPending):
+        result, message = self._admit(number, pending, maxPending)
+        # Counted out of our lock, as metrics lock is held when reading our gauges
+        if result != ADMIT_OK and self.metrics != None:
+            self.metrics.increment(F"commands_shed_{result}")
+        return result, message
+
+    # Return host state (load per CPU and available memory in MB)
+    def hostState(self):
+        with self.lock:
+            return self._host()
+
+    # Check a command (see admit)
+    def _admit(self, number, pending, maxPending):
+        with self.lock:
+            self._clean()
+            ignoreLoad = bool(self.rates.get(number, {}).get("ignoreLoad", False))
+            loadPerCpu, availableMb = self._host()
+            if not ignoreLoad:
+                if self.minFreeMemory > 0 and availableMb != None and availableMb < self.minFreeMemory:
+                    return self._reject(number, ADMIT_MEMORY, F"Host low on memory ({availableMb} MB), try again later")
+                if self.maxLoadPerCpu > 0 and loadPerCpu != None and loadPerCpu >= self.maxLoadPerCpu:
+                    return self._reject(number, ADMIT_LOAD, F"Host overloaded (load {loadPerCpu} per CPU), try again later")
+                capacity = self._capacity(maxPending, loadPerCpu)
+                if pending >= capacity:
+                    return self._reject(number, ADMIT_FULL, F"Too many pending commands ({pending}), try again later")
+            bucket = self.buckets.get(number)
+            if bucket == None:
+                bucket = TokenBucket(*self._limits(number))
+                self.buckets[number] = bucket
+            delay = bucket.take()
+            if delay:
+                return self._reject(number, ADMIT_RATE, F"Too many commands, try again in {int(delay) + 1} seconds")
+            return ADMIT_OK, None
+
+    # Return state, for logs and metrics
+    def state(self, maxPending):
+        with self.lock:
+            loadPerCpu, availableMb = self._host()
+            return {"loadPerCpu": loadPerCpu, "availableMb": availableMb, "capacity": self._capacity(maxPending, loadPerCpu),
+                "senders": len(self.buckets)}
+
+    # Return commands allowed with a load per CPU: all up to half of maximum load, then linearly less down to 1 (lock should be held)
+    def _capacity(self, maxPending, loadPerCpu):
+        if self.maxLoadPerCpu <= 0 or loadPerCpu == None or loadPerCpu <= self.maxLoadPerCpu / 2:
+            return maxPending
+        ratio = (self.maxLoadPerCpu - loadPerCpu) / (self.maxLoadPerCpu / 2)
+        return max(1, min(maxPending, int(maxPending * ratio)))
+
+    # Return rate and burst of a number (lock should be held)
+    def _limits(self, number):
+        limits = self.rates.get(number, {})
+        return limits.get("rate", self.rate), limits.get("burst", self.burst)
+
+    # Return host state, read at most once per second (lock should be held)
+    def _host(self):
+        now = time.monotonic()
+        if now - self.hostStateTime >= 1:
+            self.lastHostState = self.readHost()
+            self.hostStateTime = now
+        return self.lastHostState
+
+    # Record a rejection, returns result and message to send (lock should be held)
+    def _reject(self, number, reason, message):
+        now = time.monotonic()
+        if now - self.lastReplies.get(number, -self.replyInterval) < self.replyInterval:
+            return reason, None
+        self.lastReplies[number] = now
+        return reason, message
+
+    # Forget full buckets and old answers, once a minute (lock should be held)
+    def _clean(self):
+        now = time.monotonic()
+        if now - self.lastCleanTime < 60:
+            return
+        self.lastCleanTime = now
+        for number in [number for number, bucket in self.buckets.items() if bucket.isFull()]:
+            del self.buckets[number]
+        for number in [number for number, replyTime in self.lastReplies.items() if now - replyTime >= self.replyInterval]:
+            del self.lastReplies[number]
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Batched SMS messages, to send many SMS (like alerts to dozens of numbers) with few MQTT messages.
+
+A message can contain:
+    - a single SMS: {"number": "...", "message": "..."} (the only format known by SMS server),
+    - a batch of SMS: [{...}, {...}] or {"batch": [{...}, {...}]}.
+
+Contains:
+    - decodeMessages, used by smsHandler.py and readSms.py to read both formats,
+    - BatchPublisher, used by smsHandler.py to pack SMS published in a short delay into size bounded batches,
+    - a shim expanding batches into single messages, for SMS servers not knowing batches:
+        smsBatch.py --expand smsServer/toSendBatch smsServer/toSend
+    - a benchmark comparing messages per second of single and batched messages, through MQTT server:
+        smsBatch.py --bench 10000 --batchSize 50
+
+MQTT server settings are read from smsServerParameters.json.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import argparse
+import json
+import threading
+import time
+
+# Default batch bounds
+DEFAULT_MAX_BYTES = 4096
+DEFAULT_MAX_COUNT = 100
+
+# Return list of SMS (dictionaries) contained in a message payload (raises ValueError if not valid)
+def decodeMessages(payload):
+    if isinstance(payload, bytes):
+        payload = payload.decode("UTF-8")
+    data = json.loads(payload)
+    if isinstance(data, dict) and "batch" in data:
+        data = data["batch"]
+    if isinstance(data, dict):
+        return [data]
+    if isinstance(data, list) and all(isinstance(item, dict) for item in data):
+        return data
+    raise ValueError(F"{payload} is not an SMS nor a batch of SMS")
+
+# Pack SMS (dictionaries) into JSON arrays of at most maxBytes and maxCount SMS (a larger SMS being alone)
+def packBatches(items, maxBytes=DEFAULT_MAX_BYTES, maxCount=DEFAULT_MAX_COUNT):
+    return [batch for batch, _ in groupBatches(items, maxBytes, maxCount)]
+
+# Same as packBatches, returning each batch with indexes of its SMS in items
+def groupBatches(items, maxBytes=DEFAULT_MAX_BYTES, maxCount=DEFAULT_MAX_COUNT):
+    batches = []
+    current = []
+    indexes = []
+    currentSize = 2                                                 # Brackets
+    for index, item in enumerate(items):
+        encoded = json.dumps(item)
+        if current and (currentSize + len(encoded) + 2 > maxBytes or len(current) >= maxCount):
+            batches.append(("[" + ", ".join(current) + "]", indexes))
+            current = []
+            indexes = []
+            currentSize = 2
+        current.append(encoded)
+        indexes.append(index)
+        currentSize += len(encoded) + 2                             # Comma and space
+    if current:
+        batches.append(("[" + ", ".join(current) + "]", indexes))
+    return batches
+
+class BatchPublisher:
+    # Create a batch publisher
+    #   publish: function called with topic and payload to really publish a batch, returning False if batch was not published
+    #   delay: time to wait for other SMS before publishing a batch (in seconds)
+    def __init__(self, publish, logger, maxBytes=DEFAULT_MAX_BYTES, maxCount=DEFAULT_MAX_COUNT, delay=0.05):
+        self.publish = publish
+        self.logger = logger
+        self.maxBytes = maxBytes
+        self.maxCount = maxCount
+        self.delay = delay
+        self.condition = threading.Condition()
+        self.pending = {}                                           # Topic -> list of (SMS, function called when published)
+        self.firstTime = None                                       # Time (monotonic) of oldest SMS waiting
+        self.batchCount = 0
+        threading.Thread(target=self._run, name="batchPublisher", daemon=True).start()
+
+    # Add a SMS to batch of a topic
+    #   onPublished: optional function called once batch holding this SMS is published
+    def add(self, topic, item, onPublished=None):
+        with self.condition:
+            self.pending.setdefault(topic, []).append((item, onPublished))
+            if self.firstTime == None:
+                self.firstTime = time.monotonic()
+            self.condition.notify()
+
+    # Publish all waiting SMS now
+    def flush(self):
+        with self.condition:
+            pending = self.pending
+            self.pending = {}
+            self.firstTime = None
+        for topic, entries in pending.items():
+            for batch, indexes in groupBatches([item for item, _ in entries], self.maxBytes, self.maxCount):
+                self.batchCount += 1
+                try:
+                    if self.publish(topic, batch) == False:
+                        self.logger.error("Batch of %d SMS to %s not published", len(indexes), topic)
+                        continue
+                except Exception as e:
+                    self.logger.error("Error %s publishing batch to %s", e, topic)
+                    continue
+                for index in indexes:
+                    onPublished = entries[index][1]
+                    if onPublished != None:
+                        onPublished()
+
+    # Publisher thread
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.firstTime == None:
+                    self.condition.wait()
+                delay = self.firstTime + self.delay - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+            self.flush()
+
+# Create an MQTT client connected to server given in parameters
+def connectClient(jsonData, clientName):
+    import paho.mqtt.client as mqtt
+    # Try to find CallbackAPIVersion (exists starting on version 2)
+    try:
+        from paho.mqtt.enums import CallbackAPIVersion
+        client = mqtt.Client(client_id=clientName, callback_api_version=CallbackAPIVersion.VERSION2)
+    except AttributeError:
+        client = mqtt.Client(client_id=clientName)
+    except ModuleNotFoundError:
+        client = mqtt.Client(client_id=clientName)
+    if jsonData.get("mqttUser", "") != "":
+        client.username_pw_set(jsonData["mqttUser"], jsonData["mqttPassword"])
+    client.connect(jsonData["mqttServer"], jsonData["mqttPort"])
+    return client
+
+# Expand batches received on a topic into single messages on another one (never returns)
+def expand(jsonData, fromTopic, toTopic):
+    client = connectClient(jsonData, F"smsBatchExpand_{int(time.time()) % 65536:x}")
+    def onMessage(client, userdata, msg):
+        try:
+            items = decodeMessages(msg.payload)
+        except ValueError as e:
+            print(F"Ignoring {msg.payload}: {e}")
+            return
+        for item in items:
+            client.publish(toTopic, json.dumps(item))
+    client.on_message = onMessage
+    client.on_connect = lambda client, userdata, flags, reasonCode, properties=None: client.subscribe(fromTopic, 0)
+    print(F"Expanding batches from {fromTopic} to {toTopic}")
+    client.loop_forever(retry_first_connection=True)
+
+# Measure messages per second of SMS published one by one, then in batches, returns results
+def bench(jsonData, count, batchSize):
+    topic = F"smsBatch/bench/{int(time.time())}"
+    received = [0]
+    done = threading.Event()
+    subscribed = threading.Event()
+    def onMessage(client, userdata, msg):
+        received[0] += len(decodeMessages(msg.payload))
+        if received[0] >= count:
+            done.set()
+    subscriber = connectClient(jsonData, F"smsBatchBenchSub_{int(time.time()) % 65536:x}")
+    subscriber.on_message = onMessage
+    subscriber.on_subscribe = lambda *args: subscribed.set()
+    subscriber.subscribe(topic, 1)
+    subscriber.loop_start()
+    publisher = connectClient(jsonData, F"smsBatchBenchPub_{int(time.time()) % 65536:x}")
+    publisher.loop_start()
+    subscribed.wait(10)
+    items = [{"number": F"+3361234{index % 10000:04d}", "message": F"Alert {index}: disk almost full on server {index % 100}"} for index in range(count)]
+    results = {"count": count, "batchSize": batchSize}
+    for mode, payloads in (("single", [json.dumps(item) for item in items]), ("batched", packBatches(items, 256 * 1024, batchSize))):
+        received[0] = 0
+        done.clear()
+        startTime = time.monotonic()
+        for payload in payloads:
+            publisher.publish(topic, payload, 1)
+        done.wait(120)
+        duration = time.monotonic() - startTime
+        results[mode] = {"mqttMessages": len(payloads), "received": received[0], "seconds": round(duration, 3),
+            "smsPerSecond": round(received[0] / duration) if duration else None}
+    publisher.loop_stop()
+    subscriber.loop_stop()
+    return results
+
+#   *****************
+#   *** Main code ***
+#   *****************
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Expand or benchmark batched SMS messages")
+    parser.add_argument("--config", default="smsServerParameters.json", help="configuration file (default smsServerParameters.json)")
+    parser.add_argument("--expand", nargs=2, metavar=("FROM", "TO"), help="expand batches received on FROM topic into single messages on TO topic")
+    parser.add_argument("--bench", type=int, metavar="COUNT", help="compare single and batched publishing of COUNT SMS")
+    parser.add_argument("--batchSize", type=int, default=50, help="SMS per batch for benchmark (default 50)")
+    args = parser.parse_args()
+    with open(args.config, "r") as jsonStream:
+        jsonData = json.load(jsonStream)
+    if args.expand:
+        expand(jsonData, args.expand[0], args.expand[1])
+    elif args.bench:
+        print(json.dumps(bench(jsonData, args.bench, max(1, args.batchSize)), indent=4))
+    else:
+        parser.print_help()
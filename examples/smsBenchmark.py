@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Benchmark, record and replay functions used by smsServerTest.py.
+
+Benchmark sends tagged probes (prefix, run id and sequence number) to SMS server at a given rate and
+    concurrency, matches answers by sequence number, and computes round trip latency percentiles,
+    throughput, loss and reordering.
+
+Record saves MQTT traffic of some topics into a JSON lines file, that replay publishes again,
+    with original timing divided by a speed factor, and a new date for each SMS (so that handlers
+    don't take them for duplicates).
+
+All functions work on an MQTT client whose network loop is already running (loop_start).
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import json
+import math
+import threading
+import time
+import uuid
+
+# Return a percentile (0-100) of a sorted list (None if empty)
+def percentile(sortedValues, percent):
+    if not sortedValues:
+        return None
+    index = max(0, math.ceil(percent / 100 * len(sortedValues)) - 1)
+    return sortedValues[index]
+
+class Benchmark:
+    # Create a benchmark
+    #   client: MQTT client (with network loop running)
+    #   sendTopic: topic to publish probes to (SMS server mqttGetTopic)
+    #   receiveTopic: topic where answers are received (SMS server mqttSendTopic)
+    #   number: phone number to send probes to
+    #   prefix: prefix of probe messages
+    def __init__(self, client, sendTopic, receiveTopic, number, prefix, logger):
+        self.client = client
+        self.sendTopic = sendTopic
+        self.receiveTopic = receiveTopic
+        self.number = number
+        self.prefix = prefix
+        self.logger = logger
+        self.runId = uuid.uuid4().hex[:8]
+        self.lock = threading.Lock()
+        self.sendTimes = {}                                         # Sequence -> send time
+        self.latencies = {}                                         # Sequence -> round trip time
+        self.lastSequence = -1
+        self.reorderedCount = 0
+        self.duplicateCount = 0
+        self.slots = None
+
+    # Handle a received message (to be called from client on_message)
+    #   Returns True if message was a probe answer of this run
+    def onMessage(self, msg):
+        receivedTime = time.monotonic()
+        if msg.topic != self.receiveTopic:
+            return False
+        try:
+            message = json.loads(msg.payload.decode("UTF-8", errors="backslashreplace")).get("message", "")
+            prefix, runId, sequence = message.split()[:3]
+            sequence = int(sequence)
+        except Exception:
+            return False
+        if prefix != self.prefix or runId != self.runId:
+            return False
+        with self.lock:
+            if sequence not in self.sendTimes:
+                return False
+            if sequence in self.latencies:
+                self.duplicateCount += 1
+                return True
+            self.latencies[sequence] = receivedTime - self.sendTimes[sequence]
+            if sequence < self.lastSequence:
+                self.reorderedCount += 1
+            self.lastSequence = max(self.lastSequence, sequence)
+        try:
+            self.slots.release()
+        except ValueError:
+            # Slot was already given back after timeout
+            pass
+        return True
+
+    # Send probes and wait for answers
+    #   count: number of probes
+    #   rate: probes per second (0 for no limit)
+    #   concurrency: maximum number of probes waiting for answer
+    #   timeout: time to wait for an answer
+    #   Returns results dictionary
+    def run(self, count, rate, concurrency, timeout):
+        self.slots = threading.BoundedSemaphore(concurrency)
+        startTime = time.monotonic()
+        for sequence in range(count):
+            # Respect rate
+            if rate > 0:
+                delay = startTime + sequence / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            # Respect concurrency (a probe without answer frees its slot after timeout)
+            if not self.slots.acquire(timeout=timeout):
+                self.logger.info("No answer within %s seconds, sending next probe", timeout)
+            message = json.dumps({"number": self.number, "message": F"{self.prefix} {self.runId} {sequence} {time.time():.3f}"})
+            with self.lock:
+                self.sendTimes[sequence] = time.monotonic()
+            self.client.publish(self.sendTopic, message)
+        lastSendTime = time.monotonic()
+        # Wait for last answers
+        while time.monotonic() - lastSendTime < timeout:
+            with self.lock:
+                if len(self.latencies) >= count:
+                    break
+            time.sleep(0.05)
+        return self.results(count, rate, concurrency, timeout, startTime)
+
+    # Compute results
+    def results(self, count, rate, concurrency, timeout, startTime):
+        with self.lock:
+            latencies = sorted(self.latencies.values())
+            lastAnswer = max((self.sendTimes[sequence] + latency for sequence, latency in self.latencies.items()), default=startTime)
+        duration = lastAnswer - startTime
+        toMs = lambda value: round(value * 1000, 3) if value != None else None
+        return {
+            "runId": self.runId,
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "parameters": {"count": count, "rate": rate, "concurrency": concurrency, "timeout": timeout},
+            "sent": count,
+            "received": len(latencies),
+            "lost": count - len(latencies),
+            "lossPercent": round((count - len(latencies)) * 100 / count, 2) if count else 0,
+            "reordered": self.reorderedCount,
+            "duplicates": self.duplicateCount,
+            "durationSeconds": round(duration, 3),
+            "throughputPerSecond": round(len(latencies) / duration, 3) if duration > 0 else None,
+            "latencyMs": {
+                "min": toMs(latencies[0] if latencies else None),
+                "mean": toMs(sum(latencies) / len(latencies) if latencies else None),
+                "p50": toMs(percentile(latencies, 50)),
+                "p95": toMs(percentile(latencies, 95)),
+                "p99": toMs(percentile(latencies, 99)),
+                "max": toMs(latencies[-1] if latencies else None),
+            },
+        }
+
+class Recorder:
+    # Create a recorder writing messages to a JSON lines file
+    def __init__(self, fileName):
+        self.fileStream = open(fileName, "w")
+        self.startTime = time.monotonic()
+        self.count = 0
+        self.lock = threading.Lock()
+
+    # Record a message (to be called from client on_message)
+    def onMessage(self, msg):
+        line = json.dumps({"t": round(time.monotonic() - self.startTime, 6), "topic": msg.topic,
+            "payload": msg.payload.decode("UTF-8", errors="backslashreplace"), "retain": bool(msg.retain)})
+        with self.lock:
+            self.fileStream.write(line + "\n")
+            self.count += 1
+
+    # Close file
+    def close(self):
+        with self.lock:
+            self.fileStream.close()
+
+# Publish messages of a recorded file again
+#   speed: speed factor (2 means twice faster, should be greater than 0)
+#   topicMap: optional dictionary of recorded topic -> topic to publish to
+#   skipTopics: recorded topics not published again (like send topic, whose SMS would be sent again for real)
+#   Date of replayed SMS is replaced by replay date and sequence, so that duplicate filter of handlers doesn't drop them
+#   Returns count of published messages
+def replay(client, fileName, speed=1.0, topicMap=None, skipTopics=()):
+    if speed <= 0:
+        raise ValueError(F"Replay speed should be greater than 0, not {speed}")
+    count = 0
+    startTime = time.monotonic()
+    with open(fileName, "r") as fileStream:
+        for line in fileStream:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["topic"] in skipTopics:
+                continue
+            delay = startTime + record["t"] / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            topic = topicMap.get(record["topic"], record["topic"]) if topicMap else record["topic"]
+            client.publish(topic, replayPayload(record["payload"], count), 0, record.get("retain", False))
+            count += 1
+    return count
+
+# Return a recorded payload with its SMS date (if any) replaced by current date and a replay sequence
+def replayPayload(payload, sequence):
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        return payload
+    if not isinstance(message, dict) or "date" not in message:
+        return payload
+    message["date"] = F"{time.strftime('%Y/%m/%d %H:%M:%S')} replay {sequence}"
+    return json.dumps(message)
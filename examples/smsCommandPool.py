@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Bounded worker pool used by smsHandler.py to execute SMS commands outside of MQTT network thread.
+
+Jobs are queued per sender, with a global worker count, a per sender concurrency limit and a global queue depth limit.
+
+Commands are run in their own process group, to be able to kill the whole tree when wall clock timeout is reached.
+    Their output is streamed into a size capped capture.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import collections
+import os
+import selectors
+import signal
+import subprocess
+import threading
+import time
+
+# Time to read output left after killing a command (in seconds)
+KILL_DRAIN_DELAY = 2
+
+class CommandPool:
+    # Create a pool
+    #   maxWorkers: maximum number of commands executed at the same time
+    #   maxPerSender: maximum number of commands executed at the same time for one sender
+    #   maxQueueDepth: maximum number of commands waiting or running
+    #   logger: logger to use to report job errors
+    def __init__(self, maxWorkers, maxPerSender, maxQueueDepth, logger):
+        self.maxWorkers = max(1, maxWorkers)
+        self.maxPerSender = max(1, maxPerSender)
+        self.maxQueueDepth = max(1, maxQueueDepth)
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.readyToRun = threading.Condition(self.lock)
+        self.readyJobs = collections.deque()                        # Jobs that can be started right now
+        self.waitingJobs = {}                                       # Jobs blocked by per sender limit, by sender
+        self.runningBySender = {}                                   # Count of running/ready jobs, by sender
+        self.pendingCount = 0                                       # Count of jobs queued or running
+        self.workers = []
+
+    # Change limits (already started workers are kept)
+    def configure(self, maxWorkers, maxPerSender, maxQueueDepth):
+        with self.lock:
+            self.maxWorkers = max(1, maxWorkers)
+            self.maxPerSender = max(1, maxPerSender)
+            self.maxQueueDepth = max(1, maxQueueDepth)
+
+    # Submit a job for a sender. Returns False if queue is full
+    def submit(self, sender, function, *args):
+        with self.lock:
+            if self.pendingCount >= self.maxQueueDepth:
+                return False
+            self.pendingCount += 1
+            job = (sender, function, args)
+            if self.runningBySender.get(sender, 0) < self.maxPerSender:
+                self.runningBySender[sender] = self.runningBySender.get(sender, 0) + 1
+                self.readyJobs.append(job)
+                self.readyToRun.notify()
+            else:
+                self.waitingJobs.setdefault(sender, collections.deque()).append(job)
+            # Start a new worker if all existing ones may be busy
+            if len(self.workers) < self.maxWorkers and len(self.workers) < self.pendingCount:
+                worker = threading.Thread(target=self._worker, name=F"commandWorker{len(self.workers)}", daemon=True)
+                self.workers.append(worker)
+                worker.start()
+        return True
+
+    # Return count of jobs waiting or running
+    def pending(self):
+        with self.lock:
+            return self.pendingCount
+
+    # Worker thread: execute ready jobs forever
+    def _worker(self):
+        while True:
+            with self.lock:
+                while not self.readyJobs:
+                    self.readyToRun.wait()
+                sender, function, args = self.readyJobs.popleft()
+            try:
+                function(*args)
+            except Exception:
+                self.logger.exception("Job for %s failed", sender)
+            finally:
+                self._jobDone(sender)
+
+    # Release sender slot, and promote next waiting job of this sender
+    def _jobDone(self, sender):
+        with self.lock:
+            self.pendingCount -= 1
+            waiting = self.waitingJobs.get(sender)
+            if waiting:
+                self.readyJobs.append(waiting.popleft())
+                self.readyToRun.notify()
+                if not waiting:
+                    del self.waitingJobs[sender]
+            else:
+                self.runningBySender[sender] -= 1
+                if not self.runningBySender[sender]:
+                    del self.runningBySender[sender]
+
+# Run a shell command, killing it (and its children) if it lasts more than timeout seconds
+#   Output (stdout+stderr) is read as it comes, and written to capture (see smsOutputCapture.py)
+#   Returns return code and timed out flag
+def runShellCommand(command, capture, shellName="", timeout=None, cwd=None):
+    process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd, shell=True,
+        executable=shellName if shellName != "" else None, start_new_session=True)
+    timedOut = False
+    deadline = time.monotonic() + timeout if timeout else None
+    with process.stdout, selectors.DefaultSelector() as selector:
+        selector.register(process.stdout, selectors.EVENT_READ)
+        while True:
+            if deadline != None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not selector.select(remaining):
+                    if timedOut:
+                        # A child out of process group (daemon, setsid...) still holds output open, stop reading it
+                        break
+                    # Kill the whole process group, as shell may have started children
+                    timedOut = True
+                    try:
+                        os.killpg(process.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                    deadline = time.monotonic() + KILL_DRAIN_DELAY
+                    continue
+            data = os.read(process.stdout.fileno(), 65536)
+            if not data:
+                break
+            capture.write(data)
+    capture.close()
+    return process.wait(), timedOut
@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Configuration file loading and watching, used by smsHandler.py.
+
+Watcher thread polls configuration file modification time. When changed, file is read,
+    parsed and validated off MQTT thread, then given to a callback. When file is invalid,
+    error is logged and last good configuration is kept.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import json
+import os
+import threading
+
+# Items that must be present in configuration file
+mandatoryItems = ("mqttServer", "mqttPort", "mqttUser", "mqttPassword", "mqttReceiveTopic", "mqttSendTopic",
+    "mqttLwtTopic", "mailSender", "mailServer")
+
+# Read, parse and validate a configuration file
+#   Raises ValueError (with a readable message) if file can't be used
+def readConfig(fileName):
+    try:
+        with open(fileName, "r") as jsonStream:
+            jsonBuffer = jsonStream.read()
+    except Exception as e:
+        raise ValueError(F"Error {str(e)} opening {fileName}")
+    try:
+        configData = json.loads(jsonBuffer)
+    except Exception as e:
+        raise ValueError(F"Error {str(e)} decoding {jsonBuffer}")
+    if not isinstance(configData, dict):
+        raise ValueError(F"{fileName} should contain a JSON object")
+    missingItems = [item for item in mandatoryItems if item not in configData]
+    if missingItems:
+        raise ValueError(F"Mandatory parameter(s) {', '.join(missingItems)} not present in {fileName}")
+    return configData
+
+# Return a numeric item of configuration data (default if not present or null)
+#   minimum: lowest value allowed (None for no check)
+#   positive: value should also be greater than 0
+#   integer: value should be an integer
+#   Raises ValueError (with a readable message) if value can't be used
+def getNumber(configData, key, default, minimum=0, positive=False, integer=False):
+    value = configData.get(key)
+    if value == None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, int if integer else (int, float)):
+        raise ValueError(F"{key} should be {'an integer' if integer else 'a number'}, not {json.dumps(value)}")
+    if positive and value <= 0:
+        raise ValueError(F"{key} should be greater than 0, not {value}")
+    if minimum != None and value < minimum:
+        raise ValueError(F"{key} should be at least {minimum}, not {value}")
+    return value
+
+class ConfigWatcher:
+    # Create a watcher
+    #   fileName: configuration file to watch
+    #   onChange: function called with new configuration data (should raise an exception if data can't be used)
+    #   logger: logger to use
+    #   interval: delay between two checks (in seconds)
+    def __init__(self, fileName, onChange, logger, interval=5):
+        self.fileName = fileName
+        self.onChange = onChange
+        self.logger = logger
+        self.interval = interval
+        self.lastStat = self._stat()
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="configWatcher", daemon=True)
+        self.thread.start()
+
+    # Stop watching
+    def stop(self):
+        self.stopEvent.set()
+
+    # Return file signature (or None if file can't be accessed)
+    def _stat(self):
+        try:
+            stat = os.stat(self.fileName)
+            return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            return None
+
+    # Watcher thread
+    def _run(self):
+        while not self.stopEvent.wait(self.interval):
+            stat = self._stat()
+            if stat == None or stat == self.lastStat:
+                continue
+            self.lastStat = stat
+            self.logger.info("%s changed, reloading it", self.fileName)
+            try:
+                self.onChange(readConfig(self.fileName))
+            except Exception as e:
+                self.logger.error("%s - Keeping previous configuration", e)
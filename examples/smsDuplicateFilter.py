@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Duplicate SMS filter used by smsHandler.py, so redelivered messages never re-run commands.
+
+Messages are identified by a hash of number, date and message, kept in a bounded LRU with time to live.
+
+Keys can optionally be appended to a file, to be reloaded at startup. File is rewritten
+    (keeping only live keys) when it grows larger than twice the cache size.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import collections
+import hashlib
+import os
+import threading
+import time
+
+class DuplicateFilter:
+    # Create a filter
+    #   maxEntries: maximum number of messages remembered
+    #   ttl: time (in seconds) a message is remembered
+    #   persistFile: file used to save keys across restarts (None or "" to disable)
+    #   logger: logger to use to report file errors
+    def __init__(self, maxEntries=10000, ttl=86400, persistFile=None, logger=None):
+        self.maxEntries = max(1, maxEntries)
+        self.ttl = ttl
+        self.persistFile = persistFile if persistFile else None
+        self.logger = logger
+        self.entries = collections.OrderedDict()                    # Key -> time seen, oldest first
+        self.suppressedCount = 0
+        self.lock = threading.Lock()
+        self.fileStream = None
+        self.fileLines = 0
+        if self.persistFile != None:
+            self._load()
+            self._rewrite()
+
+    # Check if a message was already seen, remembering it if not
+    def isDuplicate(self, number, date, message):
+        key = hashlib.sha1(F"{number}\0{date}\0{message}".encode("UTF-8")).hexdigest()
+        now = time.time()
+        with self.lock:
+            seenTime = self.entries.get(key)
+            if seenTime != None and now - seenTime < self.ttl:
+                self.suppressedCount += 1
+                return True
+            self.entries[key] = now
+            self.entries.move_to_end(key)
+            # Remove expired or exceeding entries, from oldest
+            while self.entries:
+                oldestKey, oldestTime = next(iter(self.entries.items()))
+                if len(self.entries) <= self.maxEntries and now - oldestTime < self.ttl:
+                    break
+                del self.entries[oldestKey]
+            if self.fileStream != None:
+                self._append(key, now)
+        return False
+
+    # Load keys from file
+    def _load(self):
+        now = time.time()
+        try:
+            with open(self.persistFile, "r") as fileStream:
+                for line in fileStream:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        try:
+                            seenTime = float(parts[1])
+                        except ValueError:
+                            continue
+                        if now - seenTime < self.ttl:
+                            self.entries[parts[0]] = seenTime
+                            self.entries.move_to_end(parts[0])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self._error("Error %s reading %s", e, self.persistFile)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+
+    # Append a key to file, rewriting it when too large
+    def _append(self, key, seenTime):
+        try:
+            self.fileStream.write(F"{key} {seenTime}\n")
+            self.fileStream.flush()
+            self.fileLines += 1
+            if self.fileLines > 2 * self.maxEntries:
+                self._rewrite()
+        except OSError as e:
+            self._error("Error %s writing %s", e, self.persistFile)
+
+    # Rewrite file with live keys only, and reopen it for append
+    def _rewrite(self):
+        if self.fileStream != None:
+            self.fileStream.close()
+            self.fileStream = None
+        try:
+            tempFile = self.persistFile + ".tmp"
+            with open(tempFile, "w") as fileStream:
+                for key, seenTime in self.entries.items():
+                    fileStream.write(F"{key} {seenTime}\n")
+            os.replace(tempFile, self.persistFile)
+            self.fileLines = len(self.entries)
+            self.fileStream = open(self.persistFile, "a")
+        except OSError as e:
+            self._error("Error %s writing %s", e, self.persistFile)
+
+    # Report an error
+    def _error(self, *args):
+        if self.logger != None:
+            self.logger.error(*args)
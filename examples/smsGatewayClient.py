@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+HTTP client of SMS server web pages (/debug, /status, /log and /rest), used by smsScheduler.py,
+    smsMonitor.py and dashboards polling many SMS servers.
+
+Compared to one request per connection (curl, urllib), it:
+    - keeps connections open between requests (keep-alive), in a small pool per SMS server,
+        retrying once on a fresh connection when a kept connection was closed by SMS server,
+    - uses strict connection and read timeouts, so a dead SMS server doesn't block its caller,
+    - converts /debug JSON to typed values (pendingSms, freeMemory, memoryLowMark... as int),
+    - only returns new /log lines on repeated reads: SMS server gives count of saved lines as ETag,
+        so an unchanged log is answered by a 304 without content, and new lines are found by count.
+        With older SMS server versions (no ETag), new lines are found after last line previously read,
+    - polls several SMS servers in parallel (pollAll).
+
+Can be used alone, to replace curl in dashboards:
+    smsGatewayClient.py http://192.168.1.10 http://192.168.1.11 [--status|--listening|--log] [--follow 10]
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import argparse
+import concurrent.futures
+import http.client
+import json
+import threading
+import time
+import urllib.parse
+
+# Typed /debug fields (other fields are kept as read)
+DEBUG_FIELDS = {
+    "version": str, "relayActive": bool, "powerMode": str, "wifiState": str, "smsState": str, "gsmState": str,
+    "mqttConnected": bool, "isIdle": bool, "isSending": bool, "isReceiving": bool, "pendingSms": int,
+    "localDebugFlag": bool, "localTraceFlag": bool, "localEnterFlag": bool,
+    "Sim7000DebugFlag": bool, "Sim7000TraceFlag": bool, "Sim7000EnterFlag": bool,
+    "lastSentMessage": str, "lastSentDate": str, "lastSentNumber": str,
+    "lastReceivedMessage": str, "lastReceivedDate": str, "lastReceivedNumber": str,
+    "date": str, "freeMemory": int, "largestChunk": int, "memoryLowMark": int,
+}
+
+# Count of last lines kept to find new /log lines when SMS server gives no ETag
+LOG_TAIL_LINES = 3
+
+# Convert a JSON value to a type (None if missing or not convertible)
+def convertValue(value, valueType):
+    if value == None:
+        return None
+    try:
+        if valueType == bool:
+            if isinstance(value, str):
+                return value.strip().lower() in ("true", "1", "yes", "on")
+            return bool(value)
+        if valueType == int:
+            return int(float(value)) if isinstance(value, str) else int(value)
+        return valueType(value)
+    except (TypeError, ValueError):
+        return None
+
+class GatewayDebug:
+    # Create SMS server state from /debug JSON data (fields are None when not given by SMS server)
+    def __init__(self, data):
+        self.raw = data
+        for name, valueType in DEBUG_FIELDS.items():
+            setattr(self, name, convertValue(data.get(name), valueType))
+
+    # Return SMS waiting in SMS server, including the one being sent
+    def waitingSms(self):
+        return (self.pendingSms or 0) + (1 if self.isSending else 0)
+
+    # Return state as a dictionary (typed fields, then other ones)
+    def toDict(self):
+        result = {name: getattr(self, name) for name in DEBUG_FIELDS}
+        result.update({name: value for name, value in self.raw.items() if name not in DEBUG_FIELDS})
+        return result
+
+class GatewayClient:
+    # Create a client for one SMS server
+    #   url: SMS server URL (only scheme, host and port are used, so any of its page URL can be given)
+    #   connectTimeout/readTimeout: maximum delay to connect, and to wait for data (in seconds)
+    #   maxConnections: connections kept open (more can be opened, and are closed after use)
+    def __init__(self, url, connectTimeout=3, readTimeout=10, maxConnections=2, name=None):
+        parts = urllib.parse.urlsplit(url if "://" in url else "http://" + url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(F"{url} is not a valid SMS server URL")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.name = name if name else parts.netloc
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.maxConnections = max(0, maxConnections)
+        self.lock = threading.Lock()
+        self.idleConnections = []
+        self.requestCount = 0
+        self.connectionCount = 0
+        self.logLock = threading.Lock()
+        self.logEtag = None                                         # Last /log ETag
+        self.logTail = []                                           # Last /log lines read
+        self.lostLogLines = 0                                       # Lines overwritten in SMS server before being read
+
+    # Return /debug content
+    def debug(self):
+        return GatewayDebug(self.getJson("/debug"))
+
+    # Return /status content (state, powerMode and smsState)
+    def status(self):
+        return self.getJson("/status")
+
+    # Return list of nodes listening to SMS server LWT topic, as given by SMS server
+    def listening(self):
+        return self.getText("/rest/listening")
+
+    # Restart SMS server, returns its answer
+    def restart(self):
+        return self.getText("/rest/restart", retry=False)
+
+    # Send a SMS through SMS server, returns its answer
+    def send(self, number, message):
+        query = urllib.parse.urlencode({"number": number, "message": message}, quote_via=urllib.parse.quote)
+        return self.getText("/rest/send&" + query, retry=False)
+
+    # Return log lines written since last call (all lines on first call)
+    def newLogLines(self):
+        with self.logLock:
+            headers = {"If-None-Match": self.logEtag} if self.logEtag else {}
+            status, answerHeaders, content = self.request("/log", headers)
+            if status == 304:
+                return []
+            lines = [line for line in content.decode("UTF-8", errors="backslashreplace").split("\n") if line != ""]
+            etag = answerHeaders.get("ETag")
+            savedCount = self._etagCount(etag)
+            previousCount = self._etagCount(self.logEtag)
+            if savedCount != None and previousCount != None and savedCount >= previousCount:
+                newCount = savedCount - previousCount
+                if newCount > len(lines):
+                    self.lostLogLines += newCount - len(lines)
+                newLines = lines[len(lines) - min(newCount, len(lines)):]
+            else:
+                # No ETag (or SMS server restarted): take lines after last ones previously read
+                newLines = lines[self._tailEnd(lines):]
+            self.logEtag = etag
+            self.logTail = lines[-LOG_TAIL_LINES:]
+            return newLines
+
+    # Return JSON content of a page
+    def getJson(self, path, retry=True):
+        return json.loads(self.getText(path, retry))
+
+    # Return text content of a page
+    def getText(self, path, retry=True):
+        status, headers, content = self.request(path, retry=retry)
+        return content.decode("UTF-8", errors="backslashreplace")
+
+    # Read a page, returns status, headers and content (raises OSError on error status)
+    #   path: page path, or full URL on same SMS server
+    #   retry: retry once on a new connection if a kept one was closed (only for requests that can be repeated)
+    def request(self, path, headers=None, retry=True):
+        headers = headers if headers != None else {}
+        if "://" in path:
+            parts = urllib.parse.urlsplit(path)
+            path = parts.path + ("?" + parts.query if parts.query else "")
+        path = path if path.startswith("/") else "/" + path
+        with self.lock:
+            self.requestCount += 1
+        for attempt in range(2):
+            connection, reused = self._acquire()
+            try:
+                connection.request("GET", path, headers=headers)
+                answer = connection.getresponse()
+                content = answer.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, http.client.BadStatusLine):
+                connection.close()
+                if reused and retry and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            self._release(connection, answer.will_close)
+            if answer.status >= 400:
+                raise OSError(F"{self.name}{path} returned {answer.status} {answer.reason}")
+            return answer.status, answer.headers, content
+
+    # Close kept connections
+    def close(self):
+        with self.lock:
+            connections = self.idleConnections
+            self.idleConnections = []
+        for connection in connections:
+            connection.close()
+
+    # Return a kept connection, or a new one, and a flag telling if it was kept
+    def _acquire(self):
+        with self.lock:
+            if self.idleConnections:
+                return self.idleConnections.pop(), True
+            self.connectionCount += 1
+        connectionClass = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        connection = connectionClass(self.host, self.port, timeout=self.connectTimeout)
+        try:
+            connection.connect()
+        except Exception:
+            connection.close()
+            raise
+        connection.sock.settimeout(self.readTimeout)
+        return connection, False
+
+    # Keep a connection for next requests, or close it
+    def _release(self, connection, willClose):
+        with self.lock:
+            if not willClose and len(self.idleConnections) < self.maxConnections:
+                self.idleConnections.append(connection)
+                return
+        connection.close()
+
+    # Return saved log lines count from an ETag (None if not given)
+    def _etagCount(self, etag):
+        try:
+            return int(etag.strip('W/"'))
+        except (AttributeError, ValueError):
+            return None
+
+    # Return position of first line after last lines previously read (0 if not found)
+    def _tailEnd(self, lines):
+        tail = self.logTail
+        if not tail:
+            return 0
+        for position in range(len(lines) - len(tail), -1, -1):
+            if lines[position:position + len(tail)] == tail:
+                return position + len(tail)
+        return 0
+
+# Shared clients, so all users of an SMS server share its connections
+clients = {}
+clientsLock = threading.Lock()
+
+# Return shared client of SMS server of an URL (timeouts are those given when client was created)
+def getClient(url, connectTimeout=3, readTimeout=10):
+    client = GatewayClient(url, connectTimeout, readTimeout)
+    key = (client.scheme, client.host, client.port)
+    with clientsLock:
+        return clients.setdefault(key, client)
+
+# Call a function with each client in parallel, returns dictionary of client name -> result (or exception raised)
+#   function: function called with a client, like GatewayClient.debug
+def pollAll(clientList, function, maxWorkers=16):
+    results = {}
+    if not clientList:
+        return results
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(maxWorkers, len(clientList))) as executor:
+        futures = {executor.submit(function, client): client for client in clientList}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future].name] = future.result()
+            except Exception as e:
+                results[futures[future].name] = e
+    return results
+
+# Return a result printable as JSON
+def printable(result):
+    if isinstance(result, GatewayDebug):
+        return result.toDict()
+    if isinstance(result, Exception):
+        return {"error": str(result)}
+    return result
+
+#   *****************
+#   *** Main code ***
+#   *****************
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Poll SMS server web pages")
+    parser.add_argument("urls", nargs="+", metavar="URL", help="SMS server URL (like http://192.168.1.10)")
+    page = parser.add_mutually_exclusive_group()
+    page.add_argument("--status", action="store_const", dest="page", const="status", help="read /status")
+    page.add_argument("--listening", action="store_const", dest="page", const="listening", help="read /rest/listening")
+    page.add_argument("--log", action="store_const", dest="page", const="log", help="read /log (only new lines with --follow)")
+    parser.add_argument("--follow", type=float, default=0, metavar="SECONDS", help="read again every SECONDS (default 0: once)")
+    parser.add_argument("--timeout", type=float, default=5, help="connection and read timeout, in seconds (default 5)")
+    args = parser.parse_args()
+    function = {"status": GatewayClient.status, "listening": GatewayClient.listening, "log": GatewayClient.newLogLines}.get(args.page, GatewayClient.debug)
+    clientList = [GatewayClient(url, args.timeout, args.timeout) for url in args.urls]
+    try:
+        while True:
+            results = pollAll(clientList, function)
+            for client in clientList:
+                result = results[client.name]
+                if args.page == "log" and isinstance(result, list):
+                    for line in result:
+                        print(F"{client.name}: {line}")
+                else:
+                    print(json.dumps({client.name: printable(result)}, indent=4, ensure_ascii=False))
+            if not args.follow:
+                break
+            time.sleep(args.follow)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Spread outbound SMS over several SMS servers (gateways), used by smsHandler.py and readSms.py.
+
+Each gateway has its own topics, and its own scheduler (so its own rate limit and buffer check),
+    so outbound throughput grows with gateway count.
+
+Gateway state is read from its LWT topic ({"state":"up"} or {"state":"down"}). Gateway is chosen:
+    - among gateways up (or not yet known),
+    - by consistent hashing on destination number, so a conversation stays on the same SIM,
+    - skipping gateways having more SMS waiting than their fair share (bounded loads), to use the
+        least loaded ones during bursts.
+
+When a gateway goes down, its scheduler is paused, and its waiting SMS are sent through other ones.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import bisect
+import hashlib
+import json
+import math
+import threading
+
+class Gateway:
+    # Create a gateway (topics are set by router)
+    def __init__(self, name, scheduler):
+        self.name = name
+        self.scheduler = scheduler
+        self.sendTopic = ""
+        self.receiveTopic = ""
+        self.lwtTopic = ""
+        self.debugUrl = ""
+        self.batchTopic = ""                                        # Topic of batched SMS ("" to send them one by one)
+        self.up = None                                              # None until LWT is read
+        self.routedCount = 0
+
+class GatewayRouter:
+    # Create a router
+    #   createScheduler: function called with a new gateway, returning its scheduler
+    #   loadFactor: maximum load of a gateway, relative to average load, before trying next one
+    #   virtualNodes: points of each gateway on hash ring
+    def __init__(self, createScheduler, logger, loadFactor=1.1, virtualNodes=64):
+        self.createScheduler = createScheduler
+        self.logger = logger
+        self.loadFactor = max(1.0, loadFactor)
+        self.virtualNodes = virtualNodes
+        self.lock = threading.RLock()
+        self.gatewayList = []
+        self.ringHashes = []                                        # Sorted hashes of ring points
+        self.ringNames = []                                         # Gateway name of each point
+
+    # Set gateways from definitions (name -> dictionary with sendTopic, receiveTopic, lwtTopic, debugUrl and batchTopic)
+    #   Existing gateways are kept, removed ones have their waiting SMS sent through other ones
+    def configure(self, definitions):
+        with self.lock:
+            existing = {gateway.name: gateway for gateway in self.gatewayList}
+            gatewayList = []
+            for name, definition in definitions.items():
+                gateway = existing.pop(name, None)
+                newGateway = gateway == None
+                if newGateway:
+                    gateway = Gateway(name, None)
+                gateway.sendTopic = definition["sendTopic"]
+                gateway.receiveTopic = definition["receiveTopic"]
+                gateway.lwtTopic = definition["lwtTopic"]
+                gateway.debugUrl = definition.get("debugUrl", "")
+                gateway.batchTopic = definition.get("batchTopic", "")
+                if newGateway:
+                    gateway.scheduler = self.createScheduler(gateway)
+                gatewayList.append(gateway)
+            self.gatewayList = gatewayList
+            self._buildRing()
+            for gateway in existing.values():
+                gateway.scheduler.pause()
+                self._reroute(gateway)
+
+    # Return gateways
+    def gateways(self):
+        with self.lock:
+            return list(self.gatewayList)
+
+    # Return topics to subscribe to (receive and LWT topics)
+    def topics(self):
+        with self.lock:
+            topics = []
+            for gateway in self.gatewayList:
+                for topic in (gateway.receiveTopic, gateway.lwtTopic):
+                    if topic != "" and topic not in topics:
+                        topics.append(topic)
+            return topics
+
+    # Handle a message if it's a gateway state, returns True if it was
+    def onState(self, topic, payload):
+        with self.lock:
+            gateways = [gateway for gateway in self.gatewayList if gateway.lwtTopic == topic]
+            if not gateways:
+                return False
+            try:
+                state = json.loads(payload).get("state")
+            except (ValueError, AttributeError):
+                self.logger.error("Can't decode state %s from %s", payload, topic)
+                return True
+            if state == None:
+                # Not a state (a gateway is not marked down by another message sent on its topic)
+                self.logger.error("No state in %s from %s", payload, topic)
+                return True
+            up = state == "up"
+            for gateway in gateways:
+                if gateway.up == up:
+                    continue
+                gateway.up = up
+                self.logger.info("Gateway %s is %s", gateway.name, "up" if up else "down")
+                if up:
+                    gateway.scheduler.resume()
+                else:
+                    gateway.scheduler.pause()
+                    self._reroute(gateway)
+        return True
+
+    # Queue a SMS on best gateway for this number, returns False if an identical coalescable SMS was already waiting
+    #   coalesce: don't queue SMS if an identical coalescable one is already waiting
+    #   instance: name of instance answering (None if not known)
+    def send(self, number, message, priority, coalesce=False, instance=None):
+        with self.lock:
+            gateway = self._choose(number)
+            gateway.routedCount += 1
+            return gateway.scheduler.send(number, message, priority, coalesce, instance)
+
+    # Return count of SMS waiting on all gateways
+    def pending(self):
+        return sum(gateway.scheduler.pending() for gateway in self.gateways())
+
+    # Return state of each gateway
+    def state(self):
+        return {gateway.name: {"up": gateway.up, "waiting": gateway.scheduler.pending(), "routed": gateway.routedCount}
+            for gateway in self.gateways()}
+
+    # Return hash of a key on ring
+    def _hash(self, key):
+        return int.from_bytes(hashlib.md5(key.encode("UTF-8")).digest()[:8], "big")
+
+    # Build hash ring (lock should be held)
+    def _buildRing(self):
+        points = sorted((self._hash(F"{gateway.name}#{index}"), gateway.name)
+            for gateway in self.gatewayList for index in range(self.virtualNodes))
+        self.ringHashes = [point[0] for point in points]
+        self.ringNames = [point[1] for point in points]
+
+    # Choose gateway for a number (lock should be held)
+    def _choose(self, number):
+        candidates = {gateway.name: gateway for gateway in self.gatewayList if gateway.up != False}
+        if not candidates:
+            # All gateways are down, keep SMS on its usual one until it comes back
+            candidates = {gateway.name: gateway for gateway in self.gatewayList}
+        if len(candidates) == 1:
+            return next(iter(candidates.values()))
+        loads = {name: gateway.scheduler.load() for name, gateway in candidates.items()}
+        capacity = math.ceil((sum(loads.values()) + 1) * self.loadFactor / len(candidates))
+        # Walk ring from number position, taking first gateway below its fair share
+        start = bisect.bisect(self.ringHashes, self._hash(number))
+        for offset in range(len(self.ringHashes)):
+            name = self.ringNames[(start + offset) % len(self.ringHashes)]
+            if name in candidates and loads[name] < capacity:
+                return candidates[name]
+        return candidates[min(loads, key=loads.get)]
+
+    # Send waiting SMS of a gateway through other ones (lock should be held)
+    def _reroute(self, gateway):
+        entries = gateway.scheduler.drain()
+        if entries:
+            self.logger.info("Sending %d SMS waiting on %s through other gateways", len(entries), gateway.name)
+        for number, message, priority, coalesce, instance in entries:
+            self.send(number, message, priority, coalesce, instance)
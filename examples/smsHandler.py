@@ -2,144 +2,509 @@
 """
 This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
 
-It reads received SMS through MQTT, to isolate messages starting with this node name.
+It reads received SMS through MQTT, to isolate messages starting with this node name
+    (or with the name of one of the instances defined in configuration file).
 
-When found, rest of message is executed as OS local command.
+When found, rest of message is executed as OS local command, in a bounded worker pool with a timeout.
+    Messages already received (same number, date and message) are ignored.
+    Commands exceeding sender rate, or arriving while host is overloaded, are rejected at once.
+    Results of read only commands can be cached for a while.
+    Configuration file changes are applied without restarting.
 
-Result, output and errors are then sent back by mail.
+Result, output and errors are then sent back by mail, through a background mail queue.
+    Large outputs are truncated in mail body, full output being attached as a gzip file.
 
-If answer is shorter than 70 characters, it will be also sent back by SMS.
+If answer fits in allowed count of SMS (taking GSM-7 or UCS-2 encoding into account), it will be also sent back by SMS.
 
 Else result code will be sent back to sender.
 
-Traces are kept in a log file, rotated each week.
+SMS answers are published by a scheduler, limiting their rate and waiting for SMS server
+    to have room in its buffer. When several SMS servers are defined, answers are spread over
+    the ones up, a given number always using the same one while it's not overloaded.
+
+Received messages can contain a batch of SMS, and answers can be published in batches.
+
+Per stage durations, counters and gauges can be read on a local HTTP port (Prometheus format),
+    and periodically published on MQTT, next to LWT topic.
+
+Profiling (cProfile, tracemalloc, thread stacks) can be started on the running process
+    through commands sent on an MQTT control topic.
+
+Accepted commands and their outcome can be written to a journal, so commands interrupted by
+    a crash or a restart are either executed again or reported to sender at next start.
+
+MQTT connection can use a persistent session with QoS 1, so SMS received or sent while
+    reconnecting are not lost. Reconnection is retried with an exponential delay.
+
+Traces are kept in a log file, rotated each week, written by a background thread (as text or JSON lines).
 
 Author: Flying Domotic
 License: GNU GPL V3
 """
 
-fileVersion = "25.7.2-2"
+fileVersion = "26.10.18-1"
 
-import smtplib
-import glob
 import pathlib
-from email import encoders
-from email import utils
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email.message import EmailMessage
-import paho.mqtt.client as mqtt
 import os
 import socket
 import random
-import logging
-import logging.handlers as handlers
 import json
-import socket
 import shlex
-import subprocess
+import sqlite3
 import locale
+import threading
+import time
 from datetime import datetime
+from smsCommandPool import CommandPool, runShellCommand
+from smsOutputCapture import OutputCapture
+from smsShellPool import ShellPool, normalizeShellErrors
+from smsMailer import MailQueue
+from smsRouter import CommandRouter, ROUTE_OK, ROUTE_UNAUTHORIZED
+from smsLogging import setupLogging
+from smsDuplicateFilter import DuplicateFilter
+from smsResultCache import ResultCache, normalizeCommand
+from smsConfig import readConfig, getNumber, ConfigWatcher
+from smsSegmenter import splitSms, splitSmsHead
+from smsScheduler import SmsScheduler, PRIORITY_ALERT, PRIORITY_NORMAL
+from smsMetrics import Metrics, startMetricsServer
+from smsProfiler import Profiler
+from smsJournal import Journal, AT_LEAST_ONCE
+from smsHistory import HistoryStore
+from smsTransport import MqttTransport
+from smsGateways import GatewayRouter
+from smsBatch import decodeMessages, BatchPublisher
+from smsAdmission import AdmissionController, ADMIT_OK
 
 def onConnect(client, userdata, flags, reasonCode, properties=None):
     # Check for connection state
     if reasonCode != 'Success' and str(reasonCode) != '0':
-        logger.error(F"Failed to connect - Reason code={reasonCode}")
+        logger.error("Failed to connect - Reason code=%s", reasonCode)
         return
-    mqttClient.publish(MQTT_LWT_TOPIC, '{"state":"up", "version":"'+str(fileVersion)+'", "startDate":"'+str(datetime.now())+'"}', 0, True)
-    mqttClient.subscribe(MQTT_RECEIVE_TOPIC, 0)
+    mqttTransport.publish(settings.mqttLwtTopic, json.dumps({"state": "up", "version": fileVersion, "startDate": str(datetime.now()), "instances": settings.commandRouter.instanceNames()}), True)
+    for topic in gatewayRouter.topics():
+        mqttTransport.subscribe(topic)
+    if settings.mqttControlTopic != "":
+        mqttTransport.subscribe(settings.mqttControlTopic)
+    recoverJournal()
 
 def onMessage(client, userdata, msg):
+    # Execute control commands (profiling, debug)
+    if settings.mqttControlTopic != "" and msg.topic == settings.mqttControlTopic:
+        command = msg.payload.decode("UTF-8", errors="backslashreplace")
+        logger.info("Received control command %s", command)
+        if not profiler.execute(command):
+            logger.error("Command %s is unknown", command)
+        return
+    # Keep track of SMS servers state
+    if gatewayRouter.onState(msg.topic, msg.payload):
+        return
+    profiler.call(processMessage, client, userdata, msg)
+
+# Process a received message (a single SMS or a batch of SMS)
+def processMessage(client, userdata, msg):
     if msg.retain==0:
+        startTime = time.monotonic()
+        currentSettings = settings
         payload = msg.payload.decode("UTF-8")
-        logger.info('Received >'+payload+'< from '+msg.topic)
+        logger.info("Received >%s< from %s", payload, msg.topic)
         try:
-            jsonData = json.loads(payload)
+            smsList = decodeMessages(payload)
         except:
             #logger.error("Can't decode payload")
             logger.exception("Can't decode payload")
+            metrics.increment("messages_received")
+            metrics.increment("messages_invalid")
             return
-        number = getValue(jsonData, 'number').strip()
-        date = getValue(jsonData, 'date').strip()
-        message = getValue(jsonData, 'message').strip()
-        if message == '' or date == '' or number == '':
-            logger.error("Can't find 'number' or 'date' or 'message'")
+        for jsonData in smsList:
+            processSms(jsonData, startTime, currentSettings)
+
+# Process a received SMS
+def processSms(jsonData, startTime, currentSettings):
+    metrics.increment("messages_received")
+    number = getValue(jsonData, 'number').strip()
+    date = getValue(jsonData, 'date').strip()
+    message = getValue(jsonData, 'message').strip()
+    if message == '' or date == '' or number == '':
+        logger.error("Can't find 'number' or 'date' or 'message'")
+        metrics.increment("messages_invalid")
+        return
+    # Drop messages already received (redelivered by broker or gateway)
+    if duplicateFilter.isDuplicate(number, date, message):
+        logger.info("Ignoring duplicate message from %s on %s (%d duplicates suppressed)", number, date, duplicateFilter.suppressedCount)
+        metrics.increment("messages_duplicate")
+        return
+    decodedTime = time.monotonic()
+    status, instance, receiver, command = currentSettings.commandRouter.route(number, message)
+    routedTime = time.monotonic()
+    if history != None:
+        history.received(number, message, instance.name if instance != None else None, status, date)
+    if status == ROUTE_OK:
+        logger.info("Command=%s for %s", command, instance.name, extra={"number": number, "instance": instance.name, "command": command})
+        # Reject at once commands exceeding sender rate or host capacity, instead of queuing them
+        admission, rejection = admissionController.admit(number, commandPool.pending(), currentSettings.maxQueuedCommands)
+        if admission != ADMIT_OK:
+            logger.error("Rejecting %s from %s (%s), host state %s", command, number, admission, admissionController.state(currentSettings.maxQueuedCommands))
+            metrics.increment("commands_rejected")
+            if history != None:
+                history.command(number, instance.name, command, "rejected " + admission)
+            if rejection != None:
+                sendSms(number, rejection, coalesce=True, instance=instance.name)
             return
-        if message[:len(instanceName)].lower() == instanceName.lower():
-            receiver = ""
-            if "mailReceivers" in configData:
-                if number in configData["mailReceivers"]:
-                    receiver = configData["mailReceivers"][number]
-                    command = message[len(instanceName):].strip()
-                    logger.info("Command="+command)
-                    try:
-                        if shellName != "":
-                            result = subprocess.run(shellInitCommand + command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=pathlib.Path.home(), shell=True, executable=shellName)
-                        else:
-                            result = subprocess.run(shellInitCommand + command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=pathlib.Path.home(), shell=True)
-                        log = result.stdout.decode(locale.getpreferredencoding()).rstrip()
-                        logger.info("Log="+log)
-                        if result.returncode == 0:
-                            response = F"Command ok, see mail"
-                        else:
-                            response = F"Error {result.returncode} occured! See mail"
-                            if shellErrorRemove != "":
-                                log = log.replace(shellErrorRemove, "")
-                        logger.info("Response: "+response)
-                        # Replace response code by full answer if short
-                        if len(log) < 70:
-                            response = log
-                        if receiver != None:
-                            sendMail(command, log, receiver)
-                        else:
-                            response += ", mail not in "+jsonFile
-                        # compose SMS answer message
-                        jsonAnswer = {}
-                        jsonAnswer['number'] = str(number)
-                        jsonAnswer['message'] = response
-                        answerMessage = json.dumps(jsonAnswer)
-                        logger.info("Answer: >"+answerMessage+"<")
-                        mqttClient.publish(MQTT_SEND_TOPIC, answerMessage)
-                    except OSError as err:
-                        logger.error("Command execution failed with error "+str(err))
-                        response = "Error: {:s}".format(err.strerror)
-                        logger.info("Response: "+response)
-                        sendMail(command, response, receiver)
-                else:
-                    logger.info(F"'{number}' don't exist in 'mailReceivers' from configuration file")
+        timings = {"decode": elapsedMs(startTime, decodedTime), "route": elapsedMs(decodedTime, routedTime)}
+        # Record command in journal before executing it
+        journalId = journal.accept({"number": number, "date": date, "message": message}) if journal != None else None
+        # Execute command in worker pool, to keep MQTT loop responsive
+        if not commandPool.submit(number, profiler.call, executeCommand, number, receiver, command, instance, timings, routedTime, currentSettings, journalId):
+            logger.error("Queue full (%d commands pending), rejecting %s", commandPool.pending(), command)
+            metrics.increment("commands_rejected")
+            if journal != None:
+                journal.done(journalId, "rejected")
+            if history != None:
+                history.command(number, instance.name, command, "rejected full")
+            sendSms(number, "Too many pending commands, try again later", coalesce=True, instance=instance.name)
+    elif status == ROUTE_UNAUTHORIZED:
+        logger.info("'%s' don't exist in 'mailReceivers' of %s from configuration file", number, instance.name)
+        metrics.increment("messages_unauthorized")
+    else:
+        logger.info("Ignoring %s", message)
+        metrics.increment("messages_ignored")
+
+# Execute a command (in a worker thread) and send result back by mail and SMS
+#   timings: stage durations already measured (updated here)
+#   queuedTime: time (monotonic) job was queued
+#   currentSettings: settings in use when message was received
+#   journalId: id of command in journal (None if not journaled)
+def executeCommand(number, receiver, command, instance, timings, queuedTime, currentSettings, journalId=None):
+    # Command should be in journal before being executed
+    if journalId != None and not journal.waitDurable(journalId, 10):
+        logger.error("Journal not written after 10 seconds, executing %s anyway", command)
+    startTime = time.monotonic()
+    timings["queue"] = elapsedMs(queuedTime, startTime)
+    captures = []
+    returnCode = None
+    timedOut = False
+    metrics.addGauge("commands_in_flight", 1)
+    try:
+        # Run command (or get its result from cache if allowed)
+        commandTimeout = currentSettings.commandTimeout
+        ttl = currentSettings.resultCache.ttl(command)
+        if ttl == None:
+            (returnCode, timedOut, log, truncated, totalSize, head), _, _ = runCommand(command, instance, captures, currentSettings)
+            fromCache = False
+        else:
+            (returnCode, timedOut, log, truncated, totalSize, head), fromCache = currentSettings.resultCache.get((instance.name, normalizeCommand(command)), ttl,
+                lambda: runCommand(command, instance, captures, currentSettings))
+            if fromCache:
+                logger.info("Result of %s taken from cache", command)
+                metrics.increment("commands_cached")
+        commandTime = time.monotonic()
+        timings["command"] = elapsedMs(startTime, commandTime)
+        logger.info("Log=%s", log)
+        metrics.increment("commands_executed")
+        if timedOut:
+            metrics.increment("commands_timed_out")
+            response = F"Command killed after {commandTimeout} seconds! See mail"
+            log += F"\n*** Command killed after {commandTimeout} seconds ***"
+        elif returnCode == 0:
+            response = F"Command ok, see mail"
+        else:
+            response = F"Error {returnCode} occured! See mail"
+            metrics.increment("commands_failed")
+            if instance.shellErrorRemove != "":
+                log = log.replace(instance.shellErrorRemove, "")
+                head = head.replace(instance.shellErrorRemove, "")
+        logger.info("Response: %s", response)
+        # Replace response code by full answer if it fits in allowed SMS count (or by start of answer if too large to be kept in memory)
+        smsParts = [response]
+        priority = PRIORITY_NORMAL if returnCode == 0 and not timedOut else PRIORITY_ALERT
+        if log != "" and not timedOut:
+            if truncated:
+                logParts = splitSmsHead(head.rstrip(), F"... ({totalSize} bytes, see mail)", currentSettings.smsMaxParts, currentSettings.smsTransliterate)
             else:
-                logger.info("'mailReceivers' don't exist in configuration file")
+                logParts = splitSms(log, currentSettings.smsMaxParts, currentSettings.smsTransliterate)
+            if logParts != None:
+                smsParts = logParts
+        if receiver != None:
+            if captures and captures[0].isTruncated():
+                log += F"\n*** Output is {totalSize} bytes long, full output is attached ***"
+                attachment = captures[0].attachment()
+                mailQueue.send(command, log, to=receiver, fileToAttach=attachment, temporaryFiles=[attachment])
+            elif truncated:
+                # Result shared with a concurrent identical command, which owns the attachment
+                log += F"\n*** Output is {totalSize} bytes long, full output is attached to first answer ***"
+                mailQueue.send(command, log, to=receiver)
+            else:
+                mailQueue.send(command, log, to=receiver)
         else:
-            logger.info("Ignoring "+message)
-
-# Send an email to me
-def sendMail(subject, body, fileToAttach = None, to=""):
-    global mailSender, mailServer
-    with smtplib.SMTP(mailServer) as server:
-        if fileToAttach != None:
-            msg = MIMEMultipart()
-            msg.attach(MIMEText(body, "plain", "UTF-8"))
-            fileCount = 0
-            for file in glob.glob(fileToAttach):
-                fileCount += 1
-                # Add file as application/octet-stream
-                part = MIMEBase("application", "octet-stream")
-                part.set_payload(open(file, "rb").read())
-                encoders.encode_base64(part)
-                part.add_header("Content-Disposition", F"attachment; filename={pathlib.Path(file).name}")
-                msg.attach(part)
-            if not fileCount:
-                print(F"Can't find {fileToAttach} - File not attached!")
+            response += ", mail not in "+jsonFile
+            smsParts = splitSms("".join(smsParts) + ", mail not in "+jsonFile, currentSettings.smsMaxParts, currentSettings.smsTransliterate) or [response]
+            for capture in captures:
+                capture.cleanup()
+        mailTime = time.monotonic()
+        timings["mail"] = elapsedMs(commandTime, mailTime)
+        for part in smsParts:
+            sendSms(number, part, priority, instance=instance.name)
+        timings["publish"] = elapsedMs(mailTime, time.monotonic())
+    except OSError as err:
+        for capture in captures:
+            capture.cleanup()
+        logger.error("Command execution failed with error %s", err)
+        metrics.increment("commands_failed")
+        response = "Error: {:s}".format(err.strerror)
+        logger.info("Response: %s", response)
+        mailQueue.send(command, response, to=receiver)
+    except Exception as err:
+        # Unexpected error (logged by command pool): sender would otherwise get no answer at all
+        metrics.increment("commands_failed")
+        sendSms(number, F"{command} failed with internal error {type(err).__name__}", PRIORITY_ALERT, instance=instance.name)
+        raise
+    finally:
+        # Always done, even if an unexpected error is raised (and logged by command pool)
+        metrics.addGauge("commands_in_flight", -1)
+        if journalId != None:
+            journal.done(journalId, returnCode=returnCode)
+        if history != None:
+            history.command(number, instance.name, command, "timedOut" if timedOut else "done" if returnCode != None else "failed", returnCode, timings.get("command"))
+        metrics.observeTimings(timings)
+        logger.info("Done %s for %s", command, number,
+            extra={"number": number, "instance": instance.name, "command": command, "returnCode": returnCode, "timings": timings})
+
+# Handle commands interrupted by a crash or a restart (once, when first connected)
+def recoverJournal():
+    global interruptedRecords
+    records = interruptedRecords
+    interruptedRecords = []
+    for record in records:
+        number = record.get("number", "")
+        status, instance, receiver, command = settings.commandRouter.route(number, record.get("message", ""))
+        if status != ROUTE_OK:
+            journal.done(record["id"], "abandoned")
+        elif journalMode == AT_LEAST_ONCE:
+            logger.info("Executing again %s for %s, interrupted on %s", command, number, datetime.fromtimestamp(record.get("time", 0)))
+            if not commandPool.submit(number, profiler.call, executeCommand, number, receiver, command, instance, {}, time.monotonic(), settings, record["id"]):
+                journal.done(record["id"], "rejected")
         else:
-            msg = EmailMessage()
-            msg.set_content(body)
-        msg['Subject'] = subject
-        msg['Date'] = utils.formatdate(localtime=True)
-        msg['From'] = mailSender
-        msg['To'] = to if to else mailSender
-        server.sendmail(msg['From'], msg['To'], msg.as_string())
-        server.quit()
+            logger.info("Not executing again %s for %s, interrupted on %s", command, number, datetime.fromtimestamp(record.get("time", 0)))
+            journal.done(record["id"], "abandoned")
+            sendSms(number, F"{command} was interrupted by a restart, not executed again", PRIORITY_ALERT, instance=instance.name)
+
+# Run a command for an instance, capturing its output
+#   captures: list where capture is added (to get attachment or clean it)
+#   Returns (return code, timed out flag, output text, truncated flag, output size, start of output if truncated), cached size and cacheable flag
+def runCommand(command, instance, captures, currentSettings):
+    capture = OutputCapture(currentSettings.outputHeadSize, currentSettings.outputTailSize, currentSettings.outputMaxSize, cdeFile+"_")
+    captures.append(capture)
+    pool = shellPools.get((instance.shellName, instance.shellInitCommand)) if currentSettings.warmShells > 0 else None
+    returnCode = None
+    if pool != None:
+        try:
+            returnCode, timedOut = pool.run(command, capture, currentSettings.commandTimeout)
+        except OSError as e:
+            logger.error("No warm shell available (%s), running %s in a new one", e, command)
+    if returnCode == None:
+        returnCode, timedOut = runShellCommand(instance.shellInitCommand + command, capture, instance.shellName, currentSettings.commandTimeout, pathlib.Path.home())
+    log = capture.text(locale.getpreferredencoding()).rstrip()
+    head = capture.headText(locale.getpreferredencoding()) if capture.isTruncated() else ""
+    if pool != None:
+        log = normalizeShellErrors(log, pool.shellName)
+        head = normalizeShellErrors(head, pool.shellName)
+    return (returnCode, timedOut, log, capture.isTruncated(), capture.totalSize, head), len(log) + len(head), not timedOut and not capture.isTruncated()
+
+# Start warm shells needed by settings, stopping those no longer used
+def configureShellPools(currentSettings):
+    keys = set()
+    if currentSettings.warmShells > 0:
+        keys = {(instance.shellName, instance.shellInitCommand) for instance in currentSettings.commandRouter.instances.values()}
+    with shellPoolsLock:
+        for key, pool in list(shellPools.items()):
+            if key not in keys or (pool.size, pool.maxCommands, pool.initTimeout) != (currentSettings.warmShells, currentSettings.warmShellMaxCommands,
+                    currentSettings.warmShellInitTimeout):
+                pool.close()
+                del shellPools[key]
+        for key in keys:
+            if key not in shellPools:
+                shellPools[key] = ShellPool(key[0], key[1], pathlib.Path.home(), logger, currentSettings.warmShells,
+                    currentSettings.warmShellMaxCommands, currentSettings.warmShellInitTimeout, metrics)
+
+# Return count of warm shells ready
+def readyShells():
+    with shellPoolsLock:
+        return sum(pool.ready() for pool in shellPools.values())
+
+# Queue a SMS answer into scheduler of best SMS server
+#   coalesce: don't send SMS if an identical coalescable one is already waiting (for notices, not command answers)
+#   instance: name of instance answering (written to history)
+def sendSms(number, message, priority=PRIORITY_NORMAL, coalesce=False, instance=None):
+    gatewayRouter.send(str(number), message, priority, coalesce, instance)
+
+# Create scheduler of an SMS server (called by gateway router)
+def createScheduler(gateway):
+    currentSettings = settings
+    return SmsScheduler(lambda number, message, instance: publishSms(gateway, number, message, instance), logger, currentSettings.smsRate,
+        currentSettings.smsBurst, gateway.debugUrl, currentSettings.smsServerMaxPending)
+
+# Compose SMS answer message and send it through MQTT to an SMS server (called by scheduler)
+def publishSms(gateway, number, message, instance=None):
+    jsonAnswer = {}
+    jsonAnswer['number'] = str(number)
+    jsonAnswer['message'] = message
+    answerMessage = json.dumps(jsonAnswer)
+    if gateway.batchTopic != "":
+        # Published with other SMS released by scheduler in a short delay (counted once batch is published)
+        logger.info("Answer: >%s< (batched)", answerMessage)
+        batchPublisher.add(gateway.batchTopic, jsonAnswer, lambda: smsPublished(gateway, number, message, instance))
+        return
+    logger.info("Answer: >%s<", answerMessage)
+    if mqttTransport.publish(gateway.sendTopic, answerMessage):
+        smsPublished(gateway, number, message, instance)
+
+# Count and record a SMS answer published to an SMS server
+def smsPublished(gateway, number, message, instance=None):
+    metrics.increment("sms_sent")
+    if history != None:
+        history.sent(str(number), message, instance, gateway=gateway.name)
+
+# Publish a control command result on <mqttControlTopic>/<instanceName>/result
+def publishControlResult(text):
+    if settings.mqttControlTopic != "":
+        mqttClient.publish(settings.mqttControlTopic + "/result", text, 0, False)
+
+# Publish metrics periodically on <mqttLwtTopic>/<instanceName>/stats (stats thread)
+def publishStats():
+    while True:
+        statsInterval = settings.statsInterval
+        time.sleep(statsInterval if statsInterval > 0 else 5)
+        if settings.statsInterval > 0 and mqttClient.is_connected():
+            mqttClient.publish(settings.mqttLwtTopic + "/stats", json.dumps(metrics.snapshot()), 0, False)
+
+# Configuration items only read at startup (a warning is logged when they change)
+STARTUP_ONLY_ITEMS = ("logFormat", "metricsPort", "metricsAddress", "journalFile", "journalMode", "journalSyncDelay", "journalCompactSize",
+    "historyFile", "historyRetentionDays", "historyBatchDelay", "duplicateCacheSize", "duplicateTtl", "duplicateCacheFile",
+    "smsBatchMaxBytes", "smsBatchMaxCount", "smsBatchDelay", "gatewayLoadFactor", "mqttReliable", "mqttClientId", "mqttMaxInflight",
+    "mqttMaxQueued", "mqttReconnectMinDelay", "mqttReconnectMaxDelay", "configCheckInterval")
+
+# Settings derived from configuration file, replaced as a whole when file changes
+class Settings:
+    # Build settings from configuration data (raises ValueError if an item has a wrong type or value, another exception if data can't be used)
+    def __init__(self, configData):
+        self.instanceName = getValue(configData, "instanceName", hostName)
+        # MQTT
+        self.mqttBroker = configData["mqttServer"]
+        self.mqttPort = getNumber(configData, "mqttPort", None, positive=True, integer=True)
+        self.mqttReceiveTopic = configData["mqttReceiveTopic"]
+        self.mqttSendTopic = configData["mqttSendTopic"]
+        self.mqttLwtTopic = configData["mqttLwtTopic"]+"/"+self.instanceName
+        self.mqttControlTopic = getValue(configData, "mqttControlTopic")
+        if self.mqttControlTopic != "":
+            self.mqttControlTopic += "/"+self.instanceName
+        self.mqttUser = configData["mqttUser"]
+        self.mqttPassword = configData["mqttPassword"]
+        # Mail
+        self.mailSender = configData["mailSender"]
+        self.mailServer = configData["mailServer"]
+        self.mailDigestWindow = getNumber(configData, "mailDigestWindow", 0)
+        self.mailTimeout = getNumber(configData, "mailTimeout", 30, positive=True)
+        # Instances, with their mail receivers and shell options
+        self.commandRouter = CommandRouter(configData, self.instanceName)
+        # Command execution
+        self.commandTimeout = getNumber(configData, "commandTimeout", 300, positive=True)
+        self.outputHeadSize = getNumber(configData, "outputHeadSize", 4096, integer=True)
+        self.outputTailSize = getNumber(configData, "outputTailSize", 4096, integer=True)
+        self.outputMaxSize = getNumber(configData, "outputMaxSize", 50*1024*1024, integer=True)
+        cachedCommands = getValue(configData, "cachedCommands", {})
+        if not isinstance(cachedCommands, dict):
+            raise ValueError("cachedCommands should be an object of command: lifetime items")
+        for command in cachedCommands:
+            getNumber(cachedCommands, command, 0, positive=True)
+        self.resultCache = ResultCache(cachedCommands, getNumber(configData, "resultCacheSize", 1024*1024, integer=True))
+        self.maxWorkers = getNumber(configData, "maxWorkers", os.cpu_count() or 1, positive=True, integer=True)
+        self.maxCommandsPerSender = getNumber(configData, "maxCommandsPerSender", 1, positive=True, integer=True)
+        self.maxQueuedCommands = getNumber(configData, "maxQueuedCommands", 20, positive=True, integer=True)
+        self.warmShells = getNumber(configData, "warmShells", 0, integer=True)
+        self.warmShellMaxCommands = getNumber(configData, "warmShellMaxCommands", 100, positive=True, integer=True)
+        self.warmShellInitTimeout = getNumber(configData, "warmShellInitTimeout", 60, positive=True)
+        # Admission control
+        self.commandRate = getNumber(configData, "commandRate", 10)
+        self.commandBurst = getNumber(configData, "commandBurst", 5, positive=True)
+        self.commandRates = getValue(configData, "commandRates", {})
+        if not isinstance(self.commandRates, dict) or not all(isinstance(limits, dict) for limits in self.commandRates.values()):
+            raise ValueError('commandRates should be an object of number: {"rate": x, "burst": y} items')
+        for limits in self.commandRates.values():
+            getNumber(limits, "rate", 0)
+            getNumber(limits, "burst", 1, positive=True)
+        self.maxLoadPerCpu = getNumber(configData, "maxLoadPerCpu", 4)
+        self.minFreeMemory = getNumber(configData, "minFreeMemory", 32)
+        self.rejectReplyInterval = getNumber(configData, "rejectReplyInterval", 60)
+        # SMS answers
+        self.smsMaxParts = getNumber(configData, "smsMaxParts", 1, positive=True, integer=True)
+        self.smsTransliterate = getValue(configData, "smsTransliterate", True)
+        self.smsRate = getNumber(configData, "smsRate", 20)
+        self.smsBurst = getNumber(configData, "smsBurst", 5, positive=True, integer=True)
+        self.smsServerDebugUrl = getValue(configData, "smsServerDebugUrl", "")
+        self.smsServerMaxPending = getNumber(configData, "smsServerMaxPending", 2, positive=True, integer=True)
+        # SMS servers (default to main topics)
+        self.gateways = {}
+        for name, gatewayData in (getValue(configData, "gateways", {}) or {"default": {"mqttBatchTopic": getValue(configData, "mqttBatchTopic")}}).items():
+            self.gateways[name] = {
+                "sendTopic": getValue(gatewayData, "mqttSendTopic", self.mqttSendTopic),
+                "receiveTopic": getValue(gatewayData, "mqttReceiveTopic", self.mqttReceiveTopic),
+                "lwtTopic": getValue(gatewayData, "mqttLwtTopic", configData["mqttLwtTopic"]),
+                "debugUrl": getValue(gatewayData, "smsServerDebugUrl", self.smsServerDebugUrl),
+                "batchTopic": getValue(gatewayData, "mqttBatchTopic")}
+        # Metrics
+        self.statsInterval = getNumber(configData, "statsInterval", 0)
+
+    # Return settings requiring a reconnection to MQTT broker when changed
+    def brokerSettings(self):
+        return (self.mqttBroker, self.mqttPort, self.mqttUser, self.mqttPassword, self.mqttReceiveTopic, self.mqttLwtTopic, self.mqttControlTopic,
+            sorted((gateway["receiveTopic"], gateway["lwtTopic"]) for gateway in self.gateways.values()))
+
+# Apply a new configuration (called by configuration watcher thread)
+def reloadConfig(configData):
+    global settings
+    # Invalid data raises an exception here, before anything is changed
+    newSettings = Settings(configData)
+    oldSettings = settings
+    for key in STARTUP_ONLY_ITEMS:
+        if getValue(configData, key, None) != getValue(startupConfigData, key, None):
+            logger.warning("%s change will only be applied at next restart", key)
+    try:
+        applySettings(newSettings)
+    except Exception as e:
+        # Don't let some components run with new settings and others with old ones
+        logger.error("Error %s applying new configuration, restoring previous one", e)
+        applySettings(oldSettings)
+        raise
+    # Keep cached results if cache settings didn't change
+    if newSettings.resultCache.ttls == oldSettings.resultCache.ttls and newSettings.resultCache.maxBytes == oldSettings.resultCache.maxBytes:
+        newSettings.resultCache = oldSettings.resultCache
+    settings = newSettings
+    logger.info("Configuration reloaded, serving %s", ", ".join(settings.commandRouter.instanceNames()))
+    if newSettings.brokerSettings() != oldSettings.brokerSettings():
+        # Disconnect, main loop will reconnect with new settings
+        logger.info("MQTT settings changed, reconnecting")
+        mqttTransport.disconnect()
+
+# Give settings to components using them (called at reload)
+def applySettings(newSettings):
+    mailQueue.configure(newSettings.mailServer, newSettings.mailSender, newSettings.mailDigestWindow, newSettings.mailTimeout)
+    commandPool.configure(newSettings.maxWorkers, newSettings.maxCommandsPerSender, newSettings.maxQueuedCommands)
+    admissionController.configure(newSettings.commandRate, newSettings.commandBurst, newSettings.commandRates, newSettings.maxLoadPerCpu,
+        newSettings.minFreeMemory, newSettings.rejectReplyInterval)
+    configureShellPools(newSettings)
+    gatewayRouter.configure(newSettings.gateways)
+    for gateway in gatewayRouter.gateways():
+        gateway.scheduler.configure(newSettings.smsRate, newSettings.smsBurst, gateway.debugUrl, newSettings.smsServerMaxPending)
+
+# Return MQTT connection parameters from current settings (called by transport before each connection)
+def mqttParameters():
+    currentSettings = settings
+    return (currentSettings.mqttBroker, currentSettings.mqttPort, currentSettings.mqttUser, currentSettings.mqttPassword,
+        currentSettings.mqttLwtTopic, '{"state":"down"}')
+
+# Return elapsed time between two monotonic times, in milliseconds
+def elapsedMs(startTime, endTime):
+    return round((endTime - startTime) * 1000, 3)
 
 # Returns a dictionary value giving a key or default value if not existing
 def getValue(dict, key, default=''):
@@ -165,74 +530,117 @@ hostName = socket.gethostname()
 # Get this file name (w/o path & extension)
 cdeFile = pathlib.Path(__file__).stem
 
-# Log settings
-log_format = "%(asctime)s:%(levelname)s:%(message)s"
-logger = logging.getLogger(cdeFile)
-logger.setLevel(logging.INFO)
-logHandler = handlers.TimedRotatingFileHandler(os.path.join(currentPath, cdeFile +'_'+hostName+'.log'), when='W0', interval=1)
-logHandler.suffix = "%Y%m%d"
-logHandler.setLevel(logging.INFO)
-formatter = logging.Formatter(log_format)
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
-logger.info('----- Starting on '+hostName+', version '+fileVersion+' -----')
-
 # Read JSON configuration file
 jsonFile = "smsServerParameters.json"
+configData = {}
+configError = None
 try:
-    with open(jsonFile, "r") as jsonStream:
-        jsonBuffer = jsonStream.read()
-    # Convert jsonBuffer to dictionary
-    try:
-        configData = json.loads(jsonBuffer)
-    except Exception as e:
-        logger.error(F"Error {str(e)} decoding {jsonBuffer}")
-        exit(2)
+    configData = readConfig(jsonFile)
+except ValueError as e:
+    configError = str(e)
+startupConfigData = configData                                      # To find changes of items only read at startup
+
+# Log settings (records are written by a background thread, as text or JSON lines)
+logger, _ = setupLogging(cdeFile, os.path.join(currentPath, cdeFile +'_'+hostName+'.log'), getValue(configData, "logFormat", "text") == "json")
+logger.info("----- Starting on %s, version %s -----", hostName, fileVersion)
+if configError != None:
+    logger.error(configError)
+    exit(2)
+
+# Settings derived from configuration file
+try:
+    settings = Settings(configData)
 except Exception as e:
-    logger.error(F"Error {str(e)} opening {jsonFile}")
+    logger.error("Error %s loading %s", e, jsonFile)
     exit(2)
+logger.info("Serving %s", ", ".join(settings.commandRouter.instanceNames()))
+
+# Metrics (served on HTTP if a port is given)
+metrics = Metrics("smshandler")
+for counterName in ("messages_received", "messages_invalid", "messages_duplicate", "messages_ignored", "messages_unauthorized",
+        "commands_rejected", "commands_executed", "commands_cached", "commands_failed", "commands_timed_out", "sms_sent"):
+    metrics.increment(counterName, 0)
+metricsPort = getValue(configData, "metricsPort", 0)
+if metricsPort:
+    try:
+        startMetricsServer(metrics, getValue(configData, "metricsAddress", "127.0.0.1"), metricsPort, logger)
+    except OSError as e:
+        logger.error("Error %s starting metrics server on port %s", e, metricsPort)
+
+# Journal of accepted commands
+journal = None
+journalMode = getValue(configData, "journalMode", "atMostOnce")
+interruptedRecords = []
+if getValue(configData, "journalFile") != "":
+    journal = Journal(getValue(configData, "journalFile"), logger, getValue(configData, "journalSyncDelay", 0.01),
+        getValue(configData, "journalCompactSize", 1024*1024))
+    interruptedRecords = journal.recover()
+    if interruptedRecords:
+        logger.info("%d command(s) interrupted by last stop found in journal", len(interruptedRecords))
+
+# History of SMS traffic
+history = None
+if getValue(configData, "historyFile") != "":
+    history = HistoryStore(getValue(configData, "historyFile"), logger, getValue(configData, "historyRetentionDays", 90),
+        getValue(configData, "historyBatchDelay", 0.5), metrics=metrics)
+    try:
+        history.start()
+    except sqlite3.Error as e:
+        logger.error("Error %s opening %s, history disabled", e, getValue(configData, "historyFile"))
+        history = None
+
+# Profiler, driven by control commands
+profiler = Profiler(logger, os.path.join(currentPath, cdeFile+'_'+hostName), publishControlResult)
+
+# Mail queue
+mailQueue = MailQueue(settings.mailServer, settings.mailSender, logger, settings.mailDigestWindow, timeout=settings.mailTimeout)
+
+# Batched SMS publisher (used by SMS servers having a batch topic)
+batchPublisher = BatchPublisher(lambda topic, payload: mqttTransport.publish(topic, payload), logger, getValue(configData, "smsBatchMaxBytes", 4096),
+    getValue(configData, "smsBatchMaxCount", 100), getValue(configData, "smsBatchDelay", 0.05))
+
+# SMS servers, each with its outbound SMS scheduler
+gatewayRouter = GatewayRouter(createScheduler, logger, getValue(configData, "gatewayLoadFactor", 1.1))
+gatewayRouter.configure(settings.gateways)
 
-# MQTT Settings
-if "instanceName" in configData:
-    instanceName = configData["instanceName"]
-else:
-    instanceName = hostName
-MQTT_BROKER = configData["mqttServer"]
-MQTT_PORT = configData["mqttPort"]
-MQTT_RECEIVE_TOPIC = configData["mqttReceiveTopic"]
-MQTT_SEND_TOPIC = configData["mqttSendTopic"]
-MQTT_LWT_TOPIC = configData["mqttLwtTopic"]+"/"+instanceName
-MQTT_ID = configData["mqttUser"]
-MQTT_KEY = configData["mqttPassword"]
-
-# Mail settings
-mailSender = configData["mailSender"]
-mailServer = configData["mailServer"]
-
-# Shell options
-shellName = getValue(configData, "shellName", "")
-shellInitCommand = getValue(configData, "shellInitCommand", "")
-shellErrorRemove = getValue(configData, "shellErrorRemove", "")
-
-# Use this python file name and random number as client name
+# Duplicate messages filter
+duplicateFilter = DuplicateFilter(getValue(configData, "duplicateCacheSize", 10000), getValue(configData, "duplicateTtl", 86400),
+    getValue(configData, "duplicateCacheFile", ""), logger)
+
+# Command execution pool
+commandPool = CommandPool(settings.maxWorkers, settings.maxCommandsPerSender, settings.maxQueuedCommands, logger)
+
+# Admission control of commands (sender rate, host load and memory)
+admissionController = AdmissionController(settings.commandRate, settings.commandBurst, settings.commandRates, settings.maxLoadPerCpu,
+    settings.minFreeMemory, settings.rejectReplyInterval, metrics)
+
+# Warm shells (when enabled)
+shellPools = {}                                                     # (shell name, init command) -> shell pool
+shellPoolsLock = threading.Lock()
+configureShellPools(settings)
+
+metrics.setGauge("commands_in_flight", 0)
+metrics.setGauge("commands_pending", commandPool.pending)
+metrics.setGauge("commands_capacity", lambda: admissionController.state(settings.maxQueuedCommands)["capacity"])
+metrics.setGauge("sms_waiting", gatewayRouter.pending)
+metrics.setGauge("shell_sessions_ready", readyShells)
+metrics.setGauge("gateways_up", lambda: sum(1 for gateway in gatewayRouter.gateways() if gateway.up != False))
+threading.Thread(target=publishStats, name="stats", daemon=True).start()
+
+# Use this python file name and random number as client name (or a stable name with reliable transport, to find our session again)
+mqttReliable = getValue(configData, "mqttReliable", False)
 random.seed()
-mqttClientName = pathlib.Path(__file__).stem+'_{:x}'.format(random.randrange(65535))
+mqttClientName = getValue(configData, "mqttClientId", cdeFile+'_'+settings.instanceName if mqttReliable else cdeFile+'_{:x}'.format(random.randrange(65535)))
 
-# Initialize MQTT client
-# Try to find CallbackAPIVersion (exists starting on version 2)
-try:
-    from paho.mqtt.enums import CallbackAPIVersion
-    mqttClient = mqtt.Client(client_id=mqttClientName, callback_api_version=CallbackAPIVersion.VERSION2)
-except AttributeError:
-    mqttClient = mqtt.Client(client_id=mqttClientName)
-except ModuleNotFoundError:
-    mqttClient = mqtt.Client(client_id=mqttClientName)
-mqttClient.on_message = onMessage
-mqttClient.on_connect = onConnect
-mqttClient.username_pw_set(MQTT_ID, MQTT_KEY)
-# Set Last Will Testament (QOS=0, retain=True)
-mqttClient.will_set(MQTT_LWT_TOPIC, '{"state":"down"}', 0, True)
-# Connect to MQTT
-mqttClient.connect(MQTT_BROKER, MQTT_PORT)
-# Never give up!
-mqttClient.loop_forever()
+# Initialize MQTT transport (reliable settings are only read at startup)
+mqttTransport = MqttTransport(mqttClientName, logger, mqttReliable, getValue(configData, "mqttMaxInflight", 20), getValue(configData, "mqttMaxQueued", 1000),
+    getValue(configData, "mqttReconnectMinDelay", 1), getValue(configData, "mqttReconnectMaxDelay", 60), metrics)
+mqttTransport.onMessage = onMessage
+mqttTransport.onConnect = onConnect
+mqttClient = mqttTransport.client
+
+# Watch configuration file, to apply changes without restarting
+configWatcher = ConfigWatcher(jsonFile, reloadConfig, logger, getValue(configData, "configCheckInterval", 5))
+
+# Connect to MQTT, and never give up! (reconnecting with new settings after a broker settings change)
+mqttTransport.run(mqttParameters)
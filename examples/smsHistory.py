@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+History of SMS traffic (received and sent SMS, executed or rejected commands) kept in a local
+    SQLite database, used by smsHandler.py and readSms.py, to find what a number sent and what
+    was executed without reading rotated log files.
+
+Records are queued by callers and written by a background thread, all records queued in a
+    short delay sharing the same transaction (database being in WAL mode, so that queries don't
+    block writer). Records older than retention delay are deleted once an hour. If writer can't
+    follow, records are dropped (and counted) instead of slowing down callers.
+
+Can be used alone to query history:
+    smsHistory.py smsHandler_history.db [--number +33612345678] [--since 7d] [--until "2026-10-01 12:00"] [--instance vm] [--kind command] [--json]
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import argparse
+import json
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# Record kinds
+KIND_RECEIVED = "received"                                          # SMS received
+KIND_SENT = "sent"                                                  # SMS sent
+KIND_COMMAND = "command"                                            # Command executed (or rejected)
+
+# Columns of a record, after time and kind
+COLUMNS = ("instance", "number", "message", "state", "returnCode", "duration", "smsDate", "gateway")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    kind TEXT NOT NULL,
+    instance TEXT,
+    number TEXT,
+    message TEXT,
+    state TEXT,
+    returnCode INTEGER,
+    duration REAL,
+    smsDate TEXT,
+    gateway TEXT
+);
+CREATE INDEX IF NOT EXISTS historyTime ON history (time);
+CREATE INDEX IF NOT EXISTS historyNumber ON history (number, time);
+CREATE INDEX IF NOT EXISTS historyInstance ON history (instance, time);
+"""
+
+# Delay between two deletions of old records (in seconds)
+PRUNE_INTERVAL = 3600
+# Records deleted per transaction, so that writer is never blocked for long
+PRUNE_CHUNK = 10000
+
+class HistoryStore:
+    # Create a store (call start before using it)
+    #   retentionDays: days records are kept (0 to keep them forever)
+    #   batchDelay: time to wait for other records before writing a batch (in seconds)
+    #   maxQueued: records waiting to be written above which new ones are dropped
+    #   metrics: optional metrics registry
+    def __init__(self, fileName, logger, retentionDays=90, batchDelay=0.5, maxQueued=10000, metrics=None):
+        self.fileName = fileName
+        self.logger = logger
+        self.retentionDays = retentionDays
+        self.batchDelay = batchDelay
+        self.maxQueued = maxQueued
+        self.metrics = metrics
+        self.condition = threading.Condition()
+        self.queue = []                                             # Rows waiting to be written
+        self.droppedCount = 0
+        self.closing = False
+        self.connection = None
+        self.thread = None
+        self.lastPruneTime = 0
+
+    # Open database (creating it if needed) and start writer (raises sqlite3.Error if database can't be used)
+    def start(self):
+        self.connection = sqlite3.connect(self.fileName, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+        if self.metrics != None:
+            for name in ("history_records_written", "history_records_dropped", "history_records_pruned"):
+                self.metrics.increment(name, 0)
+        self.thread = threading.Thread(target=self._run, name="history", daemon=True)
+        self.thread.start()
+
+    # Record a received SMS
+    #   instance: instance SMS was routed to (None if not routed)
+    #   state: routing result (like "ok", "ignored" or "unauthorized")
+    #   smsDate: date given by SMS server
+    def received(self, number, message, instance=None, state=None, smsDate=None):
+        self.add(KIND_RECEIVED, number=number, message=message, instance=instance, state=state, smsDate=smsDate)
+
+    # Record a sent SMS
+    def sent(self, number, message, instance=None, gateway=None):
+        self.add(KIND_SENT, number=number, message=message, instance=instance, gateway=gateway)
+
+    # Record outcome of a command
+    #   state: "done", "timedOut", "failed" or "rejected" (with reason)
+    #   duration: command duration (in milliseconds)
+    def command(self, number, instance, command, state, returnCode=None, duration=None):
+        self.add(KIND_COMMAND, number=number, message=command, instance=instance, state=state, returnCode=returnCode, duration=duration)
+
+    # Queue a record (written in background)
+    def add(self, kind, **fields):
+        row = (time.time(), kind) + tuple(fields.get(column) for column in COLUMNS)
+        with self.condition:
+            if self.closing or len(self.queue) >= self.maxQueued:
+                self.droppedCount += 1
+                dropped = True
+            else:
+                self.queue.append(row)
+                self.condition.notify()
+                dropped = False
+        if dropped and self.metrics != None:
+            self.metrics.increment("history_records_dropped")
+
+    # Write queued records and stop writer
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        if self.thread != None:
+            self.thread.join()
+        if self.connection != None:
+            self.connection.close()
+            self.connection = None
+
+    # Writer thread
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closing:
+                    if not self.condition.wait(self._pruneDelay()):
+                        break
+                closing = self.closing
+                waiting = len(self.queue)
+            # Let other records join this batch
+            if waiting and self.batchDelay > 0 and not closing:
+                time.sleep(self.batchDelay)
+            with self.condition:
+                rows = self.queue
+                self.queue = []
+            if rows:
+                self._write(rows)
+            if closing:
+                break
+            if self._pruneDelay() == 0:
+                self._prune()
+
+    # Write a batch of records in one transaction
+    def _write(self, rows):
+        try:
+            with self.connection:
+                self.connection.executemany(F"INSERT INTO history (time, kind, {', '.join(COLUMNS)}) VALUES ({', '.join('?' * (len(COLUMNS) + 2))})", rows)
+        except sqlite3.Error as e:
+            self.logger.error("Error %s writing %d records to %s", e, len(rows), self.fileName)
+            if self.metrics != None:
+                self.metrics.increment("history_records_dropped", len(rows))
+            return
+        if self.metrics != None:
+            self.metrics.increment("history_records_written", len(rows))
+
+    # Return delay before next deletion of old records (None if records are kept forever)
+    def _pruneDelay(self):
+        if self.retentionDays <= 0:
+            return None
+        return max(0, self.lastPruneTime + PRUNE_INTERVAL - time.monotonic())
+
+    # Delete records older than retention delay, by chunks
+    def _prune(self):
+        self.lastPruneTime = time.monotonic()
+        limit = time.time() - self.retentionDays * 86400
+        pruned = 0
+        try:
+            while True:
+                with self.connection:
+                    deleted = self.connection.execute("DELETE FROM history WHERE id IN (SELECT id FROM history WHERE time < ? LIMIT ?)",
+                        (limit, PRUNE_CHUNK)).rowcount
+                pruned += deleted
+                if deleted < PRUNE_CHUNK:
+                    break
+        except sqlite3.Error as e:
+            self.logger.error("Error %s deleting old records from %s", e, self.fileName)
+        if pruned:
+            self.logger.info("%d records older than %d days deleted from %s", pruned, self.retentionDays, self.fileName)
+            if self.metrics != None:
+                self.metrics.increment("history_records_pruned", pruned)
+
+# Return records matching criteria, oldest first (read only, can be called while a store writes to database)
+#   since/until: time range (epoch seconds, None for no limit)
+#   limit: maximum records returned (last ones of range)
+def queryHistory(fileName, number=None, since=None, until=None, instance=None, kind=None, limit=100):
+    conditions = []
+    values = []
+    for column, value in (("number", number), ("instance", instance), ("kind", kind)):
+        if value != None:
+            conditions.append(F"{column} = ?")
+            values.append(value)
+    if since != None:
+        conditions.append("time >= ?")
+        values.append(since)
+    if until != None:
+        conditions.append("time < ?")
+        values.append(until)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    connection = sqlite3.connect(F"file:{fileName}?mode=ro", uri=True)
+    try:
+        connection.row_factory = sqlite3.Row
+        rows = connection.execute(F"SELECT * FROM history{where} ORDER BY time DESC LIMIT ?", values + [limit]).fetchall()
+    finally:
+        connection.close()
+    return [dict(row) for row in reversed(rows)]
+
+# Convert a time given on command line (ISO date, or delay before now like 30m, 12h or 7d) to epoch seconds
+def parseTime(text):
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)([smhdw])", text.strip())
+    if match:
+        return time.time() - float(match.group(1)) * {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}[match.group(2)]
+    try:
+        return datetime.fromisoformat(text.strip()).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(F"{text} is not a date (like 2026-10-01 or '2026-10-01 12:00') nor a delay (like 30m, 12h or 7d)")
+
+# Return a record as a text line
+def formatRecord(record):
+    items = [datetime.fromtimestamp(record["time"]).strftime("%Y-%m-%d %H:%M:%S"), record["kind"], record["instance"] or "-", record["number"] or "-"]
+    if record["state"] != None:
+        items.append(record["state"])
+    if record["returnCode"] != None:
+        items.append(F"rc={record['returnCode']}")
+    if record["duration"] != None:
+        items.append(F"{record['duration']:.0f}ms")
+    if record["gateway"] != None:
+        items.append(F"via {record['gateway']}")
+    return " ".join(items) + F": {record['message']}"
+
+#   *****************
+#   *** Main code ***
+#   *****************
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query SMS traffic history")
+    parser.add_argument("fileName", help="history database (historyFile of smsServerParameters.json)")
+    parser.add_argument("--number", help="phone number")
+    parser.add_argument("--since", type=parseTime, help="start of range (like 2026-10-01, '2026-10-01 12:00' or 7d)")
+    parser.add_argument("--until", type=parseTime, help="end of range (same format)")
+    parser.add_argument("--instance", help="instance name")
+    parser.add_argument("--kind", choices=(KIND_RECEIVED, KIND_SENT, KIND_COMMAND), help="record kind")
+    parser.add_argument("--limit", type=int, default=100, help="maximum records (last ones, default 100)")
+    parser.add_argument("--json", action="store_true", help="write records as JSON lines")
+    args = parser.parse_args()
+    try:
+        records = queryHistory(args.fileName, args.number, args.since, args.until, args.instance, args.kind, args.limit)
+    except sqlite3.Error as e:
+        parser.exit(1, F"Error {e} reading {args.fileName}\n")
+    for record in records:
+        print(json.dumps(record, ensure_ascii=False) if args.json else formatRecord(record))
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Write ahead journal of accepted SMS commands and their outcome, used by smsHandler.py
+    to know which commands were interrupted by a crash or a restart.
+
+Journal is an append only file of JSON lines. An "accepted" record is written before
+    command is executed, a "done" record after. Records are written by a background thread,
+    all records queued while previous ones were written sharing the same fsync (group commit).
+
+At startup, journal is read through mmap, and accepted commands without outcome are returned.
+    File is rewritten with these commands only when it grows larger than a given size,
+    so its size (and recovery time) stays bounded.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import json
+import mmap
+import os
+import threading
+import time
+import uuid
+
+# Interrupted commands handling
+AT_MOST_ONCE = "atMostOnce"                                         # Never executed again (sender is told)
+AT_LEAST_ONCE = "atLeastOnce"                                       # Executed again
+
+class Journal:
+    # Create a journal (call recover before using it)
+    #   syncDelay: time to wait for other records before writing a batch (in seconds)
+    #   compactSize: file size triggering rewrite with unfinished commands only (in bytes)
+    def __init__(self, fileName, logger, syncDelay=0.01, compactSize=1024*1024):
+        self.fileName = fileName
+        self.logger = logger
+        self.syncDelay = syncDelay
+        self.compactSize = compactSize
+        self.condition = threading.Condition()
+        self.unfinished = {}                                        # Id -> accepted record
+        self.sequences = {}                                         # Id -> sequence of accepted record
+        self.queue = []                                             # Lines waiting to be written
+        self.queuedSequence = 0
+        self.writtenSequence = 0
+        self.idPrefix = uuid.uuid4().hex[:8]
+        self.nextId = 0
+        self.fileStream = None
+        self.closing = False
+        self.thread = None
+
+    # Read journal, returning accepted records without outcome, then start writer
+    def recover(self):
+        self.unfinished = {}
+        try:
+            with open(self.fileName, "rb") as fileStream:
+                if os.fstat(fileStream.fileno()).st_size:
+                    with mmap.mmap(fileStream.fileno(), 0, access=mmap.ACCESS_READ) as fileMap:
+                        self._scan(fileMap)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            self.logger.error("Error %s reading %s", e, self.fileName)
+        # Start from a clean file (this also removes a partially written last record)
+        self._compact(list(self.unfinished.values()))
+        self.thread = threading.Thread(target=self._run, name="journal", daemon=True)
+        self.thread.start()
+        return list(self.unfinished.values())
+
+    # Record an accepted command, returns its id (record is written in background, see waitDurable)
+    def accept(self, record):
+        with self.condition:
+            self.nextId += 1
+            record = dict(record, id=F"{self.idPrefix}-{self.nextId}", state="accepted", time=time.time())
+            self.unfinished[record["id"]] = record
+            self.sequences[record["id"]] = self._queue(record)
+            return record["id"]
+
+    # Wait for an accepted record to be on disk, returns False on timeout
+    def waitDurable(self, entryId, timeout=None):
+        with self.condition:
+            sequence = self.sequences.get(entryId, 0)
+            return self.condition.wait_for(lambda: self.writtenSequence >= sequence, timeout)
+
+    # Record outcome of a command (state is "done", "rejected", "abandoned"...)
+    def done(self, entryId, state="done", **outcome):
+        with self.condition:
+            if self.unfinished.pop(entryId, None) == None:
+                return
+            self.sequences.pop(entryId, None)
+            self._queue(dict(outcome, id=entryId, state=state, time=time.time()))
+
+    # Write queued records and stop writer
+    def close(self):
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        if self.thread != None:
+            self.thread.join()
+
+    # Queue a record, returns its sequence (condition should be held)
+    def _queue(self, record):
+        self.queue.append(json.dumps(record) + "\n")
+        self.queuedSequence += 1
+        self.condition.notify_all()
+        return self.queuedSequence
+
+    # Read records from a mapped file
+    def _scan(self, fileMap):
+        position = 0
+        while position < len(fileMap):
+            end = fileMap.find(b"\n", position)
+            if end < 0:
+                # Last record was not fully written
+                break
+            line = fileMap[position:end]
+            position = end + 1
+            try:
+                record = json.loads(line)
+                entryId = record["id"]
+            except (ValueError, KeyError, TypeError):
+                self.logger.error("Ignoring bad record %s in %s", line, self.fileName)
+                continue
+            if record.get("state") == "accepted":
+                self.unfinished[entryId] = record
+            else:
+                self.unfinished.pop(entryId, None)
+
+    # Rewrite journal with given records only, and reopen it for append
+    def _compact(self, records):
+        if self.fileStream != None:
+            self.fileStream.close()
+            self.fileStream = None
+        try:
+            tempFile = self.fileName + ".tmp"
+            with open(tempFile, "w") as fileStream:
+                for record in records:
+                    fileStream.write(json.dumps(record) + "\n")
+                fileStream.flush()
+                os.fsync(fileStream.fileno())
+            os.replace(tempFile, self.fileName)
+            self._syncDirectory()
+        except OSError as e:
+            self.logger.error("Error %s compacting %s", e, self.fileName)
+        try:
+            self.fileStream = open(self.fileName, "a")
+        except OSError as e:
+            self.logger.error("Error %s opening %s", e, self.fileName)
+
+    # Make file rename durable
+    def _syncDirectory(self):
+        try:
+            directory = os.open(os.path.dirname(os.path.abspath(self.fileName)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(directory)
+        except OSError:
+            pass
+        finally:
+            os.close(directory)
+
+    # Writer thread
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closing:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+            # Let other records join this batch
+            if self.syncDelay > 0 and not self.closing:
+                time.sleep(self.syncDelay)
+            with self.condition:
+                lines = self.queue
+                self.queue = []
+                sequence = self.queuedSequence
+            try:
+                self.fileStream.write("".join(lines))
+                self.fileStream.flush()
+                os.fsync(self.fileStream.fileno())
+            except (OSError, AttributeError) as e:
+                self.logger.error("Error %s writing %s", e, self.fileName)
+            with self.condition:
+                self.writtenSequence = sequence
+                self.condition.notify_all()
+                records = list(self.unfinished.values())
+            # Compact journal when too large
+            try:
+                fileSize = self.fileStream.tell()
+            except (OSError, AttributeError, ValueError):
+                fileSize = 0
+            if fileSize > self.compactSize:
+                self._compact(records)
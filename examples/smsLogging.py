@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Queue based logging used by smsHandler.py and readSms.py.
+
+Callers only put log records in a queue. A listener thread owns the (weekly rotated) file handler,
+    and is the only one to format and write records, so a slow disk never blocks MQTT callbacks.
+
+Records can be written as text or as JSON lines. In JSON, "number", "instance", "command",
+    "returnCode" and "timings" items given as extra are written as separate fields.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import atexit
+import json
+import logging
+import logging.handlers as handlers
+import queue
+
+# Extra record items written as JSON fields
+jsonFields = ("number", "instance", "command", "returnCode", "timings")
+
+# Queue handler which doesn't format records, leaving this to listener thread
+class LazyQueueHandler(handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Format records as JSON lines
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {"time": self.formatTime(record), "level": record.levelname, "message": record.getMessage()}
+        for field in jsonFields:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+# Create a logger writing to a weekly rotated file through a queue
+#   Returns logger and queue listener (stopped at exit)
+def setupLogging(name, fileName, jsonFormat=False, level=logging.INFO):
+    logHandler = handlers.TimedRotatingFileHandler(fileName, when='W0', interval=1)
+    logHandler.suffix = "%Y%m%d"
+    logHandler.setLevel(level)
+    if jsonFormat:
+        logHandler.setFormatter(JsonFormatter())
+    else:
+        logHandler.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(message)s"))
+    logQueue = queue.SimpleQueue()
+    listener = handlers.QueueListener(logQueue, logHandler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.addHandler(LazyQueueHandler(logQueue))
+    return logger, listener
@@ -0,0 +1,270 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Background mail delivery queue used by smsHandler.py and smsServerTest.py.
+
+Mails are sent by a dedicated thread, reusing one SMTP session (reconnected when dropped by server).
+
+Failed sends are retried with exponential backoff.
+
+Mails to the same receiver can be merged into one digest mail when sent within a given window.
+
+Messages are written to a spooled temporary file and streamed to server, attachments being
+    encoded chunk by chunk, so large attachments are never loaded in memory.
+
+Mail server can be given as "host" or "host:port", which allows testing against a local SMTP stand-in.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import binascii
+import glob
+import heapq
+import itertools
+import os
+import pathlib
+import queue
+import smtplib
+import tempfile
+import threading
+import time
+import uuid
+from email import header
+from email import policy
+from email import utils
+from email.mime.text import MIMEText
+
+class MailQueue:
+    # Create a mail queue
+    #   mailServer: name or IP of mail server (optionally followed by ":port")
+    #   mailSender: mail address of sender (and default receiver)
+    #   logger: logger to use
+    #   digestWindow: mails to same receiver sent within this delay (seconds) are merged (0 to disable)
+    #   maxRetries: number of retries before giving up a mail
+    #   retryDelay: delay before first retry (doubled at each retry)
+    #   idleTimeout: close SMTP session after this idle time (seconds)
+    #   timeout: maximum time to wait for mail server when connecting or sending (seconds)
+    def __init__(self, mailServer, mailSender, logger, digestWindow=0, maxRetries=5, retryDelay=5, idleTimeout=60, timeout=30):
+        self.mailServer = mailServer
+        self.mailSender = mailSender
+        self.logger = logger
+        self.digestWindow = digestWindow
+        self.maxRetries = maxRetries
+        self.retryDelay = retryDelay
+        self.idleTimeout = idleTimeout
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.digests = {}                                           # Mails waiting for digest, by receiver
+        self.retries = []                                           # Heap of (due time, sequence, mail, retry count)
+        self.sequence = itertools.count()
+        self.server = None
+        self.lastUsed = 0
+        self.sentCount = 0
+        self.failedCount = 0
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="mailQueue", daemon=True)
+        self.thread.start()
+
+    # Queue a mail
+    #   fileToAttach: optional glob pattern of files to attach
+    #   temporaryFiles: optional list of files to remove once mail is sent (or given up)
+    def send(self, subject, body, to="", fileToAttach=None, temporaryFiles=None):
+        self.queue.put({"subject": subject, "body": body, "to": to if to else self.mailSender, "fileToAttach": fileToAttach,
+            "temporaryFiles": temporaryFiles if temporaryFiles != None else []})
+
+    # Change mail server, sender, digest window and timeout (applied by mail thread, before next mail)
+    def configure(self, mailServer, mailSender, digestWindow=0, timeout=30):
+        self.queue.put({"configure": (mailServer, mailSender, digestWindow, timeout)})
+
+    # Send all pending mails (including digests and retries) and stop thread
+    def close(self, timeout=None):
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    # Mail thread
+    def _run(self):
+        while True:
+            try:
+                mail = self.queue.get(timeout=self._nextWakeUp())
+            except queue.Empty:
+                mail = False
+            if mail is None:
+                # Stop requested: don't wait for digest windows anymore
+                self.stopping = True
+            elif mail and "configure" in mail:
+                if (self.mailServer, self.mailSender, self.timeout) != (mail["configure"][0], mail["configure"][1], mail["configure"][3]):
+                    self._disconnect()
+                self.mailServer, self.mailSender, self.digestWindow, self.timeout = mail["configure"]
+            elif mail:
+                if self.digestWindow > 0:
+                    self.digests.setdefault(mail["to"], {"due": time.monotonic() + self.digestWindow, "mails": []})["mails"].append(mail)
+                else:
+                    self._deliver(mail, 0)
+            now = time.monotonic()
+            # Send digests whose window is over
+            for receiver in [receiver for receiver, digest in self.digests.items() if digest["due"] <= now or self.stopping]:
+                self._sendDigest(receiver)
+            # Retry mails whose delay is over
+            while self.retries and self.retries[0][0] <= now:
+                _, _, mail, retryCount = heapq.heappop(self.retries)
+                self._deliver(mail, retryCount)
+            if self.stopping and not self.retries and self.queue.empty():
+                self._disconnect()
+                return
+            # Close idle session
+            if self.server != None and now - self.lastUsed > self.idleTimeout:
+                self._disconnect()
+
+    # Return delay before next thing to do
+    def _nextWakeUp(self):
+        dueTimes = [digest["due"] for digest in self.digests.values()]
+        if self.retries:
+            dueTimes.append(self.retries[0][0])
+        if self.server != None:
+            dueTimes.append(self.lastUsed + self.idleTimeout)
+        if not dueTimes:
+            return None
+        return max(0, min(dueTimes) - time.monotonic())
+
+    # Merge all mails waiting for a receiver into one
+    def _sendDigest(self, receiver):
+        mails = self.digests.pop(receiver)["mails"]
+        if len(mails) == 1:
+            self._deliver(mails[0], 0)
+            return
+        body = ""
+        attachments = []
+        temporaryFiles = []
+        for mail in mails:
+            body += F"===== {mail['subject']} =====\n{mail['body']}\n\n"
+            if mail["fileToAttach"] != None:
+                attachments += mail["fileToAttach"] if isinstance(mail["fileToAttach"], list) else [mail["fileToAttach"]]
+            temporaryFiles += mail["temporaryFiles"]
+        subject = F"{len(mails)} results: " + ", ".join(mail["subject"] for mail in mails)
+        self._deliver({"subject": subject, "body": body.rstrip(), "to": receiver, "fileToAttach": attachments if attachments else None,
+            "temporaryFiles": temporaryFiles}, 0)
+
+    # Send a mail, scheduling a retry if it fails
+    def _deliver(self, mail, retryCount):
+        try:
+            with tempfile.SpooledTemporaryFile(max_size=1024*1024) as spool:
+                writeMessage(spool, mail["subject"], mail["body"], self.mailSender, mail["to"], mail["fileToAttach"], self.logger)
+                reused = self.server != None
+                try:
+                    sendStream(self._connection(), self.mailSender, mail["to"], spool)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    # Server dropped idle session, reconnect once (a new session failing is retried later)
+                    if not reused:
+                        raise
+                    self._disconnect(False)
+                    sendStream(self._connection(), self.mailSender, mail["to"], spool)
+            self.lastUsed = time.monotonic()
+            self.sentCount += 1
+        except Exception as e:
+            # Including socket.timeout of a stalled mail server: drop session (without waiting for QUIT answer) and retry later
+            self._disconnect(False)
+            if retryCount < self.maxRetries:
+                delay = self.retryDelay * (2 ** retryCount)
+                self.logger.error("Error %s sending mail '%s' to %s, retrying in %s seconds", e, mail["subject"], mail["to"], delay)
+                heapq.heappush(self.retries, (time.monotonic() + delay, next(self.sequence), mail, retryCount + 1))
+                return
+            self.logger.error("Error %s sending mail '%s' to %s, giving up", e, mail["subject"], mail["to"])
+            self.failedCount += 1
+        # Mail sent or given up, remove its temporary files
+        for file in mail["temporaryFiles"]:
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+
+    # Return a connected SMTP session
+    def _connection(self):
+        if self.server == None:
+            self.server = smtplib.SMTP(self.mailServer, timeout=self.timeout)
+            self.lastUsed = time.monotonic()
+        return self.server
+
+    # Close SMTP session, ignoring errors
+    #   graceful: send QUIT before closing (not done after an error, as server may not answer)
+    def _disconnect(self, graceful=True):
+        if self.server != None:
+            try:
+                if graceful:
+                    self.server.quit()
+                else:
+                    self.server.close()
+            except Exception:
+                self.server.close()
+            self.server = None
+
+# Write a mail message to a stream, encoding attachments chunk by chunk
+#   fileToAttach: glob pattern (or list of glob patterns) of files to attach
+def writeMessage(stream, subject, body, sender, to, fileToAttach=None, logger=None):
+    headers = F"Subject: {header.Header(subject, 'UTF-8').encode()}\r\nDate: {utils.formatdate(localtime=True)}\r\nFrom: {sender}\r\nTo: {to if to else sender}\r\nMIME-Version: 1.0\r\n"
+    bodyPart = MIMEText(body, "plain", "UTF-8")
+    del bodyPart["MIME-Version"]
+    bodyPart = bodyPart.as_bytes(policy=policy.SMTP)
+    files = []
+    if fileToAttach != None:
+        for pattern in fileToAttach if isinstance(fileToAttach, list) else [fileToAttach]:
+            files += glob.glob(pattern)
+        if not files and logger != None:
+            logger.error("Can't find %s - File not attached!", fileToAttach)
+    if not files:
+        stream.write(headers.encode())
+        stream.write(bodyPart)
+    else:
+        boundary = "===============" + uuid.uuid4().hex
+        stream.write((headers + F"Content-Type: multipart/mixed; boundary=\"{boundary}\"\r\n\r\n").encode())
+        stream.write(F"--{boundary}\r\n".encode())
+        stream.write(bodyPart)
+        for file in files:
+            # Add file as application/octet-stream, base64 encoded
+            stream.write(F"\r\n--{boundary}\r\nContent-Type: application/octet-stream\r\nContent-Transfer-Encoding: base64\r\n"
+                F"Content-Disposition: attachment; filename=\"{pathlib.Path(file).name}\"\r\n\r\n".encode())
+            with open(file, "rb") as fileStream:
+                while True:
+                    # Read a multiple of 57 bytes, to get full 76 characters base64 lines
+                    chunk = fileStream.read(57 * 1024)
+                    if not chunk:
+                        break
+                    for i in range(0, len(chunk), 57):
+                        stream.write(binascii.b2a_base64(chunk[i:i+57], newline=False) + b"\r\n")
+        stream.write(F"\r\n--{boundary}--\r\n".encode())
+
+# Send a message written in a stream through an SMTP session, without loading it in memory
+def sendStream(server, sender, to, stream):
+    server.ehlo_or_helo_if_needed()
+    code, response = server.mail(sender)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+    code, response = server.rcpt(to)
+    if code not in (250, 251):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused({to: (code, response)})
+    server.putcmd("data")
+    code, response = server.getreply()
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, response)
+    stream.seek(0)
+    buffer = bytearray()
+    for line in stream:
+        line = line.rstrip(b"\r\n")
+        # Escape lines starting with a dot
+        if line.startswith(b"."):
+            buffer += b"."
+        buffer += line + b"\r\n"
+        if len(buffer) >= 65536:
+            server.send(bytes(buffer))
+            buffer.clear()
+    buffer += b".\r\n"
+    server.send(bytes(buffer))
+    code, response = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
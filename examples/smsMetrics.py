@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Counters, gauges and latency histograms used by smsHandler.py.
+
+Metrics can be read:
+    - in Prometheus text format, on a local HTTP port (/metrics),
+    - as a JSON dictionary, to be published periodically on MQTT.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import http.server
+import json
+import threading
+import time
+
+# Histogram buckets (upper bounds, in milliseconds)
+DEFAULT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 300000)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)                      # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    # Add a value
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # Return an approximated percentile (upper bound of bucket containing it)
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        target = percent / 100 * self.count
+        cumulated = 0
+        for index, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated >= target:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+class Metrics:
+    # Create a metrics registry
+    #   prefix: prefix of Prometheus metric names
+    def __init__(self, prefix, buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}                                          # Name -> value
+        self.gauges = {}                                            # Name -> value or function returning value
+        self.histograms = {}                                        # Stage -> histogram
+        self.startTime = time.time()
+
+    # Increment a counter
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Set a gauge to a value (or to a function called when metrics are read)
+    def setGauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    # Add a value to a gauge
+    def addGauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + value
+
+    # Add a stage duration (in milliseconds)
+    def observe(self, stage, value):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram == None:
+                histogram = Histogram(self.buckets)
+                self.histograms[stage] = histogram
+            histogram.observe(value)
+
+    # Add all stage durations of a timings dictionary
+    def observeTimings(self, timings):
+        for stage, value in timings.items():
+            self.observe(stage, value)
+
+    # Return gauge values (lock should be held)
+    def _gaugeValues(self):
+        values = {}
+        for name, value in self.gauges.items():
+            try:
+                values[name] = value() if callable(value) else value
+            except Exception:
+                pass
+        return values
+
+    # Return metrics as a dictionary
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime": round(time.time() - self.startTime),
+                "counters": dict(self.counters),
+                "gauges": self._gaugeValues(),
+                "stages": {stage: {"count": histogram.count, "meanMs": round(histogram.sum / histogram.count, 3) if histogram.count else None,
+                    "p50Ms": histogram.percentile(50), "p95Ms": histogram.percentile(95), "p99Ms": histogram.percentile(99),
+                    "maxMs": round(histogram.max, 3)} for stage, histogram in self.histograms.items()},
+            }
+
+    # Return metrics in Prometheus text format
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(F"# TYPE {self.prefix}_{name}_total counter")
+                lines.append(F"{self.prefix}_{name}_total {value}")
+            for name, value in sorted(self._gaugeValues().items()):
+                lines.append(F"# TYPE {self.prefix}_{name} gauge")
+                lines.append(F"{self.prefix}_{name} {value}")
+            histogramName = F"{self.prefix}_stage_duration_milliseconds"
+            if self.histograms:
+                lines.append(F"# TYPE {histogramName} histogram")
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulated = 0
+                for index, count in enumerate(histogram.counts):
+                    cumulated += count
+                    bound = histogram.buckets[index] if index < len(histogram.buckets) else "+Inf"
+                    lines.append(F'{histogramName}_bucket{{stage="{stage}",le="{bound}"}} {cumulated}')
+                lines.append(F'{histogramName}_sum{{stage="{stage}"}} {round(histogram.sum, 3)}')
+                lines.append(F'{histogramName}_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+# Serve metrics on /metrics (Prometheus text format) and /stats (JSON)
+#   Returns HTTP server (running in a background thread)
+def startMetricsServer(metrics, address, port, logger):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                content = metrics.render().encode("UTF-8")
+                contentType = "text/plain; version=0.0.4"
+            elif self.path == "/stats":
+                content = json.dumps(metrics.snapshot()).encode("UTF-8")
+                contentType = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metricsServer", daemon=True).start()
+    logger.info("Metrics available on http://%s:%s/metrics", address, port)
+    return server
@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+SMS server health monitor, used by smsServerTest.py --monitor.
+
+A probe SMS is sent to SMS server own number at a given interval, through an MQTT connection kept
+    open, and waited back. Success rate and round trip latency of last probes are kept.
+
+After a given count of consecutive failures, SMS server is restarted (if a restart URL is given).
+    Restarts are separated by a cooldown, doubled after each restart (up to a maximum), and reset
+    when SMS server answers again, so a broken SMS server is not restarted in a loop.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import collections
+import json
+import threading
+import time
+import uuid
+from smsBenchmark import percentile
+
+# Restart SMS server through its restart URL, returns True if request succeeded
+def restartGateway(url, logger):
+    # Imported here, as only needed when SMS server is not answering
+    from smsGatewayClient import getClient
+    try:
+        text = getClient(url, readTimeout=30).getText(url, retry=False)
+    except Exception as e:
+        logger.error("Error %s restarting SMS server", e)
+        return False
+    logger.info("Restarting SMS server returned %s", text)
+    return True
+
+class HealthMonitor:
+    # Create a monitor (call onMessage with received messages, then run)
+    #   publish: function called with topic and payload to send a probe
+    #   isConnected: function returning True when MQTT connection is up
+    #   sendTopic: topic to publish probes to (SMS server mqttGetTopic)
+    #   number: phone number to send probes to
+    #   prefix: prefix of probes, to recognize them
+    #   interval: delay between two probes (in seconds)
+    #   timeout: delay to wait for a probe answer (in seconds)
+    #   window: count of last probes used for statistics
+    #   failureThreshold: consecutive failures before restarting SMS server
+    #   restartCooldown/restartMaxCooldown: minimum delay between two restarts, doubled after each restart (in seconds)
+    #   restart: function called to restart SMS server (None to never restart)
+    #   alert: function called with a subject and a message when SMS server stops or starts answering
+    #   statusFile: file where statistics are written after each probe ("" to disable)
+    def __init__(self, publish, isConnected, sendTopic, number, prefix, logger, interval=300, timeout=60, window=20,
+            failureThreshold=3, restartCooldown=900, restartMaxCooldown=14400, restart=None, alert=None, statusFile=""):
+        self.publish = publish
+        self.isConnected = isConnected
+        self.sendTopic = sendTopic
+        self.number = number
+        self.prefix = prefix
+        self.logger = logger
+        self.interval = interval
+        self.timeout = timeout
+        self.failureThreshold = max(1, failureThreshold)
+        self.restartCooldown = restartCooldown
+        self.restartMaxCooldown = max(restartCooldown, restartMaxCooldown)
+        self.restart = restart
+        self.alert = alert
+        self.statusFile = statusFile
+        self.lock = threading.Lock()
+        self.results = collections.deque(maxlen=max(1, window))    # (success, latency in ms) of last probes
+        self.runId = uuid.uuid4().hex[:6]
+        self.sequence = 0
+        self.expected = None                                        # Text of probe waiting for answer
+        self.answered = threading.Event()
+        self.sendTime = 0
+        self.latencyMs = None
+        self.probeCount = 0
+        self.consecutiveFailures = 0
+        self.alerted = False
+        self.restartCount = 0
+        self.cooldown = restartCooldown
+        self.nextRestartTime = 0
+
+    # Handle a message received from SMS server
+    def onMessage(self, msg):
+        try:
+            message = json.loads(msg.payload.decode("UTF-8")).get("message", "").strip()
+        except (ValueError, AttributeError):
+            return
+        if not message.startswith(self.prefix):
+            return
+        text = message[len(self.prefix):].strip()
+        with self.lock:
+            if text == self.expected:
+                self.latencyMs = round((time.monotonic() - self.sendTime) * 1000, 3)
+                self.expected = None
+                self.answered.set()
+                return
+        self.logger.info("Ignoring late or unknown probe %s", text)
+
+    # Send probes forever
+    def run(self):
+        while True:
+            startTime = time.monotonic()
+            self.probe()
+            time.sleep(max(0, self.interval - (time.monotonic() - startTime)))
+
+    # Send one probe and wait for its answer, returns latency in ms (None if not received)
+    def probe(self):
+        if not self.isConnected():
+            # A broker outage says nothing about SMS server
+            self.logger.error("Not connected to MQTT, probe skipped")
+            return None
+        with self.lock:
+            self.sequence += 1
+            self.expected = F"Probe {self.runId} {self.sequence}"
+            self.answered.clear()
+            self.latencyMs = None
+            self.sendTime = time.monotonic()
+            payload = json.dumps({"number": self.number, "message": self.prefix + " " + self.expected})
+        self.logger.info("Publish %s to %s", payload, self.sendTopic)
+        self.publish(self.sendTopic, payload)
+        answered = self.answered.wait(self.timeout)
+        with self.lock:
+            self.expected = None
+            latencyMs = self.latencyMs if answered else None
+        self._record(latencyMs)
+        return latencyMs
+
+    # Return statistics on last probes
+    def stats(self):
+        with self.lock:
+            results = list(self.results)
+            latencies = sorted(latencyMs for success, latencyMs in results if success)
+            return {
+                "probes": self.probeCount,
+                "window": len(results),
+                "successRate": round(len(latencies) * 100 / len(results), 1) if results else None,
+                "p50Ms": percentile(latencies, 50),
+                "p95Ms": percentile(latencies, 95),
+                "maxMs": latencies[-1] if latencies else None,
+                "consecutiveFailures": self.consecutiveFailures,
+                "restarts": self.restartCount,
+                "nextRestartIn": max(0, round(self.nextRestartTime - time.monotonic())) if self.restartCount else 0,
+            }
+
+    # Record a probe result, restarting SMS server and sending alerts when needed
+    def _record(self, latencyMs):
+        with self.lock:
+            self.probeCount += 1
+            self.results.append((latencyMs != None, latencyMs))
+            if latencyMs != None:
+                wasFailing = self.alerted
+                self.consecutiveFailures = 0
+                self.alerted = False
+                self.cooldown = self.restartCooldown
+            else:
+                self.consecutiveFailures += 1
+        stats = self.stats()
+        if latencyMs != None:
+            self.logger.info("Probe answered in %.0f ms, %s", latencyMs, stats)
+            if wasFailing and self.alert != None:
+                self.alert("SMS server answering again", json.dumps(stats, indent=4))
+        else:
+            self.logger.error("Probe not answered within %s seconds, %s", self.timeout, stats)
+            if self.consecutiveFailures >= self.failureThreshold:
+                self._failing(stats)
+        self._writeStatus(stats)
+
+    # Handle consecutive failures: alert once, restart SMS server if cooldown is over
+    def _failing(self, stats):
+        if not self.alerted:
+            self.alerted = True
+            if self.alert != None:
+                self.alert("SMS server not answering !!!", json.dumps(stats, indent=4))
+        if self.restart == None:
+            return
+        now = time.monotonic()
+        if now < self.nextRestartTime:
+            self.logger.info("SMS server restart delayed, %.0f seconds of cooldown left", self.nextRestartTime - now)
+            return
+        self.restartCount += 1
+        self.nextRestartTime = now + self.cooldown
+        self.logger.info("Restarting SMS server after %d failures, next restart not before %.0f seconds", self.consecutiveFailures, self.cooldown)
+        self.cooldown = min(self.cooldown * 2, self.restartMaxCooldown)
+        self.restart()
+
+    # Write statistics to status file
+    def _writeStatus(self, stats):
+        if self.statusFile == "":
+            return
+        try:
+            with open(self.statusFile, "w") as statusStream:
+                json.dump(dict(stats, time=time.strftime("%Y-%m-%d %H:%M:%S")), statusStream, indent=4)
+        except OSError as e:
+            self.logger.error("Error %s writing %s", e, self.statusFile)
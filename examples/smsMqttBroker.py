@@ -0,0 +1,327 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Lightweight MQTT 3.1.1 broker, used by smsServerEmulator.py to test handlers without any other server.
+
+Supports QoS 0 and 1 (QoS 2 is downgraded to 1), retained messages, last will, "+" and "#" wildcards,
+    and persistent sessions (QoS 1 messages are kept while client is disconnected). Authentication is not checked.
+
+It's not designed for production, only for local tests and performance work.
+
+Can be run alone: smsMqttBroker.py [--host 127.0.0.1] [--port 1883]
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import argparse
+import socketserver
+import struct
+import threading
+
+# MQTT packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# Maximum messages kept for a disconnected persistent session
+MAX_OFFLINE_MESSAGES = 1000
+
+# Check if a topic matches a subscription filter
+def topicMatches(topicFilter, topic):
+    filterParts = topicFilter.split("/")
+    topicParts = topic.split("/")
+    for i, part in enumerate(filterParts):
+        if part == "#":
+            return True
+        if i >= len(topicParts):
+            return False
+        if part != "+" and part != topicParts[i]:
+            return False
+    return len(filterParts) == len(topicParts)
+
+# Encode a string (or bytes) with its 2 bytes length
+def encodeString(value):
+    if isinstance(value, str):
+        value = value.encode("UTF-8")
+    return struct.pack("!H", len(value)) + value
+
+# Build a packet from its first byte and its content
+def buildPacket(firstByte, content):
+    length = len(content)
+    header = bytearray([firstByte])
+    while True:
+        digit = length % 128
+        length //= 128
+        header.append(digit | 0x80 if length else digit)
+        if not length:
+            break
+    return bytes(header) + content
+
+class Session:
+    # Create a session for a connected client
+    def __init__(self, broker, connection):
+        self.broker = broker
+        self.connection = connection
+        self.clientId = ""
+        self.subscriptions = {}                                     # Topic filter -> granted QoS
+        self.will = None                                            # (topic, payload, qos, retain)
+        self.writeLock = threading.Lock()
+        self.nextPacketId = 1
+        self.persistent = False                                     # Session kept after disconnection
+        self.offlineMessages = []                                   # (topic, payload) received while disconnected
+
+    # Send a packet, ignoring errors (client will be cleaned by its reader thread)
+    def send(self, packet):
+        if self.connection == None:
+            return
+        try:
+            with self.writeLock:
+                self.connection.sendall(packet)
+        except OSError:
+            pass
+
+    # Send a message to this client (keeping QoS 1 messages while disconnected)
+    def deliver(self, topic, payload, qos, retain=False):
+        if self.connection == None:
+            if qos and len(self.offlineMessages) < MAX_OFFLINE_MESSAGES:
+                self.offlineMessages.append((topic, payload))
+            return
+        firstByte = (PUBLISH << 4) | (qos << 1) | (1 if retain else 0)
+        content = encodeString(topic)
+        if qos:
+            with self.writeLock:
+                packetId = self.nextPacketId
+                self.nextPacketId = self.nextPacketId % 65535 + 1
+            content += struct.pack("!H", packetId)
+        self.send(buildPacket(firstByte, content + payload))
+
+class MqttBroker:
+    # Create a broker (call start to serve)
+    def __init__(self, host="127.0.0.1", port=1883):
+        self.host = host
+        self.port = port
+        self.lock = threading.Lock()
+        self.sessions = {}                                          # Client id -> session
+        self.offlineSessions = {}                                   # Client id -> disconnected persistent session
+        self.retained = {}                                          # Topic -> (payload, qos)
+        self.publishedCount = 0
+        self.server = None
+
+    # Start serving in a background thread
+    def start(self):
+        broker = self
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                broker._serve(self.request)
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name="mqttBroker", daemon=True).start()
+        return self
+
+    # Stop serving
+    def stop(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    # Publish a message to all matching subscribers
+    def publish(self, topic, payload, qos=0, retain=False):
+        with self.lock:
+            self.publishedCount += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = (payload, qos)
+                else:
+                    self.retained.pop(topic, None)
+            targets = []
+            for session in list(self.sessions.values()) + list(self.offlineSessions.values()):
+                grantedQos = [subscriptionQos for topicFilter, subscriptionQos in session.subscriptions.items() if topicMatches(topicFilter, topic)]
+                if grantedQos:
+                    targets.append((session, min(qos, max(grantedQos))))
+        for session, deliveryQos in targets:
+            session.deliver(topic, payload, deliveryQos)
+
+    # Serve one client connection
+    def _serve(self, connection):
+        session = Session(self, connection)
+        stream = connection.makefile("rb")
+        cleanExit = False
+        try:
+            while True:
+                packetType, flags, content = self._readPacket(stream)
+                if packetType == None:
+                    break
+                if packetType == CONNECT:
+                    session = self._connect(session, content)
+                elif packetType == PUBLISH:
+                    self._publish(session, flags, content)
+                elif packetType == PUBREL:
+                    session.send(buildPacket(PUBCOMP << 4, content[:2]))
+                elif packetType in (PUBACK, PUBREC, PUBCOMP):
+                    pass
+                elif packetType == SUBSCRIBE:
+                    self._subscribe(session, content)
+                elif packetType == UNSUBSCRIBE:
+                    self._unsubscribe(session, content)
+                elif packetType == PINGREQ:
+                    session.send(buildPacket(PINGRESP << 4, b""))
+                elif packetType == DISCONNECT:
+                    cleanExit = True
+                    break
+        except (OSError, ValueError, struct.error, IndexError):
+            pass
+        finally:
+            with self.lock:
+                if self.sessions.get(session.clientId) is session:
+                    del self.sessions[session.clientId]
+                    if session.persistent:
+                        session.connection = None
+                        self.offlineSessions[session.clientId] = session
+            if not cleanExit and session.will != None:
+                self.publish(*session.will)
+            try:
+                connection.close()
+            except OSError:
+                pass
+
+    # Read a packet, returns type, flags and content (type is None at end of stream)
+    def _readPacket(self, stream):
+        firstByte = stream.read(1)
+        if not firstByte:
+            return None, None, None
+        length = 0
+        multiplier = 1
+        while True:
+            digit = stream.read(1)
+            if not digit:
+                return None, None, None
+            length += (digit[0] & 0x7F) * multiplier
+            multiplier *= 128
+            if not digit[0] & 0x80:
+                break
+        content = stream.read(length) if length else b""
+        if len(content) != length:
+            return None, None, None
+        return firstByte[0] >> 4, firstByte[0] & 0x0F, content
+
+    # Read a length prefixed field at a position, returns field and next position
+    def _readField(self, content, position):
+        length = struct.unpack_from("!H", content, position)[0]
+        return content[position + 2:position + 2 + length], position + 2 + length
+
+    # Handle CONNECT packet, returns session to use (a persistent one may be resumed)
+    def _connect(self, session, content):
+        _, position = self._readField(content, 0)                   # Protocol name
+        connectFlags = content[position + 1]
+        position += 4                                               # Level, flags and keep alive
+        clientId, position = self._readField(content, position)
+        clientId = clientId.decode("UTF-8")
+        will = None
+        if connectFlags & 0x04:
+            willTopic, position = self._readField(content, position)
+            willPayload, position = self._readField(content, position)
+            will = (willTopic.decode("UTF-8"), willPayload, min((connectFlags >> 3) & 0x03, 1), bool(connectFlags & 0x20))
+        cleanSession = bool(connectFlags & 0x02)
+        with self.lock:
+            previous = self.sessions.get(clientId)
+            resumed = self.offlineSessions.pop(clientId, None)
+            if cleanSession or resumed == None:
+                resumed = None
+            else:
+                resumed.connection = session.connection
+                session = resumed
+            session.clientId = clientId
+            session.will = will
+            session.persistent = not cleanSession
+            self.sessions[clientId] = session
+            offlineMessages = session.offlineMessages
+            session.offlineMessages = []
+        # Disconnect previous client using same id
+        if previous != None and previous is not session:
+            try:
+                previous.connection.shutdown(2)
+            except OSError:
+                pass
+        session.send(buildPacket(CONNACK << 4, b"\x01\x00" if resumed != None else b"\x00\x00"))
+        # Send messages received while disconnected
+        for topic, payload in offlineMessages:
+            session.deliver(topic, payload, 1)
+        return session
+
+    # Handle PUBLISH packet
+    def _publish(self, session, flags, content):
+        qos = (flags >> 1) & 0x03
+        topic, position = self._readField(content, 0)
+        if qos:
+            packetId = content[position:position + 2]
+            position += 2
+            if qos == 1:
+                session.send(buildPacket(PUBACK << 4, packetId))
+            else:
+                # QoS 2 handshake is answered (PUBREC, then PUBCOMP on PUBREL), but message is delivered as QoS 1
+                session.send(buildPacket(PUBREC << 4, packetId))
+        self.publish(topic.decode("UTF-8"), content[position:], min(qos, 1), bool(flags & 0x01))
+
+    # Handle SUBSCRIBE packet
+    def _subscribe(self, session, content):
+        packetId = content[:2]
+        position = 2
+        granted = bytearray()
+        newFilters = []
+        while position < len(content):
+            topicFilter, position = self._readField(content, position)
+            qos = min(content[position] & 0x03, 1)
+            position += 1
+            topicFilter = topicFilter.decode("UTF-8")
+            with self.lock:
+                session.subscriptions[topicFilter] = qos
+            newFilters.append((topicFilter, qos))
+            granted.append(qos)
+        session.send(buildPacket((SUBACK << 4), packetId + bytes(granted)))
+        # Send retained messages matching new subscriptions
+        with self.lock:
+            retained = list(self.retained.items())
+        for topicFilter, qos in newFilters:
+            for topic, (payload, retainedQos) in retained:
+                if topicMatches(topicFilter, topic):
+                    session.deliver(topic, payload, min(qos, retainedQos), True)
+
+    # Handle UNSUBSCRIBE packet
+    def _unsubscribe(self, session, content):
+        packetId = content[:2]
+        position = 2
+        while position < len(content):
+            topicFilter, position = self._readField(content, position)
+            with self.lock:
+                session.subscriptions.pop(topicFilter.decode("UTF-8"), None)
+        session.send(buildPacket(UNSUBACK << 4, packetId))
+
+#   *****************
+#   *** Main code ***
+#   *****************
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Lightweight MQTT broker for local tests")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen to (default 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=1883, help="port to listen to (default 1883)")
+    args = parser.parse_args()
+    broker = MqttBroker(args.host, args.port).start()
+    print(F"Listening on {args.host}:{broker.port}")
+    threading.Event().wait()
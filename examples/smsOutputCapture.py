@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Size capped capture of command output, used by smsHandler.py.
+
+Output is fed incrementally. Only its head and tail are kept in memory.
+
+When output is larger than head and tail, it's also written to a gzip compressed temporary
+    file (up to a maximum size), to be sent as mail attachment.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import gzip
+import os
+import tempfile
+
+class OutputCapture:
+    # Create a capture
+    #   headSize: bytes kept at start of output
+    #   tailSize: bytes kept at end of output
+    #   spoolMaxSize: maximum (uncompressed) bytes written to spool file
+    #   spoolPrefix: prefix of spool file name
+    def __init__(self, headSize=4096, tailSize=4096, spoolMaxSize=50*1024*1024, spoolPrefix="output_"):
+        self.headSize = headSize
+        self.tailSize = tailSize
+        self.spoolMaxSize = spoolMaxSize
+        self.spoolPrefix = spoolPrefix
+        self.buffer = bytearray()                                   # Full output, while smaller than head + tail
+        self.head = b""
+        self.tail = bytearray()
+        self.totalSize = 0
+        self.spoolName = None
+        self.spoolFile = None
+        self.spoolSize = 0
+
+    # Add some output
+    def write(self, data):
+        self.totalSize += len(data)
+        if self.spoolName == None:
+            self.buffer += data
+            if len(self.buffer) <= self.headSize + self.tailSize:
+                return
+            # Output is too large to be kept in memory, switch to head/tail and spool file
+            self.head = bytes(self.buffer[:self.headSize])
+            self.tail = self.buffer[self.headSize:]
+            self.buffer = bytearray()
+            fd, self.spoolName = tempfile.mkstemp(prefix=self.spoolPrefix, suffix=".log.gz")
+            self.spoolFile = gzip.GzipFile(fileobj=os.fdopen(fd, "wb"), mode="wb")
+            self._spool(self.head)
+            self._spool(self.tail)
+        else:
+            self.tail += data
+            self._spool(data)
+        if len(self.tail) > self.tailSize:
+            del self.tail[:len(self.tail) - self.tailSize]
+
+    # Write data to spool file, up to its maximum size
+    def _spool(self, data):
+        if self.spoolSize < self.spoolMaxSize:
+            data = data[:self.spoolMaxSize - self.spoolSize]
+            self.spoolFile.write(data)
+            self.spoolSize += len(data)
+            if self.spoolSize >= self.spoolMaxSize:
+                self.spoolFile.write(F"\n*** Output truncated after {self.spoolMaxSize} bytes ***\n".encode())
+
+    # Close spool file (if any)
+    def close(self):
+        if self.spoolFile != None:
+            fileObject = self.spoolFile.fileobj
+            self.spoolFile.close()
+            fileObject.close()
+            self.spoolFile = None
+
+    # Is output truncated in memory?
+    def isTruncated(self):
+        return self.spoolName != None
+
+    # Return full output (if not truncated) or head and tail as text
+    def text(self, encoding):
+        if not self.isTruncated():
+            return self.buffer.decode(encoding, errors="replace")
+        skipped = self.totalSize - len(self.head) - len(self.tail)
+        return self.head.decode(encoding, errors="replace") \
+            + F"\n[... {skipped} bytes skipped, see attachment ...]\n" \
+            + self.tail.decode(encoding, errors="replace")
+
+    # Return start of output as text
+    def headText(self, encoding):
+        return (self.head if self.isTruncated() else self.buffer).decode(encoding, errors="replace")
+
+    # Return compressed spool file name (or None if output was not truncated)
+    def attachment(self):
+        return self.spoolName
+
+    # Remove spool file
+    def cleanup(self):
+        self.close()
+        if self.spoolName != None:
+            try:
+                os.remove(self.spoolName)
+            except OSError:
+                pass
+            self.spoolName = None
@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+On demand profiling of a running script, driven by commands received on an MQTT control topic.
+    Used by smsHandler.py and readSms.py.
+
+Available commands:
+    - start profile [seconds]: profile handled messages and commands with cProfile (default 30 seconds)
+    - stop profile: stop profiling before end of delay
+    - start tracemalloc [frames]: start tracing memory allocations (keeping 1 frame by default)
+    - take snapshot [count]: take a memory snapshot, and give top allocations (or differences with
+        previous snapshot), 10 by default
+    - stop tracemalloc: stop tracing memory allocations
+    - dump threads: dump stacks of all threads
+    - enable local debug/disable local debug: change log level
+
+Full results are written to files (named with script name and time), a short summary being sent back.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+
+class Profiler:
+    # Create a profiler
+    #   logger: logger to use (its level is changed by debug commands)
+    #   filePrefix: prefix of result files
+    #   publish: function called with summary of each command
+    def __init__(self, logger, filePrefix, publish):
+        self.logger = logger
+        self.filePrefix = filePrefix
+        self.publish = publish
+        self.lock = threading.Lock()
+        self.profiling = False
+        self.generation = 0
+        self.profiles = []
+        self.profileStart = 0
+        self.profileTimer = None
+        self.lastSnapshot = None
+
+    # Execute a control command, returns False if command is unknown
+    def execute(self, command):
+        words = command.strip().lower().split()
+        try:
+            if words[:2] == ["start", "profile"]:
+                self._startProfile(float(words[2]) if len(words) > 2 else 30)
+            elif words == ["stop", "profile"]:
+                self._stopProfile(self.generation)
+            elif words[:2] == ["start", "tracemalloc"]:
+                tracemalloc.start(int(words[2]) if len(words) > 2 else 1)
+                self.lastSnapshot = None
+                self._summary("Memory allocations traced")
+            elif words[:2] == ["take", "snapshot"]:
+                self._takeSnapshot(int(words[2]) if len(words) > 2 else 10)
+            elif words == ["stop", "tracemalloc"]:
+                tracemalloc.stop()
+                self.lastSnapshot = None
+                self._summary("Memory allocations not traced anymore")
+            elif words == ["dump", "threads"]:
+                self._dumpThreads()
+            elif words == ["enable", "local", "debug"]:
+                self.logger.setLevel(logging.DEBUG)
+            elif words == ["disable", "local", "debug"]:
+                self.logger.setLevel(logging.INFO)
+            else:
+                return False
+        except (ValueError, OSError) as e:
+            self._summary(F"Error {e} executing {command}")
+        return True
+
+    # Call a function, profiling it if profile is running
+    def call(self, function, *args, **kwargs):
+        if not self.profiling:
+            return function(*args, **kwargs)
+        # cProfile only profiles its own thread, so each call gets its own profile, merged at end
+        generation = self.generation
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another call is already profiled (only one profiler can be active starting with Python 3.12)
+            return function(*args, **kwargs)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self.lock:
+                if self.profiling and generation == self.generation:
+                    self.profiles.append(profile)
+
+    # Return a file name for a result
+    def _fileName(self, extension):
+        return F"{self.filePrefix}_{time.strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+    # Log and publish a summary
+    def _summary(self, text):
+        self.logger.info("%s", text)
+        try:
+            self.publish(text)
+        except Exception as e:
+            self.logger.error("Error %s publishing profiler summary", e)
+
+    # Start profiling for a given delay
+    def _startProfile(self, seconds):
+        with self.lock:
+            if self.profiling:
+                self._summary("Profile already running")
+                return
+            self.generation += 1
+            self.profiles = []
+            self.profiling = True
+            self.profileStart = time.monotonic()
+            self.profileTimer = threading.Timer(seconds, self._stopProfile, (self.generation,))
+            self.profileTimer.daemon = True
+            self.profileTimer.start()
+        self._summary(F"Profiling for {seconds:g} seconds")
+
+    # Stop profiling, writing results
+    def _stopProfile(self, generation):
+        with self.lock:
+            if not self.profiling or generation != self.generation:
+                return
+            self.profiling = False
+            self.profileTimer.cancel()
+            profiles = self.profiles
+            self.profiles = []
+            duration = time.monotonic() - self.profileStart
+        if not profiles:
+            self._summary(F"Nothing profiled in {duration:.1f} seconds")
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        fileName = self._fileName("prof")
+        stats.dump_stats(fileName)
+        # Write a readable version, and summarize top functions by cumulative time
+        textStream = io.StringIO()
+        pstats.Stats(fileName, stream=textStream).sort_stats("cumulative").print_stats(30)
+        with open(fileName[:-4] + "txt", "w") as fileStream:
+            fileStream.write(textStream.getvalue())
+        stats.sort_stats("cumulative")
+        top = []
+        for function in stats.fcn_list[:5]:
+            _, _, _, cumulativeTime, _ = stats.stats[function]
+            top.append(F"{function[2]} ({function[0].split('/')[-1]}:{function[1]}) {cumulativeTime * 1000:.1f} ms")
+        self._summary(F"{len(profiles)} calls profiled in {duration:.1f} seconds, written to {fileName}. Top: {', '.join(top)}")
+
+    # Take a memory snapshot, giving top allocations or differences with previous one
+    def _takeSnapshot(self, count):
+        if not tracemalloc.is_tracing():
+            self._summary("Memory allocations are not traced, send 'start tracemalloc' first")
+            return
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        fileName = self._fileName("snapshot")
+        snapshot.dump(fileName)
+        if self.lastSnapshot != None:
+            title = F"Top {count} differences with previous snapshot"
+            statistics = snapshot.compare_to(self.lastSnapshot, "lineno")[:count]
+        else:
+            title = F"Top {count} allocations"
+            statistics = snapshot.statistics("lineno")[:count]
+        self.lastSnapshot = snapshot
+        with open(fileName + ".txt", "w") as fileStream:
+            fileStream.write(title + "\n")
+            for statistic in statistics:
+                fileStream.write(str(statistic) + "\n")
+        current, peak = tracemalloc.get_traced_memory()
+        self._summary(F"{title} (traced {current // 1024} kB, peak {peak // 1024} kB), written to {fileName}: " +
+            "; ".join(str(statistic) for statistic in statistics[:3]))
+
+    # Dump stacks of all threads
+    def _dumpThreads(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        fileName = self._fileName("threads.txt")
+        with open(fileName, "w") as fileStream:
+            for ident, frame in frames.items():
+                fileStream.write(F"Thread {names.get(ident, '?')} ({ident}):\n")
+                fileStream.write("".join(traceback.format_stack(frame)) + "\n")
+        self._summary(F"{len(frames)} thread stacks written to {fileName}: " + ", ".join(sorted(str(name) for name in names.values())))
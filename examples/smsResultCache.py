@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Result cache for read only SMS commands, used by smsHandler.py.
+
+Only commands given in allow list are cached, each one with its own time to live.
+    Commands are normalized (extra spaces removed) before being compared.
+
+Cache size is limited (in bytes of cached output), least recently used results being removed first.
+
+Concurrent identical requests are coalesced: only one command is executed, all callers getting its result.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import collections
+import threading
+import time
+
+# Request being computed, shared by all callers asking for same key
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class ResultCache:
+    # Create a cache
+    #   cachedCommands: dictionary of command -> time to live (in seconds)
+    #   maxBytes: maximum size of cached results
+    def __init__(self, cachedCommands, maxBytes=1024*1024):
+        self.ttls = {normalizeCommand(command): ttl for command, ttl in (cachedCommands if cachedCommands != None else {}).items()}
+        self.maxBytes = maxBytes
+        self.entries = collections.OrderedDict()                    # Key -> (expiration time, size, result), oldest first
+        self.flights = {}                                           # Key -> request being computed
+        self.totalBytes = 0
+        self.hitCount = 0
+        self.coalescedCount = 0
+        self.lock = threading.Lock()
+
+    # Return time to live of a command (or None if command can't be cached)
+    def ttl(self, command):
+        return self.ttls.get(normalizeCommand(command))
+
+    # Return result for a key, calling compute if not cached and not being computed by another caller
+    #   compute returns result, its size and a flag saying if result can be cached
+    #   Returns result and a flag set if result was not computed by this call
+    def get(self, key, ttl, compute):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry != None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hitCount += 1
+                    return entry[2], True
+                self._remove(key)
+            flight = self.flights.get(key)
+            owner = flight == None
+            if owner:
+                flight = _Flight()
+                self.flights[key] = flight
+            else:
+                self.coalescedCount += 1
+        if not owner:
+            # Wait for result computed by another caller
+            flight.done.wait()
+            if flight.error != None:
+                raise flight.error
+            return flight.result, True
+        try:
+            result, size, cacheable = compute()
+            flight.result = result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+                if flight.error == None and cacheable and size <= self.maxBytes:
+                    if key in self.entries:
+                        self._remove(key)
+                    self.entries[key] = (time.monotonic() + ttl, size, result)
+                    self.totalBytes += size
+                    while self.totalBytes > self.maxBytes:
+                        self._remove(next(iter(self.entries)))
+            flight.done.set()
+        return result, False
+
+    # Remove an entry (lock should be held)
+    def _remove(self, key):
+        self.totalBytes -= self.entries.pop(key)[1]
+
+# Normalize a command (remove extra spaces)
+def normalizeCommand(command):
+    return " ".join(command.split())
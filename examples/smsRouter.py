@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Command router used by smsHandler.py to serve multiple instances (command namespaces) from one process.
+
+Instances are defined in "instances" item of configuration file, each instance inheriting missing
+    items from main level. When "instances" is not given, one instance is created from "instanceName"
+    (or host name) and main level items.
+
+Index (lower case instance name) and authorization map (phone number -> instance -> mail receiver)
+    are built once at load time, so routing cost doesn't depend on instance and sender count.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+# Instance items that can be given at main level and overridden by instance
+instanceItems = {"mailReceivers": {}, "shellName": "", "shellInitCommand": "", "shellErrorRemove": ""}
+
+# Routing status
+ROUTE_OK = "ok"
+ROUTE_IGNORED = "ignored"
+ROUTE_UNAUTHORIZED = "unauthorized"
+
+class Instance:
+    # Create an instance from its name and (merged) settings
+    def __init__(self, name, settings):
+        self.name = name
+        self.mailReceivers = settings["mailReceivers"] if settings["mailReceivers"] != None else {}
+        self.shellName = settings["shellName"]
+        self.shellInitCommand = settings["shellInitCommand"]
+        self.shellErrorRemove = settings["shellErrorRemove"]
+
+class CommandRouter:
+    # Build router from configuration data
+    #   defaultName: instance name to use when neither "instances" nor "instanceName" are given
+    def __init__(self, configData, defaultName):
+        self.instances = {}                                         # Instances, by lower case name
+        self.authorizations = {}                                    # Phone number -> lower case name -> mail receiver
+        defaults = {}
+        for item, default in instanceItems.items():
+            value = configData.get(item, default)
+            defaults[item] = value if value != None else default
+        if "instances" in configData:
+            for name, settings in configData["instances"].items():
+                merged = dict(defaults)
+                merged.update(settings if settings != None else {})
+                self._addInstance(Instance(name, merged))
+        else:
+            self._addInstance(Instance(configData.get("instanceName", defaultName), defaults))
+        # Prefix lengths, longest first, for messages where command is glued to instance name
+        self.prefixLengths = sorted({len(name) for name in self.instances}, reverse=True)
+
+    # Add an instance to index and authorization map
+    def _addInstance(self, instance):
+        key = instance.name.lower()
+        if key in self.instances:
+            raise ValueError(F"Instance {instance.name} defined twice")
+        self.instances[key] = instance
+        for number, receiver in instance.mailReceivers.items():
+            self.authorizations.setdefault(number, {})[key] = receiver
+
+    # Return list of instance names
+    def instanceNames(self):
+        return [instance.name for instance in self.instances.values()]
+
+    # Route a message
+    #   Returns status, instance, mail receiver and command
+    def route(self, number, message):
+        key, command = self._split(message)
+        if key == None:
+            return ROUTE_IGNORED, None, None, None
+        instance = self.instances[key]
+        allowed = self.authorizations.get(number)
+        if allowed == None or key not in allowed:
+            return ROUTE_UNAUTHORIZED, instance, None, command
+        return ROUTE_OK, instance, allowed[key], command
+
+    # Split message into instance key and command, using first token, then prefixes
+    def _split(self, message):
+        parts = message.split(None, 1)
+        if not parts:
+            return None, None
+        key = parts[0].lower()
+        if key in self.instances:
+            return key, parts[1].strip() if len(parts) > 1 else ""
+        # Command may be glued to instance name (like "myHostuptime")
+        for length in self.prefixLengths:
+            key = message[:length].lower()
+            if key in self.instances:
+                return key, message[length:].strip()
+        return None, None
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Outbound SMS scheduler, used by smsHandler.py to avoid overflowing SMS server buffer during bursts.
+
+SMS are kept in a local queue, and published one by one:
+    - higher priority first (alerts before normal answers), then in order of arrival,
+    - at a rate limited by a token bucket (sustained rate in SMS per minute, with a burst size),
+    - only when SMS server has less than a given count of pending SMS. This count is read from
+        its /debug page (pendingSms and isSending), when URL is given.
+
+An SMS flagged as coalescable (like a rejection notice) is not queued twice when an identical one
+    (same number and message) is already waiting. Other SMS (like command answers) are always queued,
+    even if identical, as they answer distinct commands.
+
+Scheduler can be paused (when SMS server is down), and its waiting SMS taken back to be sent elsewhere.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import heapq
+import itertools
+import threading
+import time
+from smsGatewayClient import getClient
+
+# Priorities (lower is sent first)
+PRIORITY_ALERT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+class SmsScheduler:
+    # Create a scheduler
+    #   publish: function called with number, message and instance name to really send a SMS
+    #   rate: sustained SMS per minute (0 for no limit)
+    #   burst: SMS that can be sent at once after an idle period
+    #   debugUrl: SMS server /debug URL ("" to disable backpressure)
+    #   maxPending: maximum SMS waiting in SMS server before we stop publishing
+    #   pollInterval: delay between two /debug reads while waiting for SMS server (in seconds)
+    def __init__(self, publish, logger, rate=20, burst=5, debugUrl="", maxPending=2, pollInterval=2):
+        self.publish = publish
+        self.logger = logger
+        self.condition = threading.Condition()
+        self.queue = []                                             # Heap of [priority, sequence, number, message, active, coalesce, instance]
+        self.waitingCount = 0                                       # Active entries in queue
+        self.coalescable = {}                                       # (number, message) -> heap entry of coalescable SMS
+        self.sequence = itertools.count()
+        self.tokens = 0
+        self.lastRefill = time.monotonic()
+        self.gatewayPending = 0                                     # SMS server pending count (read or estimated)
+        self.gatewayError = False
+        self.lastPublishTime = 0
+        self.coalescedCount = 0
+        self.paused = False
+        self.pollInterval = pollInterval
+        self.configure(rate, burst, debugUrl, maxPending)
+        self.tokens = self.burst
+        threading.Thread(target=self._run, name="smsScheduler", daemon=True).start()
+
+    # Change settings
+    def configure(self, rate, burst, debugUrl, maxPending):
+        with self.condition:
+            self.rate = rate
+            self.burst = max(1, burst)
+            self.tokens = min(self.tokens, self.burst)
+            self.debugUrl = debugUrl
+            self.maxPending = max(1, maxPending)
+            self.condition.notify()
+
+    # Queue a SMS, returns False if an identical coalescable SMS was already waiting
+    #   coalesce: don't queue SMS if an identical coalescable one is already waiting
+    #   instance: name of instance answering (given back to publish, None if not known)
+    def send(self, number, message, priority=PRIORITY_NORMAL, coalesce=False, instance=None):
+        key = (number, message)
+        with self.condition:
+            entry = self.coalescable.get(key) if coalesce else None
+            if entry != None:
+                self.coalescedCount += 1
+                self.logger.info("%s to %s already waiting, not queued again", message, number)
+                if priority < entry[0]:
+                    # Move it to higher priority, keeping its arrival order
+                    entry[4] = False
+                    entry = [priority, entry[1], number, message, True, True, entry[6]]
+                    self.coalescable[key] = entry
+                    heapq.heappush(self.queue, entry)
+                    self.condition.notify()
+                return False
+            entry = [priority, next(self.sequence), number, message, True, coalesce, instance]
+            if coalesce:
+                self.coalescable[key] = entry
+            self.waitingCount += 1
+            heapq.heappush(self.queue, entry)
+            self.condition.notify()
+        return True
+
+    # Return count of SMS waiting
+    def pending(self):
+        with self.condition:
+            return self.waitingCount
+
+    # Return SMS waiting here, plus SMS known to wait in SMS server (when its state can be read)
+    def load(self):
+        with self.condition:
+            return self.waitingCount + (self.gatewayPending if self.debugUrl else 0)
+
+    # Stop publishing (waiting SMS are kept)
+    def pause(self):
+        with self.condition:
+            self.paused = True
+
+    # Publish again
+    def resume(self):
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    # Remove all waiting SMS, returns them as (number, message, priority, coalesce, instance) in sending order
+    def drain(self):
+        with self.condition:
+            entries = sorted(entry for entry in self.queue if entry[4])
+            self.queue = []
+            self.waitingCount = 0
+            self.coalescable = {}
+            self.condition.notify_all()
+        return [(number, message, priority, coalesce, instance) for priority, _, number, message, _, coalesce, instance in entries]
+
+    # Wait for queue to be empty (or timeout)
+    def flush(self, timeout=None):
+        endTime = time.monotonic() + timeout if timeout != None else None
+        with self.condition:
+            while self.waitingCount:
+                remaining = endTime - time.monotonic() if endTime != None else None
+                if remaining != None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    # Add tokens earned since last refill (lock should be held)
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.lastRefill) * self.rate / 60)
+        else:
+            self.tokens = self.burst
+        self.lastRefill = now
+
+    # Read SMS server pending count, returns None if not available
+    def _readGateway(self, debugUrl):
+        try:
+            # Connection to SMS server is kept open between reads
+            pending = getClient(debugUrl, readTimeout=5).debug().waitingSms()
+            if self.gatewayError:
+                self.logger.info("%s readable again", debugUrl)
+                self.gatewayError = False
+            return pending
+        except Exception as e:
+            if not self.gatewayError:
+                self.logger.error("Error %s reading %s, using rate limit only", e, debugUrl)
+                self.gatewayError = True
+            return None
+
+    # Scheduler thread
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.waitingCount or self.paused:
+                    self.condition.wait()
+                # Wait for a token
+                self._refill()
+                if self.tokens < 1:
+                    self.condition.wait((1 - self.tokens) * 60 / self.rate)
+                    continue
+                debugUrl = self.debugUrl
+                gatewayFull = self.gatewayPending >= self.maxPending
+                if debugUrl and gatewayFull:
+                    # Give SMS server time to get last published SMS before reading its state
+                    delay = self.lastPublishTime + self.pollInterval - time.monotonic()
+                    if delay > 0:
+                        self.condition.wait(delay)
+                        continue
+            # Check SMS server buffer before sending (estimate is refreshed only when needed)
+            if debugUrl and gatewayFull:
+                pending = self._readGateway(debugUrl)
+                with self.condition:
+                    self.gatewayPending = pending if pending != None else 0
+                    if self.gatewayPending >= self.maxPending:
+                        self.condition.wait(self.pollInterval)
+                        continue
+            with self.condition:
+                while self.queue and not self.queue[0][4]:
+                    heapq.heappop(self.queue)
+                if not self.queue:
+                    continue
+                _, _, number, message, _, coalesce, instance = heapq.heappop(self.queue)
+                self.waitingCount -= 1
+                if coalesce:
+                    del self.coalescable[(number, message)]
+                self.tokens -= 1
+                self.gatewayPending += 1
+                self.lastPublishTime = time.monotonic()
+                self.condition.notify_all()
+            try:
+                self.publish(number, message, instance)
+            except Exception as e:
+                self.logger.error("Error %s sending %s to %s", e, message, number)
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+SMS encoding and segmentation, used by smsHandler.py to send answers in the fewest SMS.
+
+A message only made of GSM 03.38 characters is sent in GSM-7 (160 characters, or 153 per part
+    when split, characters of extension table counting twice). Any other character forces
+    UCS-2 (70 characters, or 67 per part).
+
+Accentuated characters not existing in GSM-7 can optionally be replaced as firmware's
+    unaccentuate() does (src/unaccentuate.h), to keep message in GSM-7.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+# GSM 03.38 basic character set
+GSM7_BASIC = frozenset("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+# GSM 03.38 extension table (each character uses 2 septets)
+GSM7_EXTENSION = frozenset("\f^{}\\[~]|€")
+
+# Message sizes (single message, part of a concatenated message)
+GSM7_SINGLE = 160
+GSM7_PART = 153
+UCS2_SINGLE = 70
+UCS2_PART = 67
+
+# Same replacements as firmware's unaccentuate()
+UNACCENTUATE_TABLE = str.maketrans({
+    "À": "A", "Á": "A", "Â": "A", "Ã": "A", "Ä": "A", "Å": "A", "Ç": "C", "È": "E", "É": "E", "Ê": "E", "Ë": "E",
+    "Ì": "I", "Í": "I", "Î": "I", "Ï": "I", "Ñ": "N", "Ò": "O", "Ó": "O", "Ô": "O", "Õ": "O", "Ö": "O", "Ø": "O",
+    "Ù": "U", "Ú": "U", "Û": "U", "Ü": "U", "à": "a", "á": "a", "â": "a", "ã": "a", "ä": "a", "å": "a", "ç": "c",
+    "è": "e", "é": "e", "ê": "e", "ë": "e", "ì": "i", "í": "i", "î": "i", "ï": "i", "ð": "o", "ñ": "n", "ò": "o",
+    "ó": "o", "ô": "o", "õ": "o", "ö": "o", "ø": "o", "ù": "u", "ú": "u", "û": "u", "ü": "u", "ý": "y", "ÿ": "y",
+})
+
+# Same replacements, restricted to characters not existing in GSM-7 (others are kept as they cost nothing)
+TRANSLITERATE_TABLE = {code: replacement for code, replacement in UNACCENTUATE_TABLE.items()
+    if chr(code) not in GSM7_BASIC and chr(code) not in GSM7_EXTENSION}
+
+# Replace accentuated characters as firmware does
+def unaccentuate(text, toLowercase=False):
+    text = text.translate(UNACCENTUATE_TABLE)
+    return text.lower() if toLowercase else text
+
+# Check if a text can be sent in GSM-7
+def isGsm7(text):
+    return all(char in GSM7_BASIC or char in GSM7_EXTENSION for char in text)
+
+# Return cost of each character of a text (septets in GSM-7, UTF-16 code units in UCS-2)
+def _charCosts(text, gsm7):
+    if gsm7:
+        return [2 if char in GSM7_EXTENSION else 1 for char in text]
+    return [2 if ord(char) > 0xFFFF else 1 for char in text]
+
+# Return encoding ("gsm7" or "ucs2") and length (in septets or UTF-16 code units) of a text
+def smsLength(text):
+    gsm7 = isGsm7(text)
+    return ("gsm7" if gsm7 else "ucs2"), sum(_charCosts(text, gsm7))
+
+# Split a text into the fewest SMS parts
+#   maxParts: maximum count of parts (0 for no limit)
+#   transliterate: replace accentuated characters not existing in GSM-7 if this keeps message in GSM-7
+#   Returns list of parts, or None if text needs more than maxParts parts
+def splitSms(text, maxParts=0, transliterate=True):
+    gsm7 = isGsm7(text)
+    if not gsm7 and transliterate:
+        replaced = text.translate(TRANSLITERATE_TABLE)
+        if isGsm7(replaced):
+            text, gsm7 = replaced, True
+    costs = _charCosts(text, gsm7)
+    if sum(costs) <= (GSM7_SINGLE if gsm7 else UCS2_SINGLE):
+        return [text]
+    partSize = GSM7_PART if gsm7 else UCS2_PART
+    parts = []
+    start = 0
+    used = 0
+    # Characters are never split (extension characters and surrogate pairs stay in same part)
+    for position, cost in enumerate(costs):
+        if used + cost > partSize:
+            parts.append(text[start:position])
+            if maxParts and len(parts) >= maxParts:
+                return None
+            start = position
+            used = 0
+        used += cost
+    parts.append(text[start:])
+    return parts
+
+# Split the longest start of a text followed by a suffix (like "... see mail") that fits in maxParts SMS
+#   Returns list of parts, or None if suffix alone doesn't fit
+def splitSmsHead(text, suffix, maxParts=1, transliterate=True):
+    parts = splitSms(text + suffix, maxParts, transliterate)
+    if parts != None:
+        return parts
+    # Longer starts never need less parts, so search the longest one fitting
+    low, high = -1, min(len(text), maxParts * GSM7_PART) if maxParts else len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if splitSms(text[:middle] + suffix, maxParts, transliterate) != None:
+            low = middle
+        else:
+            high = middle - 1
+    return splitSms(text[:low] + suffix, maxParts, transliterate) if low >= 0 else None
@@ -0,0 +1,403 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+It emulates FF_SmsServer32 MQTT interface, to test and load test SMS handlers without ESP32, modem or SIM card.
+
+Like SMS server, it:
+    - reads SMS to send (JSON with number and message) from mqttSendTopic,
+    - writes received SMS (JSON with number, date and message) to mqttReceiveTopic,
+    - publishes its state ({"state":"up"} or {"state":"down"} as last will) to mqttLwtTopic,
+    - executes debug commands received on mqttCommandTopic.
+
+SMS to send are buffered, then sent one by one by an emulated modem, with a configurable send delay,
+    maximum SMS rate and drop rate. SMS sent to SMS server own number are received back after
+    a receive delay, as real SMS server does (this is what smsServerTest.py uses).
+
+In addition to SMS server commands, "receive <number> <message>" on command topic
+    emulates reception of a SMS from any number.
+
+An embedded MQTT broker can be started (--broker), so nothing else is needed to test on a plain Linux box.
+
+Usage: smsServerEmulator.py [--broker] [--sendDelay 3] [--maxRate 0] [--dropRate 0] [--httpPort 0]
+
+With --httpPort, SMS server /debug, /status, /log and /rest pages are also emulated (used to test smsGatewayClient.py).
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import argparse
+import collections
+import http.server
+import json
+import logging
+import os
+import pathlib
+import random
+import threading
+import time
+import urllib.parse
+import paho.mqtt.client as mqtt
+from smsConfig import readConfig
+from smsMqttBroker import MqttBroker
+
+class Modem:
+    # Create an emulated modem
+    #   ownNumber: SMS server phone number (SMS sent to it are received back)
+    #   allowedNumbers: list of numbers SMS are accepted from (and sent to when no number given)
+    #   sendDelay: time to send one SMS (in seconds)
+    #   receiveDelay: time before a SMS sent to own number is received (in seconds)
+    #   maxRate: maximum SMS sent per minute (0 for no limit)
+    #   dropRate: percentage of SMS silently lost
+    #   maxPending: maximum count of buffered SMS (0 for no limit)
+    #   onReceive: function called with number, date and message of received SMS
+    def __init__(self, ownNumber, allowedNumbers, sendDelay, receiveDelay, maxRate, dropRate, maxPending, onReceive, logger):
+        self.ownNumber = ownNumber
+        self.allowedNumbers = allowedNumbers
+        self.sendDelay = sendDelay
+        self.receiveDelay = receiveDelay
+        self.maxRate = maxRate
+        self.dropRate = dropRate
+        self.maxPending = maxPending
+        self.onReceive = onReceive
+        self.logger = logger
+        self.buffer = collections.deque()                           # (number, message) waiting to be sent
+        self.condition = threading.Condition()
+        self.isSending = False
+        self.lastSendTime = None
+        self.counters = {"queued": 0, "rejected": 0, "sent": 0, "dropped": 0, "received": 0, "refused": 0, "maxPending": 0}
+        self.lastSent = {"number": "", "date": "", "message": ""}
+        self.lastReceived = {"number": "", "date": "", "message": ""}
+        threading.Thread(target=self._run, name="modem", daemon=True).start()
+
+    # Store a SMS in buffer (number can be a comma separated list, defaults to allowed numbers)
+    def sendSms(self, message, target=""):
+        for number in (target if target else ",".join(self.allowedNumbers)).split(","):
+            number = number.strip()
+            if number == "":
+                continue
+            with self.condition:
+                if self.maxPending and len(self.buffer) >= self.maxPending:
+                    self.counters["rejected"] += 1
+                    self.logger.error("Buffer full, can't send %s to %s", message, number)
+                    continue
+                self.logger.info("Sending %s to %s", message, number)
+                self.buffer.append((number, message))
+                self.counters["queued"] += 1
+                self.counters["maxPending"] = max(self.counters["maxPending"], len(self.buffer))
+                self.condition.notify()
+
+    # Return count of pending messages
+    def pendingMessages(self):
+        with self.condition:
+            return len(self.buffer)
+
+    # Emulate reception of a SMS
+    def receiveSms(self, number, message):
+        date = getTime()
+        accepted = number in self.allowedNumbers
+        with self.condition:
+            self.lastReceived = {"number": number, "date": date, "message": message}
+            self.counters["received" if accepted else "refused"] += 1
+        if not accepted:
+            self.logger.info("Bad sender %s", number)
+            return
+        self.logger.info("Received %s from %s on %s", message, number, date)
+        self.onReceive(number, date, message)
+
+    # Modem thread, sending buffered SMS one by one (as sendBufferedSMS does)
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.buffer:
+                    self.condition.wait()
+                number, message = self.buffer.popleft()
+                self.isSending = True
+            # Respect maximum rate
+            if self.maxRate > 0 and self.lastSendTime != None:
+                delay = self.lastSendTime + 60 / self.maxRate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.lastSendTime = time.monotonic()
+            self.logger.debug("Send SMS to %s: %s", number, message)
+            time.sleep(self.sendDelay)
+            with self.condition:
+                self.isSending = False
+                if random.random() * 100 < self.dropRate:
+                    self.counters["dropped"] += 1
+                    self.logger.info("Dropped %s to %s", message, number)
+                    continue
+                self.counters["sent"] += 1
+                self.lastSent = {"number": number, "date": getTime(), "message": message}
+            # SMS sent to ourself are received back
+            if number == self.ownNumber:
+                timer = threading.Timer(self.receiveDelay, self.receiveSms, (number, message))
+                timer.daemon = True
+                timer.start()
+
+    # Return modem state
+    def state(self):
+        with self.condition:
+            return {"isIdle": not self.isSending and not self.buffer, "isSending": self.isSending, "pendingSms": len(self.buffer),
+                "lastSentMessage": self.lastSent["message"], "lastSentDate": self.lastSent["date"], "lastSentNumber": self.lastSent["number"],
+                "lastReceivedMessage": self.lastReceived["message"], "lastReceivedDate": self.lastReceived["date"],
+                "lastReceivedNumber": self.lastReceived["number"], "counters": dict(self.counters)}
+
+# Return current time as SMS server does
+def getTime():
+    return time.strftime("%Y/%m/%d %H:%M:%S")
+
+# Execute a debug command received on command topic
+def executeCommand(command):
+    if command.startswith("send "):
+        modem.sendSms(command[5:])
+    elif command.startswith("receive "):
+        parts = command.split(" ", 2)
+        if len(parts) < 3:
+            logger.error("Command %s should be 'receive <number> <message>'", command)
+            return
+        modem.receiveSms(parts[1], parts[2])
+    elif command.lower() == "show modem":
+        logger.info("Modem state: %s", json.dumps(modem.state()))
+    elif command.lower() in ("enable local debug", "enable modem debug"):
+        logger.setLevel(logging.DEBUG)
+    elif command.lower() in ("disable local debug", "disable modem debug"):
+        logger.setLevel(logging.INFO)
+    elif command.startswith("AT") or command.lower().startswith(("enable ", "disable ")):
+        logger.info("Ignoring %s", command)
+    else:
+        logger.error("Command %s is unknown", command)
+
+# Publish a received SMS
+def publishReceived(number, date, message):
+    payload = json.dumps({"number": number, "date": date, "message": message})
+    logger.info("Publishing %s to %s", payload, receiveTopic)
+    mqttClient.publish(receiveTopic, payload, args.qos, False)
+
+def onConnect(client, userdata, flags, reasonCode, properties=None):
+    # Check for connection state
+    if reasonCode != 'Success' and str(reasonCode) != '0':
+        logger.error(F"Failed to connect - Reason code={reasonCode}")
+        return
+    logger.info("Connected to %s:%s", mqttServer, mqttPort)
+    client.publish(lwtTopic, json.dumps({"state": "up", "id": emulatorName, "version": fileVersion}), 0, True)
+    client.subscribe(sendTopic, 0)
+    client.subscribe(commandTopic, 0)
+    client.subscribe(lwtTopic + "/+", 0)
+
+def onMessage(client, userdata, msg):
+    payload = msg.payload.decode("UTF-8", errors='backslashreplace')
+    logger.debug("Received: %s from %s", payload, msg.topic)
+    if msg.topic == sendTopic:
+        # This is a request to send a SMS
+        try:
+            jsonData = json.loads(payload)
+            message = str(getValue(jsonData, "message"))
+            number = str(getValue(jsonData, "number"))
+        except Exception as e:
+            logger.error("Failed to parse >%s<. Error: %s", payload, e)
+            return
+        if message == "" or number == "":
+            logger.error("Message and/or number missing from MQTT payload %s", payload)
+            return
+        modem.sendSms(message, number)
+    elif msg.topic == commandTopic:
+        executeCommand(payload)
+    elif msg.topic.startswith(lwtTopic + "/"):
+        node = msg.topic[len(lwtTopic) + 1:]
+        if "/" in node:
+            # Deeper topics (like node stats) are not node states
+            return
+        if payload:
+            try:
+                state = json.loads(payload).get("state")
+            except Exception:
+                logger.error("Failed to parse %s for topic %s", payload, msg.topic)
+                return
+            if state == None:
+                logger.error("'State' missing from MQTT payload %s for topic %s", payload, msg.topic)
+                return
+            listeningNodes[node] = state
+            logger.info("Node >%s< is >%s<", node, listeningNodes[node])
+        else:
+            listeningNodes.pop(node, None)
+            logger.info("Node >%s< is deleted", node)
+
+# Keep last log lines, as SMS server does for its /log page
+class LogRing(logging.Handler):
+    def __init__(self, maxLines=45):
+        super().__init__()
+        self.lines = collections.deque(maxlen=maxLines)
+        self.savedCount = 0                                         # Lines saved since start (used as ETag)
+
+    def emit(self, record):
+        line = self.format(record)
+        with self.lock:
+            self.lines.append(line)
+            self.savedCount += 1
+
+    # Return saved lines and their ETag
+    def content(self):
+        with self.lock:
+            return list(self.lines), F'"{self.savedCount}"'
+
+# Web server giving state as SMS server /debug, /status, /log and /rest pages do
+class StateHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"                                   # Keep connections open, as SMS server does
+
+    def do_GET(self):
+        contentType = "application/json"
+        headers = {}
+        if self.path == "/debug":
+            answer = {"version": fileVersion, "mqttConnected": mqttClient.is_connected(), "date": getTime()}
+            answer.update(modem.state())
+        elif self.path == "/status":
+            answer = {"state": "off", "powerMode": "USB", "smsState": "SMS ready"}
+        elif self.path == "/log":
+            lines, etag = logRing.content()
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            answer = "".join(line + "\n" for line in lines)
+            contentType = "text/plain; charset=utf-8"
+            headers["ETag"] = etag
+        elif self.path == "/rest/listening":
+            answer = ", ".join(F"{node}:{state}" for node, state in listeningNodes.items()) or "[Empty]"
+            contentType = "text/plain"
+        elif self.path == "/rest/restart":
+            logger.info("Restart requested")
+            answer = "Restarting..."
+            contentType = "text/plain"
+        elif self.path.startswith(("/rest/send&", "/rest/params&")):
+            params = urllib.parse.parse_qs(self.path[self.path.index("&") + 1:])
+            number = params.get("number", [""])[0].replace(" ", "+")
+            message = params.get("message", [""])[0]
+            if number == "" or message == "":
+                self.send_error(400, "Missing number and/or message")
+                return
+            modem.sendSms(message, number)
+            answer = "ok\n"
+            contentType = "text/plain"
+        else:
+            self.send_error(404)
+            return
+        content = (answer if isinstance(answer, str) else json.dumps(answer)).encode("UTF-8")
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # Not saved in log ring, so that reading /log doesn't change it
+        logging.getLogger(cdeFile + "Http").debug(format, *args)
+
+# Returns a dictionary value giving a key or default value if not existing
+def getValue(dict, key, default=''):
+    if key in dict:
+        if dict[key] == None:
+            return default
+        else:
+            return dict[key]
+    else:
+        return default
+
+#   *****************
+#   *** Main code ***
+#   *****************
+
+# Set current working directory to this python file folder
+currentPath = pathlib.Path(__file__).parent.resolve()
+os.chdir(currentPath)
+
+# Get this file name (w/o path & extension)
+cdeFile = pathlib.Path(__file__).stem
+
+parser = argparse.ArgumentParser(description="FF_SmsServer32 emulator")
+parser.add_argument("--config", default="smsServerParameters.json", help="configuration file (default smsServerParameters.json)")
+parser.add_argument("--broker", action="store_true", help="start an embedded MQTT broker on mqttPort")
+parser.add_argument("--number", help="SMS server phone number (default smsServerNumber)")
+parser.add_argument("--allowed", help="comma separated list of allowed numbers (default SMS server number)")
+parser.add_argument("--sendDelay", type=float, default=3.0, help="time to send one SMS, in seconds (default 3)")
+parser.add_argument("--receiveDelay", type=float, default=1.0, help="time to receive a SMS sent to SMS server number, in seconds (default 1)")
+parser.add_argument("--maxRate", type=float, default=0, help="maximum SMS sent per minute (default 0: no limit)")
+parser.add_argument("--dropRate", type=float, default=0, help="percentage of SMS lost (default 0)")
+parser.add_argument("--maxPending", type=int, default=0, help="maximum buffered SMS (default 0: no limit)")
+parser.add_argument("--qos", type=int, choices=(0, 1), default=0, help="QoS of received SMS, as MQTT_RECEIVED_QOS of SMS server (default 0)")
+parser.add_argument("--httpPort", type=int, default=0, help="port to serve /debug, /status, /log and /rest pages (default 0: disabled)")
+parser.add_argument("--debug", action="store_true", help="display debug messages")
+args = parser.parse_args()
+
+# Log settings
+logging.basicConfig(format="%(asctime)s:%(levelname)s:%(message)s", level=logging.INFO)
+logger = logging.getLogger(cdeFile)
+logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+logRing = LogRing()
+logRing.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+logger.addHandler(logRing)
+logger.info("----- Starting version %s -----", fileVersion)
+
+# Read JSON configuration file
+try:
+    configData = readConfig(args.config)
+except ValueError as e:
+    logger.error(e)
+    exit(2)
+
+mqttServer = configData["mqttServer"]
+mqttPort = configData["mqttPort"]
+sendTopic = configData["mqttSendTopic"]
+receiveTopic = configData["mqttReceiveTopic"]
+lwtTopic = configData["mqttLwtTopic"]
+commandTopic = getValue(configData, "mqttCommandTopic", "smsServer/command")
+ownNumber = args.number if args.number else getValue(configData, "smsServerNumber")
+allowedNumbers = [number.strip() for number in (args.allowed if args.allowed else ownNumber).split(",") if number.strip()]
+listeningNodes = {}
+
+# Start embedded broker if needed
+if args.broker:
+    broker = MqttBroker("127.0.0.1", mqttPort).start()
+    mqttServer = "127.0.0.1"
+    mqttPort = broker.port
+    logger.info("MQTT broker listening on %s:%s", mqttServer, mqttPort)
+
+modem = Modem(ownNumber, allowedNumbers, args.sendDelay, args.receiveDelay, args.maxRate, args.dropRate, args.maxPending,
+    publishReceived, logger)
+
+# Use this python file name and random number as client name
+random.seed()
+emulatorName = cdeFile+'_{:x}'.format(random.randrange(65535))
+
+# Initialize MQTT client
+# Try to find CallbackAPIVersion (exists starting on version 2)
+try:
+    from paho.mqtt.enums import CallbackAPIVersion
+    mqttClient = mqtt.Client(client_id=emulatorName, callback_api_version=CallbackAPIVersion.VERSION2)
+except AttributeError:
+    mqttClient = mqtt.Client(client_id=emulatorName)
+except ModuleNotFoundError:
+    mqttClient = mqtt.Client(client_id=emulatorName)
+mqttClient.on_message = onMessage
+mqttClient.on_connect = onConnect
+if configData["mqttUser"] != "":
+    mqttClient.username_pw_set(configData["mqttUser"], configData["mqttPassword"])
+# Set Last Will Testament (QOS=1, retain=True), as SMS server does
+mqttClient.will_set(lwtTopic, '{"state":"down"}', 1, True)
+
+# Start state web server if needed
+if args.httpPort:
+    httpServer = http.server.ThreadingHTTPServer(("", args.httpPort), StateHandler)
+    threading.Thread(target=httpServer.serve_forever, name="httpServer", daemon=True).start()
+    logger.info("State available on http://localhost:%s/debug", args.httpPort)
+
+# Connect to MQTT and never give up!
+mqttClient.connect_async(mqttServer, mqttPort)
+mqttClient.loop_forever(retry_first_connection=True)
@@ -6,25 +6,33 @@ It sends a test SMS to SMS server and checks it can read it back within a minute
 
 If not, it sends a error mail and restart SMS server if smsServerRestartUrl is defined in JSON file
 
+It can also be used to:
+    - monitor SMS server continuously (--monitor): send a probe at a given interval on a single MQTT
+        connection, keep success rate and latency of last probes, and restart SMS server only after
+        some consecutive failures, waiting longer between each restart,
+    - benchmark SMS server round trip (--bench): send tagged probes at a given rate and concurrency,
+        and report latency percentiles, throughput, loss and reordering in a JSON file,
+    - record live MQTT traffic into a file (--record),
+    - replay a recorded file against handlers (--replay), at original or faster speed.
+
 Author: Flying Domotic
 License: GNU GPL V3
 """
 
-fileVersion = "1.0.0"
+fileVersion = "1.2.0"
 
 import pathlib
 import os
 import socket
 import random
-import smtplib
-import email.utils
-from email.mime.text import MIMEText
 import logging
 import json
-import socket
-import requests
+import argparse
+import threading
+import time
 from datetime import datetime
 import paho.mqtt.client as mqtt
+# Other modules are imported only when needed, to start quickly when run from cron
 
 def onConnect(client, userdata, flags, reasonCode, properties=None):
     # Check for connection state
@@ -77,16 +85,11 @@ def onMessage(client, userdata, msg):
 
 # Send an email to me
 def sendMail(subject, message, mailServer, sender, to=''):
-    with smtplib.SMTP(mailServer) as server:
-        msg = MIMEText(message, _charset='UTF-8')
-        msg['Subject'] = hostName +": "+subject
-        msg['Date'] = email.utils.formatdate(localtime=1)
-        msg['From'] = sender
-        if to:
-            msg['To'] = to
-        else:
-            msg['To'] = sender
-        server.sendmail(msg['From'], msg['To'], msg.as_string())
+    from smsMailer import MailQueue
+    mailQueue = MailQueue(mailServer, sender, logger, maxRetries=2)
+    mailQueue.send(hostName +": "+subject, message, to)
+    # Wait for mail to be sent (or given up)
+    mailQueue.close()
 
 # Returns a dictionary value giving a key or default value if not existing
 def getValue(dict, key, default=''):
@@ -102,6 +105,35 @@ def getValue(dict, key, default=''):
 #   *** Main code ***
 #   *****************
 
+# Parse command line
+parser = argparse.ArgumentParser(description="Test, benchmark, record or replay SMS server traffic")
+parser.add_argument("--bench", type=int, metavar="COUNT", help="send COUNT probes and report round trip statistics")
+parser.add_argument("--rate", type=float, default=1.0, help="probes sent per second (0 for no limit, default 1)")
+parser.add_argument("--concurrency", type=int, default=1, help="maximum probes waiting for answer (default 1)")
+parser.add_argument("--timeout", type=float, default=60.0, help="seconds to wait for a probe answer (default 60)")
+parser.add_argument("--output", help="benchmark results file (default <script name>Bench.json)")
+parser.add_argument("--record", metavar="FILE", help="record MQTT traffic into FILE")
+parser.add_argument("--duration", type=float, default=60.0, help="recording duration in seconds (default 60)")
+parser.add_argument("--topic", action="append", help="topic to record (default to receive topic, can be repeated)")
+parser.add_argument("--replay", metavar="FILE", help="publish again traffic recorded into FILE")
+parser.add_argument("--speed", type=float, default=1.0, help="replay speed factor, greater than 0 (default 1)")
+parser.add_argument("--map", action="append", metavar="RECORDED=TOPIC", help="publish messages recorded on RECORDED topic to TOPIC when replaying (can be repeated)")
+parser.add_argument("--monitor", action="store_true", help="monitor SMS server continuously")
+parser.add_argument("--interval", type=float, default=300.0, help="seconds between two monitor probes (default 300)")
+parser.add_argument("--window", type=int, default=20, help="monitor probes kept for statistics (default 20)")
+parser.add_argument("--failures", type=int, default=3, help="consecutive failures before restarting SMS server (default 3)")
+parser.add_argument("--cooldown", type=float, default=900.0, help="minimum seconds between two restarts, doubled after each restart (default 900)")
+parser.add_argument("--maxCooldown", type=float, default=14400.0, help="maximum seconds between two restarts (default 14400)")
+args = parser.parse_args()
+if args.speed <= 0:
+    parser.error(F"--speed should be greater than 0, not {args.speed}")
+topicMap = {}
+for item in args.map or []:
+    recordedTopic, separator, topic = item.partition("=")
+    if not separator or recordedTopic == "" or topic == "":
+        parser.error(F"--map should be RECORDED=TOPIC, not {item}")
+    topicMap[recordedTopic] = topic
+
 # Set current working directory to this python file folder
 currentPath = pathlib.Path(__file__).parent.resolve()
 os.chdir(currentPath)
@@ -115,12 +147,17 @@ cdeFile = pathlib.Path(__file__).stem
 
 # Log settings
 logFile = str(cdeFile) + prefix + ".log"
-# Delete log file if already existing
-if os.path.exists(logFile):
-    os.remove(logFile)
-logger = logging.getLogger(cdeFile)
-logging.basicConfig(filename=logFile, level=logging.INFO)
-logger.setLevel(logging.INFO)
+if args.monitor:
+    # Keep log file, rotated each week
+    from smsLogging import setupLogging
+    logger, _ = setupLogging(cdeFile, logFile)
+else:
+    # Delete log file if already existing (it's sent by mail in case of error)
+    if os.path.exists(logFile):
+        os.remove(logFile)
+    logger = logging.getLogger(cdeFile)
+    logging.basicConfig(filename=logFile, level=logging.INFO)
+    logger.setLevel(logging.INFO)
 logger.info('----- Starting on '+hostName+', version '+fileVersion+' -----')
 
 # Define global flag, set by callback routine
@@ -165,6 +202,25 @@ data['number'] = jsonData['smsServerNumber']
 data['message'] = F"Test from {hostName} {datetime.now().isoformat()}"
 data['prefix'] = prefix
 
+# Monitor mode: keep MQTT connection open (reconnecting when lost), and send probes from a background thread
+if args.monitor:
+    from smsTransport import MqttTransport
+    from smsMonitor import HealthMonitor, restartGateway
+    from smsMailer import MailQueue
+    mailQueue = MailQueue(jsonData['mailServer'], jsonData['mailSender'], logger)
+    mqttTransport = MqttTransport(mqttClientName, logger, reconnectMinDelay=getValue(jsonData, "mqttReconnectMinDelay", 1),
+        reconnectMaxDelay=getValue(jsonData, "mqttReconnectMaxDelay", 60))
+    restartUrl = jsonData['smsServerRestartUrl']
+    monitor = HealthMonitor(mqttTransport.publish, mqttTransport.client.is_connected, jsonData['mqttSendTopic'], jsonData['smsServerNumber'],
+        prefix, logger, args.interval, args.timeout, args.window, args.failures, args.cooldown, args.maxCooldown,
+        (lambda: restartGateway(restartUrl, logger)) if restartUrl != "" else None,
+        lambda subject, message: mailQueue.send(hostName +": "+subject, message), cdeFile + "Status.json")
+    mqttTransport.onConnect = lambda client, userdata, flags, reasonCode, properties=None: mqttTransport.subscribe(jsonData['mqttReceiveTopic'])
+    mqttTransport.onMessage = lambda client, userdata, msg: monitor.onMessage(msg)
+    threading.Thread(target=monitor.run, name="monitor", daemon=True).start()
+    logger.info("Monitoring SMS server every %s seconds", args.interval)
+    mqttTransport.run(lambda: (jsonData['mqttServer'], jsonData['mqttPort'], jsonData['mqttUser'], jsonData['mqttPassword'], None, None))
+
 # Try to find CallbackAPIVersion (exists starting on version 2)
 try:
     from paho.mqtt.enums import CallbackAPIVersion
@@ -186,6 +242,46 @@ if jsonData['mqttUser'] != "":
 # Connect to MQTT
 mqttClient.connect(host=jsonData['mqttServer'], port=jsonData['mqttPort'])
 
+# Benchmark, record or replay modes
+if args.bench or args.record or args.replay:
+    from smsBenchmark import Benchmark, Recorder, replay
+    subscribed = threading.Event()
+    topics = [jsonData['mqttReceiveTopic']]
+    if args.bench:
+        tool = Benchmark(mqttClient, jsonData['mqttSendTopic'], jsonData['mqttReceiveTopic'], jsonData['smsServerNumber'], prefix, logger)
+        mqttClient.on_message = lambda client, userdata, msg: tool.onMessage(msg)
+    elif args.record:
+        tool = Recorder(args.record)
+        topics = args.topic if args.topic else [jsonData['mqttReceiveTopic']]
+        mqttClient.on_message = lambda client, userdata, msg: tool.onMessage(msg)
+    else:
+        mqttClient.on_message = None
+    mqttClient.on_connect = lambda client, userdata, flags, reasonCode, properties=None: client.subscribe([(topic, 0) for topic in topics])
+    mqttClient.on_subscribe = lambda client, userdata, mid, reasonCode, properties=None: subscribed.set()
+    mqttClient.loop_start()
+    if not subscribed.wait(30):
+        logger.error("Can't subscribe to %s", topics)
+        print("Can't connect/subscribe to MQTT server")
+        exit(2)
+    if args.bench:
+        results = tool.run(args.bench, args.rate, max(1, args.concurrency), args.timeout)
+        outputFile = args.output if args.output else cdeFile + "Bench.json"
+        with open(outputFile, "w") as outputStream:
+            json.dump(results, outputStream, indent=4)
+        print(json.dumps(results, indent=4))
+    elif args.record:
+        time.sleep(args.duration)
+        tool.close()
+        print(F"{tool.count} messages recorded into {args.record}")
+    else:
+        # Answers recorded on send topic would be sent again as real SMS, unless they're redirected
+        skipTopics = [jsonData['mqttSendTopic']] if jsonData['mqttSendTopic'] not in topicMap else []
+        count = replay(mqttClient, args.replay, args.speed, topicMap, skipTopics)
+        print(F"{count} messages replayed from {args.replay}")
+    mqttClient.disconnect()
+    mqttClient.loop_stop()
+    exit(0)
+
 # Wait for answer for a minute
 sleepCount = 60
 while not correctMessageReceived and sleepCount > 0:
@@ -204,20 +300,13 @@ if correctMessageReceived:
 else:    
     # if SMS restart command defined, restart SMS server
     if jsonData['smsServerRestartUrl'] != "":
-        try:
-            httpAnswer = requests.get(jsonData['smsServerRestartUrl'])
-        except Exception as e:
-            logging.error(F"Error {str(e)} restarting ESP")
-        else:
-            if httpAnswer.status_code == 200:
-                logging.info(F"Restarting ESP returned {httpAnswer.text}")
-            else:
-                logging.error(F"Restarting ESP returned error {httpAnswer.status_code} {httpAnswer.text}")
+        from smsMonitor import restartGateway
+        restartGateway(jsonData['smsServerRestartUrl'], logger)
     # Stop logging
     logging.shutdown()
     # Open logging file
     with open(logFile, "r") as logStream:
-        errors = logStream.readl()
+        errors = logStream.read()
     # Print all errors
     print(errors, end="")
     # Send a mail with errors
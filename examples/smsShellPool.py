@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+Pool of warm shell sessions, used by smsHandler.py to run commands without paying shell start
+    and init command (like sourcing a profile or activating a virtual environment) at each SMS.
+
+Each session is a shell started once, which runs init command, then reads commands on its input.
+    A command is run in a subshell (so that "cd", "exit" or variables don't change the session),
+    with no input, followed by an end line containing a random token and its exit code, used to
+    find end of its output.
+
+A session is replaced by a new one after a given count of commands, when a command lasts too
+    long (whole session being killed), or when session itself fails (shell stopped, end line not
+    found). Replacements are started in background, so that a given count of sessions are ready
+    when no command runs.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import os
+import re
+import selectors
+import shlex
+import signal
+import subprocess
+import threading
+import time
+import uuid
+
+# Start of end line written after each command
+END_PREFIX = "__smsShellEnd_"
+
+# Make line numbers of shell errors (growing in a session) equal to those of a new shell, so that "shellErrorRemove" still works
+def normalizeShellErrors(text, shellName):
+    return re.sub(rF"^({re.escape(shellName)}): (line )?\d+: ", r"\1: \g<2>1: ", text, flags=re.MULTILINE)
+
+class ShellSession:
+    # Start a shell and run init command (raises OSError if shell doesn't get ready)
+    def __init__(self, shellName, initCommand, cwd, initTimeout):
+        self.process = subprocess.Popen([shellName], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd,
+            start_new_session=True)
+        self.fd = self.process.stdout.fileno()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.process.stdout, selectors.EVENT_READ)
+        self.commandCount = 0
+        initOutput = bytearray()
+        initCommand = initCommand.strip().rstrip(";").strip()
+        token = uuid.uuid4().hex
+        try:
+            self._write((initCommand + " </dev/null\n" if initCommand != "" else "") + F"printf '\\n{END_PREFIX}{token} ready\\n'\n")
+            found, timedOut, _ = self._readUntil(F"\n{END_PREFIX}{token} ".encode(), time.monotonic() + initTimeout, initOutput.extend)
+        except OSError:
+            found, timedOut = False, False
+        if not found:
+            self.close()
+            raise OSError(F"{shellName} not ready{' after ' + str(initTimeout) + ' seconds' if timedOut else ''}: {initOutput[-200:].decode(errors='backslashreplace')}")
+
+    # Run a command, writing its output (stdout+stderr) to capture (see smsOutputCapture.py)
+    #   Returns return code, timed out flag and session health (False if it should not be used again)
+    def run(self, command, capture, timeout=None):
+        self.commandCount += 1
+        self._discardStaleOutput()
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            self._write(F"( eval {shlex.quote(command)} ) </dev/null 2>&1; printf '\\n{END_PREFIX}{token} %d\\n' $?\n")
+            found, timedOut, returnCode = self._readUntil(F"\n{END_PREFIX}{token} ".encode(), deadline, capture.write)
+        except OSError:
+            found, timedOut, returnCode = False, False, None
+        capture.close()
+        if timedOut:
+            # Kill whole session, as command may have started children
+            self.close()
+            return -signal.SIGKILL, True, False
+        if not found:
+            # Session died (or its input was closed) during command
+            self.close()
+            return self.process.returncode if self.process.returncode != None else -1, False, False
+        return int(returnCode), False, True
+
+    # Return True if shell is still running
+    def isAlive(self):
+        return self.process.poll() == None
+
+    # Kill shell and its children
+    def close(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        self.process.wait()
+        self.selector.close()
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    # Write text to shell input
+    def _write(self, text):
+        self.process.stdin.write(text.encode("UTF-8"))
+        self.process.stdin.flush()
+
+    # Read output up to an end line, writing output before it to sink
+    #   Returns found flag, timed out flag and rest of end line
+    def _readUntil(self, endMarker, deadline, sink):
+        pending = b""
+        keep = len(endMarker) + 16                                  # Enough to hold a partial end line
+        while True:
+            index = pending.find(endMarker)
+            if index >= 0:
+                lineEnd = pending.find(b"\n", index + len(endMarker))
+                if lineEnd >= 0:
+                    sink(pending[:index])
+                    return True, False, pending[index + len(endMarker):lineEnd].decode()
+            elif len(pending) > keep:
+                sink(pending[:-keep])
+                pending = pending[-keep:]
+            remaining = deadline - time.monotonic() if deadline != None else None
+            if remaining != None and (remaining <= 0 or not self.selector.select(remaining)):
+                sink(pending)
+                return False, True, None
+            data = os.read(self.fd, 65536)
+            if not data:
+                sink(pending)
+                return False, False, None
+            pending += data
+
+    # Drop output written after end of previous command (by its background children)
+    def _discardStaleOutput(self):
+        while self.selector.select(0):
+            if not os.read(self.fd, 65536):
+                break
+
+class ShellPool:
+    # Create a pool, starting its sessions in background
+    #   shellName: shell to start ("" for /bin/sh)
+    #   initCommand: command run once when a session starts (like "source ~/.profile; ")
+    #   size: sessions kept ready
+    #   maxCommands: commands run by a session before it's replaced
+    #   initTimeout: maximum duration of init command (in seconds)
+    #   metrics: optional metrics registry
+    def __init__(self, shellName, initCommand, cwd, logger, size=2, maxCommands=100, initTimeout=60, metrics=None):
+        self.shellName = shellName if shellName != "" else "/bin/sh"
+        self.initCommand = initCommand
+        self.cwd = cwd
+        self.logger = logger
+        self.size = max(1, size)
+        self.maxCommands = max(1, maxCommands)
+        self.initTimeout = initTimeout
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.idleSessions = []
+        self.startingCount = 0
+        self.closed = False
+        self._fill()
+
+    # Run a command in a warm session (raises OSError if no session can be started)
+    #   Returns return code and timed out flag
+    def run(self, command, capture, timeout=None):
+        session = self._acquire()
+        returnCode, timedOut, healthy = session.run(command, capture, timeout)
+        self._release(session, healthy)
+        return returnCode, timedOut
+
+    # Return count of sessions ready
+    def ready(self):
+        with self.lock:
+            return len(self.idleSessions)
+
+    # Stop all sessions (sessions running a command are stopped at end of command)
+    def close(self):
+        with self.lock:
+            self.closed = True
+            sessions = self.idleSessions
+            self.idleSessions = []
+        for session in sessions:
+            session.close()
+
+    # Return a ready session, or start one if none
+    def _acquire(self):
+        with self.lock:
+            while self.idleSessions:
+                session = self.idleSessions.pop()
+                if session.isAlive():
+                    return session
+                session.close()
+        if self.metrics != None:
+            self.metrics.increment("shell_sessions_cold")
+        return self._start()
+
+    # Give back a session after a command, replacing it if needed (or starting missing ones after a start failure)
+    def _release(self, session, reusable):
+        with self.lock:
+            kept = reusable and not self.closed and session.commandCount < self.maxCommands and len(self.idleSessions) < self.size
+            if kept:
+                self.idleSessions.append(session)
+            self._fillLocked()
+        if kept:
+            return
+        session.close()
+        if self.metrics != None:
+            self.metrics.increment("shell_sessions_recycled")
+
+    # Start a session
+    def _start(self):
+        startTime = time.monotonic()
+        session = ShellSession(self.shellName, self.initCommand, self.cwd, self.initTimeout)
+        if self.metrics != None:
+            self.metrics.increment("shell_sessions_started")
+            self.metrics.observe("shell_start", round((time.monotonic() - startTime) * 1000, 3))
+        return session
+
+    # Start sessions in background, up to pool size
+    def _fill(self):
+        with self.lock:
+            self._fillLocked()
+
+    # Start sessions in background, up to pool size (lock should be held)
+    def _fillLocked(self):
+        while not self.closed and len(self.idleSessions) + self.startingCount < self.size:
+            self.startingCount += 1
+            threading.Thread(target=self._startInBackground, name="shellStarter", daemon=True).start()
+
+    # Start a session and make it ready (starter thread)
+    def _startInBackground(self):
+        try:
+            session = self._start()
+        except OSError as e:
+            self.logger.error("Error starting warm shell: %s", e)
+            with self.lock:
+                self.startingCount -= 1
+            return
+        with self.lock:
+            self.startingCount -= 1
+            if not self.closed and len(self.idleSessions) < self.size:
+                self.idleSessions.append(session)
+                return
+        session.close()
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+"""
+This file is part of FF_SmsServer (https://github.com/FlyingDomotic/FF_SmsServer)
+
+MQTT transport used by smsHandler.py and readSms.py, keeping connection alive.
+
+By default, it behaves as a plain paho client (clean session, QoS 0). When reliable mode is set:
+    - client id is stable, and session is persistent (broker keeps subscriptions and QoS 1
+        messages received while we're disconnected),
+    - subscriptions and publications use QoS 1, with a maximum count of messages waiting for
+        acknowledge (in flight window), and a maximum count of messages queued while disconnected.
+
+In both modes, connection is retried with an exponential delay (with random jitter, to avoid all
+    clients reconnecting at the same time after a broker restart).
+
+When a metrics registry is given, reconnections count and duration, and messages recovered from
+    session (received after reconnection, before our subscriptions were renewed, or redelivered)
+    are recorded.
+
+Author: Flying Domotic
+License: GNU GPL V3
+"""
+
+fileVersion = "1.0.0"
+
+import paho.mqtt.client as mqtt
+import random
+import time
+
+class MqttTransport:
+    # Create an MQTT transport (set onConnect and onMessage, then call run)
+    #   clientId: MQTT client id (should be stable in reliable mode, to find our session again)
+    #   reliable: use a persistent session and QoS 1
+    #   maxInflight: QoS 1 messages sent and not yet acknowledged
+    #   maxQueued: messages kept while disconnected or while in flight window is full (0 for no limit)
+    #   reconnectMinDelay/reconnectMaxDelay: bounds of delay between reconnections (in seconds)
+    #   metrics: optional metrics registry
+    def __init__(self, clientId, logger, reliable=False, maxInflight=20, maxQueued=1000, reconnectMinDelay=1, reconnectMaxDelay=60, metrics=None):
+        self.logger = logger
+        self.reliable = reliable
+        self.qos = 1 if reliable else 0
+        self.reconnectMinDelay = max(0.1, reconnectMinDelay)
+        self.reconnectMaxDelay = max(self.reconnectMinDelay, reconnectMaxDelay)
+        self.metrics = metrics
+        self.onConnect = None                                       # User's connection callback
+        self.onMessage = None                                       # User's message callback
+        self.disconnectTime = None                                  # Time (monotonic) connection was lost
+        self.disconnectRequested = False
+        self.reconnectAttempt = 0                                   # Failed attempts since last accepted connection
+        self.recovering = False                                     # Messages are coming from our session
+        self.recoveredCount = 0
+        random.seed()
+        # Try to find CallbackAPIVersion (exists starting on version 2)
+        try:
+            from paho.mqtt.enums import CallbackAPIVersion
+            self.client = mqtt.Client(client_id=clientId, clean_session=not reliable, callback_api_version=CallbackAPIVersion.VERSION2)
+        except AttributeError:
+            self.client = mqtt.Client(client_id=clientId, clean_session=not reliable)
+        except ModuleNotFoundError:
+            self.client = mqtt.Client(client_id=clientId, clean_session=not reliable)
+        if reliable:
+            self.client.max_inflight_messages_set(maxInflight)
+            self.client.max_queued_messages_set(maxQueued)
+        self.client.on_connect = self._onConnect
+        self.client.on_message = self._onMessage
+        self.client.on_subscribe = self._onSubscribe
+        self.client.on_disconnect = self._onDisconnect
+        if metrics != None:
+            for counterName in ("mqtt_reconnects", "mqtt_messages_recovered", "mqtt_publish_dropped"):
+                metrics.increment(counterName, 0)
+
+    # Publish a message with transport QoS, returns False if it can't be sent nor queued
+    def publish(self, topic, payload, retain=False):
+        result = self.client.publish(topic, payload, self.qos, retain)
+        if result.rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+            self.logger.error("Outgoing queue full, %s to %s dropped", payload, topic)
+            if self.metrics != None:
+                self.metrics.increment("mqtt_publish_dropped")
+            return False
+        if result.rc == mqtt.MQTT_ERR_NO_CONN and not self.qos:
+            # Messages published while disconnected are only sent at reconnection when QoS is 1
+            self.logger.error("Not connected, %s to %s dropped", payload, topic)
+            if self.metrics != None:
+                self.metrics.increment("mqtt_publish_dropped")
+            return False
+        return result.rc == mqtt.MQTT_ERR_SUCCESS or result.rc == mqtt.MQTT_ERR_NO_CONN
+
+    # Subscribe to a topic with transport QoS
+    def subscribe(self, topic):
+        self.client.subscribe(topic, self.qos)
+
+    # Disconnect from broker (run will reconnect immediately, reading parameters again)
+    def disconnect(self):
+        self.disconnectRequested = True
+        self.client.disconnect()
+
+    # Connect and serve forever, reconnecting when connection is lost
+    #   getParameters: function returning (host, port, user, password, willTopic, willPayload), called before each connection
+    def run(self, getParameters):
+        while True:
+            host, port, user, password, willTopic, willPayload = getParameters()
+            self.client.username_pw_set(user, password)
+            if willTopic:
+                # Set Last Will Testament (retain=True)
+                self.client.will_set(willTopic, willPayload, self.qos, True)
+            try:
+                self.client.connect(host, port)
+            except OSError as e:
+                delay = self._reconnectDelay(self.reconnectAttempt)
+                self.reconnectAttempt += 1
+                self.logger.error("Error %s connecting to %s:%s, retrying in %.1f seconds", e, host, port, delay)
+                if self.disconnectTime == None:
+                    self.disconnectTime = time.monotonic()
+                time.sleep(delay)
+                continue
+            result = mqtt.MQTT_ERR_SUCCESS
+            while result == mqtt.MQTT_ERR_SUCCESS:
+                result = self.client.loop(timeout=1.0)
+            if self.disconnectTime == None:
+                self.disconnectTime = time.monotonic()
+            if self.disconnectRequested:
+                self.disconnectRequested = False
+                continue
+            # Delay only goes back to minimum after a connection accepted by broker (not after a refusal, like bad credentials)
+            delay = self._reconnectDelay(self.reconnectAttempt)
+            self.reconnectAttempt += 1
+            self.logger.error("Connection to %s:%s lost (%s), reconnecting in %.1f seconds", host, port, mqtt.error_string(result), delay)
+            time.sleep(delay)
+
+    # Return delay before next reconnection: exponential, with random jitter
+    def _reconnectDelay(self, attempt):
+        return random.uniform(self.reconnectMinDelay, min(self.reconnectMaxDelay, self.reconnectMinDelay * 2 ** min(attempt, 30)))
+
+    def _onConnect(self, client, userdata, flags, reasonCode, properties=None):
+        if reasonCode == 'Success' or str(reasonCode) == '0':
+            self.reconnectAttempt = 0
+            # Flags are an object starting with paho version 2, a dictionary before
+            sessionPresent = getattr(flags, "session_present", None)
+            if sessionPresent == None:
+                sessionPresent = flags.get("session present", 0) if isinstance(flags, dict) else False
+            self.recovering = bool(sessionPresent)
+            self.recoveredCount = 0
+            if self.disconnectTime != None:
+                reconnectMs = round((time.monotonic() - self.disconnectTime) * 1000, 3)
+                self.disconnectTime = None
+                self.logger.info("Reconnected in %.0f ms%s", reconnectMs, ", session found" if sessionPresent else "")
+                if self.metrics != None:
+                    self.metrics.increment("mqtt_reconnects")
+                    self.metrics.observe("mqtt_reconnect", reconnectMs)
+        if self.onConnect != None:
+            self.onConnect(client, userdata, flags, reasonCode, properties)
+
+    def _onMessage(self, client, userdata, msg):
+        # Messages sent by broker before our subscriptions were renewed come from our session
+        if self.recovering or msg.dup:
+            self.recoveredCount += 1
+            if self.metrics != None:
+                self.metrics.increment("mqtt_messages_recovered")
+        if self.onMessage != None:
+            self.onMessage(client, userdata, msg)
+
+    def _onSubscribe(self, client, userdata, mid, *args):
+        if self.recovering:
+            self.recovering = False
+            if self.recoveredCount:
+                self.logger.info("%d message(s) recovered from session", self.recoveredCount)
+
+    def _onDisconnect(self, client, userdata, *args):
+        if self.disconnectTime == None:
+            self.disconnectTime = time.monotonic()
@@ -212,6 +212,7 @@
 #endif
 String savedLogLines[LOG_MAX_LINES];                                // Buffer to save last log lines
 uint16_t savedLogNextSlot = 0;                                      // Address of next slot to be written
+uint32_t savedLogCount = 0;                                         // Count of lines saved since start (used as /log ETag)
 uint16_t logRequestNextLog = 0;                                     // Address of next slot to be send for a /log request
 
 //  ---- Syslog ----
@@ -223,6 +224,9 @@ uint16_t logRequestNextLog = 0;                                     // Address o
 //  ---- Asynchronous web server ----
 AsyncWebServer webServer(80);                                       // Web server on port 80
 AsyncEventSource events("/events");                                 // Event root
+AsyncStaticWebHandler *versionedFilesHandler = nullptr;             // Serves files with a version (never changing)
+AsyncStaticWebHandler *staticFilesHandler = nullptr;                // Serves other files
+#define ASSETS_MANIFEST "/assets.json"                              // Written by buildWebAssets.py
 
 //  ---- Preferences----
 #define SETTINGS_FILE "/settings.json"
@@ -314,6 +318,9 @@ unsigned long lastMqttcheck = 0;                                    // Last time
 String listeningNodes = "";                                         // List of listening nodes from MQTT LWT
 #define MAX_MQTT_DISCONNECTED 15                                    // Restart ESP if more than this number of disconnected count has bee seen
 #define MQTT_CHECK_STATE_EVERY 30000                                // Check Mqtt state every 30 seconds
+#ifndef MQTT_RECEIVED_QOS
+    #define MQTT_RECEIVED_QOS 0                                     // QoS of received SMS (1 to be kept by broker for persistent sessions)
+#endif
 
 //          --------------------------------------
 //          ---- Function/routines definition ----
@@ -381,6 +388,8 @@ void commandReceived(AsyncWebServerRequest *request);
 void logReceived(AsyncWebServerRequest *request);
 void send404Error(AsyncWebServerRequest *request);
 void notFound(AsyncWebServerRequest *request);
+String getAssetsDate(void);
+void webFilesChanged(void);
 
 //  ---- OTA routines ----
 
@@ -498,6 +507,7 @@ void saveLogMessage(const String message) {
     if (savedLogNextSlot >= LOG_MAX_LINES) {
         savedLogNextSlot = 0;
     }
+    savedLogCount++;
 }
 
 // Returns a log line number
@@ -1286,8 +1296,14 @@ void commandReceived(AsyncWebServerRequest *request) {
 }
 
 // Called when /log is received - Send saved log, line by line
+//  ETag is count of saved lines, so clients can ask only for changes (If-None-Match) and find new lines
 void logReceived(AsyncWebServerRequest *request) {
     if (localEnterFlag) enterRoutine(__func__);
+    String etag = "\"" + String(savedLogCount) + "\"";
+    if (request->hasHeader("If-None-Match") && request->getHeader("If-None-Match")->value() == etag) {
+        request->send(304);                                         // Nothing new since last request
+        return;
+    }
     AsyncWebServerResponse *response = request->beginChunkedResponse("text/plain; charset=utf-8", [](uint8_t *logResponseBuffer, size_t maxLen, size_t index) -> size_t {
         // For all log lines
         while (logRequestNextLog < LOG_MAX_LINES) {
@@ -1309,10 +1325,33 @@ void logReceived(AsyncWebServerRequest *request) {
         return 0;
     });
     logRequestNextLog = 0;
+    response->addHeader("ETag", etag);
     request->send(response);
 }
 
 
+// Returns date of last web files change, from manifest written by buildWebAssets.py ("" if not found)
+String getAssetsDate(void) {
+    String lastModified = "";
+    File manifestFile = LittleFS.open(ASSETS_MANIFEST, "r");        // Open manifest file
+    if (manifestFile) {                                             // Open ok?
+        JsonDocument filter;
+        filter["lastModified"] = true;                              // Don't load list of files
+        JsonDocument jsonData;
+        if (!deserializeJson(jsonData, manifestFile, DeserializationOption::Filter(filter))) {
+            lastModified = jsonData["lastModified"].as<String>();
+        }
+        manifestFile.close();                                       // Close file
+    }
+    return lastModified;
+}
+
+// Called when a file is changed by editor - Browsers should check all files again
+void webFilesChanged(void) {
+    if (versionedFilesHandler) versionedFilesHandler->setCacheControl("no-cache");
+    if (staticFilesHandler) staticFilesHandler->setLastModified("");
+}
+
 // Sends a 404 error with requested file name
 void send404Error(AsyncWebServerRequest *request) {
     char msg[120];
@@ -1457,7 +1496,7 @@ static void onMqttMessage(char* topic, char* payloadPtr, AsyncMqttClientMessageP
     } else if (strTopic.startsWith(mqttLwtTopic)) {
         // This is a LWT message from a connected node
         String node = String(topic).substring(mqttLwtTopic.length()+1);   // Extract node part from topic
-        if (node != "") {                                           // Is node specified?
+        if (node != "" && node.indexOf("/") < 0) {                  // Is node specified (deeper topics, like node stats, are not nodes)?
             // Does payload exists?
             if (payloadPtr[0]) {
                 JsonDocument jsonDoc;
@@ -1520,8 +1559,8 @@ static void onMqttConnect(bool sessionPresent) {
         mqttClient.subscribe(mqttCommandTopic.c_str(), 0);             // Subscribe to command topic (debug commands)
     }
     if (mqttLwtTopic != "") {
-        trace_debug_P("Subscribing to %s", (mqttLwtTopic+"/#").c_str());
-        mqttClient.subscribe((mqttLwtTopic+"/#").c_str(), 0);       // Subscribe to LWT sub topics
+        trace_debug_P("Subscribing to %s", (mqttLwtTopic+"/+").c_str());
+        mqttClient.subscribe((mqttLwtTopic+"/+").c_str(), 0);       // Subscribe to LWT sub topics (one level only, deeper ones are not node states)
     }
     updateWebServerData();
 }
@@ -1799,7 +1838,7 @@ void readSmsCallback(const char* receivedNumber, const char* receivedDate, const
                 // Publish received SMS on MQTT
                 if (mqttReceivedTopic != "") {
                     trace_info_P("Publishing %s to %s", buffer, mqttReceivedTopic.c_str());
-                    int result = mqttClient.publish(mqttReceivedTopic.c_str(), 0, false, buffer);
+                    int result = mqttClient.publish(mqttReceivedTopic.c_str(), MQTT_RECEIVED_QOS, false, buffer);
                     lastPublishTime = millis();
                     if (!result) {
                         trace_error_P("Publish to %s returned %d", mqttReceivedTopic.c_str(), result);
@@ -2393,9 +2432,19 @@ void setup(void) {
     // These URL are used internally by setup.htm - Use them at your own risk!
     webServer.on("/changed", HTTP_GET, setChangedReceived);         // /changed request
     webServer.addHandler(&events);                                  // Define web events
-    webServer.addHandler(new LittleFSEditor());                     // Define file system editor
+    LittleFSEditor *editor = new LittleFSEditor();                  // Define file system editor
+    editor->setOnChange(webFilesChanged);                           // Stop browser caching when a file is changed
+    webServer.addHandler(editor);
     webServer.onNotFound (notFound);                                // To be called when URL is not known
-    webServer.serveStatic("/",LittleFS, "/").setDefaultFile("index.htm"); // Serve "/", default page = index.htm
+    // Files asked with a version (?v=<content hash>, set by buildWebAssets.py) never change, browsers can keep them
+    versionedFilesHandler = &webServer.serveStatic("/",LittleFS, "/").setCacheControl("max-age=31536000, immutable");
+    versionedFilesHandler->setFilter([](AsyncWebServerRequest *request) {return request->hasParam("v");});
+    // Other files are checked by browsers at each use, answered by 304 if not changed since manifest date
+    staticFilesHandler = &webServer.serveStatic("/",LittleFS, "/").setDefaultFile("index.htm").setCacheControl("no-cache"); // Serve "/", default page = index.htm
+    String assetsDate = getAssetsDate();
+    if (assetsDate != "") {
+        staticFilesHandler->setLastModified(assetsDate.c_str());
+    }
 
     webServer.begin();                                              // Start Web server
 
@@ -171,6 +171,13 @@ _username(username)
 }
 
 
+// Remove compressed copy of a file (built by buildWebAssets.py), as web server would send it instead of file
+static void removeCompressedCopy(const String& path){
+    if(!path.endsWith(".gz") && LittleFS.exists(path + ".gz")){
+        LittleFS.remove(path + ".gz");
+    }
+}
+
 void LittleFSEditor::handleRequest(AsyncWebServerRequest *request){
   if(_username.length() && _password.length() && !request->authenticate(_username.c_str(), _password.c_str()))
     return request->requestAuthentication();
@@ -233,6 +240,8 @@ void LittleFSEditor::handleRequest(AsyncWebServerRequest *request){
   } else if(request->method() == HTTP_DELETE){
     if(request->hasParam("path", true)){
         LittleFS.remove(request->getParam("path", true)->value());
+        removeCompressedCopy(request->getParam("path", true)->value());
+        if (_onChange) _onChange();
       request->send(200, "", "DELETE: "+request->getParam("path", true)->value());
     } else
       request->send(404);
@@ -251,6 +260,8 @@ void LittleFSEditor::handleRequest(AsyncWebServerRequest *request){
         if(f){
           f.write((uint8_t)0x00);
           f.close();
+          removeCompressedCopy(filename);
+          if (_onChange) _onChange();
           request->send(200, "", "CREATE: "+filename);
         } else {
           request->send(500);
@@ -275,6 +286,8 @@ void LittleFSEditor::handleUpload(AsyncWebServerRequest *request, const String&
     }
     if(final){
       request->_tempFile.close();
+      removeCompressedCopy(filename);
+      if (_onChange) _onChange();
     }
   }
 }
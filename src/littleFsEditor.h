@@ -9,7 +9,9 @@ class LittleFSEditor: public AsyncWebHandler {
     String _password;
     bool _authenticated;
     uint32_t _startTime;
+    void (*_onChange)(void) = nullptr;                              // Called when a file is changed
   public:
+    void setOnChange(void (*onChange)(void)) {_onChange = onChange;}
 #ifdef ESP32
     LittleFSEditor(const String& username=String(), const String& password=String());
     virtual bool canHandle(AsyncWebServerRequest *request) const override final;